@@ -0,0 +1,167 @@
+'''Timing baseline for the models, the historian ingestion and the fitting hot paths. \n
+Run from the repository root: python benchmarks/run_benchmarks.py (--only <words> for some cases, --large to
+include the 10000x ingestion file) \n
+Every run writes benchmarks/results/<commit>.json. Compare two of them with
+python benchmarks/run_benchmarks.py --compare old.json new.json
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT) # for ptplab and pbr_test.py
+RESULTS_DIR = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+
+from ptplab import DATA_DIR
+from ptplab.catalog import get_run, load_catalog_run
+from ptplab.estimation import run_residuals
+from ptplab.historian import load_run
+from ptplab.models import CSTR_model, PBR_model, CSTR_model_step_change, PBR_model_step_change, PBR_KINETICS
+
+PBR_TANKS = [6, 9, 20, 50, 200]
+INGEST_SIZES = [1, 100] # multiples of a real PBR export (about 1500 rows)
+LARGE_INGEST_SIZE = 10000 # about 1.9 GB on disk and many GB in memory in load_run, only with --large
+INGEST_FILE = os.path.join(DATA_DIR, 'PBR_Data', '18.09.40C_again.csv')
+SCAN_TANKS = range(8, 20) # same range as PBR_Number_of_Tanks.py
+
+def timeit(func, repeat=5, min_time=0.2):
+    '''Calls func until at least min_time has passed (and at least once), repeat times.
+    returns dictionary with min and median seconds per call'''
+    times = []
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            func()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        times.append(elapsed/calls)
+    return {'min': min(times), 'median': float(np.median(times)), 'repeat': repeat}
+
+def scaled_export(factor, directory):
+    '''Historian file with the data rows of INGEST_FILE repeated factor times, written once per directory'''
+    path = os.path.join(directory, f'ingest_{factor}x.csv')
+    if not os.path.exists(path):
+        with open(INGEST_FILE, encoding='ISO-8859-1') as file:
+            header = file.readline()
+            rows = file.read()
+        if not rows.endswith('\n'):
+            rows += '\n'
+        with open(path, 'w', encoding='ISO-8859-1') as file:
+            file.write(header)
+            for _ in range(factor):
+                file.write(rows)
+    return path
+
+def tank_scan(run):
+    '''Sum of squared errors for every tank count, like PBR_Number_of_Tanks.py'''
+    return [np.sum(run_residuals(dict(run, n=n), PBR_KINETICS)**2) for n in SCAN_TANKS]
+
+def cases(ingest_sizes, workdir):
+    '''name -> setup, setup() prepares what the case needs (files, runs) and returns the function to time.
+    Nothing is written or loaded until a case is set up, so --only does not pay for the others.'''
+    def ingest(factor):
+        path = scaled_export(factor, workdir)
+        return lambda: load_run(path)
+
+    def scan():
+        scan_run = load_catalog_run(get_run('PBR 40c'))
+        return lambda: tank_scan(scan_run)
+
+    def rk4():
+        import pbr_test
+        return lambda: pbr_test.CSTR_model(27, 185.8, 14.9, V=567)
+
+    startup = [sys.executable, '-c', 'import ptplab.cli, ptplab.models, ptplab.estimation, ptplab.catalog']
+    benchmarks = {
+        'CSTR_model': lambda: lambda: CSTR_model(27, 185.8, 14.9, V=567),
+        'CSTR_model_step_change': lambda: lambda: CSTR_model_step_change(26.9, 29.99, 185.83, 14.89, V=567),
+        'PBR_model_step_change n=9': lambda: lambda: PBR_model_step_change(30, 35, 24.3, 3.3, 2.2, n=9),
+        'master_function rk4 (pbr_test.CSTR_model)': rk4,
+    }
+    for n in PBR_TANKS:
+        benchmarks[f'PBR_model n={n}'] = lambda n=n: lambda: PBR_model(40, 26.8, 4.1, n=n)
+    for factor in ingest_sizes:
+        benchmarks[f'historian load_run {factor}x'] = lambda factor=factor: ingest(factor)
+    benchmarks['startup (import cli, models, estimation)'] = lambda: lambda: subprocess.run(startup, cwd=REPO_ROOT, check=True)
+    benchmarks['tank count scan n=8..19'] = scan
+    return benchmarks
+
+def commit_id():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+def run(ingest_sizes=INGEST_SIZES, only=None, repeat=5, output=None):
+    with tempfile.TemporaryDirectory() as workdir:
+        benchmarks = cases(ingest_sizes, workdir)
+        results = {}
+        for name, setup in benchmarks.items():
+            if only is not None and not any(word in name for word in only):
+                continue
+            results[name] = timeit(setup(), repeat=repeat)
+            print(f"{name:45s} {results[name]['median']*1e3:12.3f} ms")
+
+    report = {
+        'commit': commit_id(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results,
+    }
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{report['commit']}.json")
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=1)
+    print(f'written to {output}')
+    return report
+
+def compare(old_path, new_path, threshold=1.2):
+    '''Prints new/old median time per case, cases slower than threshold are marked'''
+    with open(old_path) as file:
+        old = json.load(file)
+    with open(new_path) as file:
+        new = json.load(file)
+    print(f"{old['commit']} -> {new['commit']}")
+    regressions = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        ratio = result['median']/old['results'][name]['median']
+        flag = '  <-- slower' if ratio > threshold else ''
+        print(f'{name:45s} {ratio:6.2f}x{flag}')
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--large', action='store_true', help=f'also time the {LARGE_INGEST_SIZE}x ingestion file (about 1.9 GB on disk, '
+                        'load_run needs many GB of memory for it)')
+    parser.add_argument('--only', nargs='+', help='only run cases whose name contains one of these words')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='json file to write (default benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare) else 0)
+    sizes = INGEST_SIZES + ([LARGE_INGEST_SIZE] if args.large else [])
+    run(ingest_sizes=sizes, only=args.only, repeat=args.repeat, output=args.output)
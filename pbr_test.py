@@ -1,47 +1,13 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from datetime import datetime
+
+from ptplab.integrators import master_function # also has an ensemble version for many runs at once
+
 # Assume reaction is 1st order wrt both components
 # Assume isothermal (no exotherm)
 # Assume constant density
 
-def master_function(fun,tspan, y0, method='rk4', number_of_points=100):
-    '''General function to solve system of differential equations. Does not work on single differential equations. \n
-    fun = function 
-    y0 = vector of initial conditions
-    optional:\n
-    method = You can select the method with which your system of differential equations will be evaluated. Default set to second order Runge-Kutta. \n
-    Supported methods : midpoint method ('midpoint'), euler method ('euler'), Classical second order Runge-Kutta ('rk2'), classical fourth order Runge-Kutta ('rk4').
-    number_of_points = how many steps. Default set to 100. Increasing this reduces error but increases computation time. '''
-    dt = (tspan[1] - tspan[0])/number_of_points
-    t = np.linspace(tspan[0], tspan[1], number_of_points+1)
-    y = np.zeros((number_of_points+1, len(y0))) # len(y0) because you would need an initial condition for each derivative.
-    for i in range(len(y0)): #initial conditions as a loop to ensure universability.
-        y[0,i] = y0[i]
-    if method == 'midpoint':
-        for i in range(number_of_points):
-            k1 = fun(t[i], y[i,:])
-            k2 = fun(t[i] + dt*0.5, y[i,:] + 0.5*dt*k1)
-            y[i+1,:] = y[i,:] + dt * k2
-    elif method == 'euler':
-        for i in range(number_of_points):
-            y[i+1,:] = y[i,:] + dt * fun(t[i], y[i,:])
-    elif method == 'rk2':
-        for i in range(number_of_points):
-            k1 = fun(t[i], y[i,:])
-            k2 = fun(t[i] + dt, y[i] + dt*k1)
-            y[i+1,:] = y[i] + dt*0.5*(k1+k2)
-    elif method == 'rk4':
-        for i in range(number_of_points):
-            k1 = fun(t[i], y[i,:])
-            k2 = fun(t[i] + dt*0.5, y[i,:] + 0.5*dt*k1)
-            k3 = fun(t[i] + dt*0.5, y[i,:] + 0.5*dt*k2)
-            k4 = fun(t[i] +dt, y[i,:] + dt*k3)
-            y[i+1,:] = y[i] + dt*((1/6)*k1 + (1/3)*(k2+k3) + (1/6)*k4)
-    else:
-        return 'Unknown method specified. Check documentation for supported methods' # In case an unknown method is specified
-    return t, y
-
 def CSTR_model(T,fv1,fv2, V=500, tspan = [0,3600]):
     '''Models the behavior of the reaction: Water + Acetic Anhydride -> 2 * Acetic acid in an adiabatic CSTR reactor. \n
     Required Arguments: \n
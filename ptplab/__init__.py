@@ -0,0 +1,44 @@
+'''Shared code for the Practical Process Technology (6P4X0) reactor lab. \n
+The scripts in CSTR Code, PBR Code and Submission each carry their own copy of the models and
+the csv extraction. This package holds one copy of those that the fitting and analysis tools use. \n
+historian = reading the historian csv exports \n
+catalog = list of the experimental runs we have \n
+models = CSTR and PBR (tanks in series with glass beads) models \n
+integrators = master_function (fixed step, adaptive and implicit) and its ensemble version \n
+estimation = fitting k0, Ea and U against all runs at once \n
+multistart = the same fit from many starting points \n
+surrogate = precomputed lookup tables of the models \n
+calibration, bootstrap, uncertainty = calibration curves, Arrhenius fit and their uncertainty \n
+kinetics = rate constants from the CSTR conductivity transient with an online Arrhenius fit \n
+probes = versioned calibration table of the PBR temperature probes, applied when runs are loaded \n
+health = drift and stuck detection of the PBR probes across runs, flagged probes are left out of the fits \n
+replicates = runs of the same condition grouped and averaged on a common grid with confidence bands \n
+instrumentation = solver statistics of every model solve \n
+synthetic = historian exports generated from the models \n
+kalman = extended Kalman filter estimating the PBR states live from the probes and conductivity \n
+mhe = moving horizon fit of U and a k0 multiplier during a run \n
+forecast = ensemble forecast of the peak PBR temperature with runaway alerts \n
+pipeline = the analysis as an incremental graph cached by content hash \n
+report = all report figures, solved and rendered on a process pool \n
+cli = python -m ptplab simulate|fit|scan|report \n
+The submodules are imported when they are first used (ptplab.models works after import ptplab), and scipy,
+matplotlib and the process pools are only imported by the functions that need them, so a command starts
+without paying for libraries it does not use.
+'''
+import importlib
+import os
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(REPO_ROOT, 'Submission', 'Data')
+
+SUBMODULES = ('historian', 'catalog', 'models', 'integrators', 'estimation', 'multistart', 'surrogate', 'calibration',
+              'kinetics', 'probes', 'health', 'replicates', 'bootstrap', 'uncertainty', 'instrumentation', 'synthetic', 'kalman',
+              'mhe', 'forecast', 'pipeline', 'report', 'cli')
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module(f'{__name__}.{name}')
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def __dir__():
+    return sorted(list(globals()) + list(SUBMODULES))
@@ -0,0 +1,5 @@
+import sys
+
+from ptplab.cli import main
+
+sys.exit(main())
@@ -0,0 +1,126 @@
+'''Bootstrap confidence intervals for the conductivity calibration curve and the Arrhenius fit. \n
+Two kinds of resampling: 'case' draws the data points with replacement, 'residual' keeps the x values and
+adds resampled residuals to the fitted curve. The straight line fit (ln k against 1/T) has a closed form so
+all resamples are done in one array operation; the exponential calibration curve needs curve_fit for every
+resample, those run in chunks on a process pool.
+'''
+import os
+import numpy as np
+
+from ptplab.calibration import model_func, fit_calibration, arrhenius_parameters, CSTR_CAL_COND, CSTR_CAL_CONC
+
+def resample(x, y, fitted, n_boot, kind, rng):
+    '''Bootstrap datasets as (n_boot, N) arrays. \n
+    fitted = model values at x (only needed for kind='residual')
+    '''
+    index = rng.integers(0, len(x), size=(n_boot, len(x)))
+    if kind == 'case':
+        return x[index], y[index]
+    if kind == 'residual':
+        residuals = y - fitted
+        return np.broadcast_to(x, index.shape), fitted + residuals[index]
+    raise ValueError(f"Unknown bootstrap kind {kind!r}, use 'case' or 'residual'")
+
+def linear_fits(X, Y):
+    '''Least squares slope and intercept of every row of X, Y at once. Rows where all x are the same give nan.'''
+    x_mean = X.mean(axis=1, keepdims=True)
+    y_mean = Y.mean(axis=1, keepdims=True)
+    sxx = np.sum((X - x_mean)**2, axis=1)
+    sxy = np.sum((X - x_mean)*(Y - y_mean), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(sxx > 0, sxy/sxx, np.nan)
+    return slope, y_mean[:, 0] - slope*x_mean[:, 0]
+
+def interval(samples, level=0.95):
+    '''Percentile interval per column, nan rows (failed or degenerate resamples) are left out, nan when none is left'''
+    samples = samples[~np.any(np.isnan(samples), axis=1)]
+    if len(samples) == 0:
+        return np.full((2, samples.shape[1]), np.nan)
+    tail = (1 - level)/2*100
+    return np.percentile(samples, [tail, 100 - tail], axis=0)
+
+def bootstrap_arrhenius(T, k, n_boot=10000, kind='residual', level=0.95, seed=None):
+    '''Bootstrap of the Arrhenius fit ln k = ln k0 - Ea/(R T). \n
+    T = temperatures in kelvin \n
+    k = rate constants \n
+    n_boot = number of resamples \n
+    kind = 'residual' or 'case' \n
+    level = confidence level of the intervals \n
+    returns dictionary with the point 'estimate' {'k0', 'Ea'}, the resampled 'samples' (n_boot, 2) and 'interval' {name: (low, high)}
+    '''
+    rng = np.random.default_rng(seed)
+    x = 1/np.asarray(T, dtype=float)
+    y = np.log(np.asarray(k, dtype=float))
+    slope, intercept = linear_fits(x[None, :], y[None, :])
+    X, Y = resample(x, y, slope*x + intercept, n_boot, kind, rng)
+    slopes, intercepts = linear_fits(X, Y)
+    samples = np.column_stack(arrhenius_parameters(slopes, intercepts))
+    low, high = interval(samples, level)
+    k0, Ea = arrhenius_parameters(slope[0], intercept[0])
+    return {'estimate': {'k0': k0, 'Ea': Ea}, 'samples': samples,
+            'interval': {'k0': (low[0], high[0]), 'Ea': (low[1], high[1])}}
+
+def _fit_chunk(X, Y, p0):
+    '''curve_fit of the calibration curve on every row, nan where it does not converge'''
+    from scipy.optimize import curve_fit
+    out = np.full((len(X), 3), np.nan)
+    for i, (x, y) in enumerate(zip(X, Y)):
+        try:
+            out[i] = curve_fit(model_func, x, y, p0=p0, maxfev=2000)[0]
+        except (RuntimeError, ValueError): # no convergence or a degenerate resample
+            pass
+    return out
+
+def bootstrap_calibration(cal_cond=CSTR_CAL_COND, cal_conc=CSTR_CAL_CONC, n_boot=2000, kind='residual', level=0.95, seed=None, processes=None, chunk_size=250):
+    '''Bootstrap of the calibration curve concentration = a * exp(b * conductivity) + d. \n
+    cal_cond, cal_conc = calibration points \n
+    n_boot = number of resamples \n
+    kind = 'residual' or 'case' \n
+    level = confidence level of the intervals \n
+    processes = worker processes (default all cores) \n
+    returns dictionary with the point 'estimate' {'a', 'b', 'd'}, 'samples' (n_boot, 3) and 'interval' {name: (low, high)}
+    '''
+    rng = np.random.default_rng(seed)
+    x = np.asarray(cal_cond, dtype=float)
+    y = np.asarray(cal_conc, dtype=float)
+    popt, _ = fit_calibration(x, y)
+    X, Y = resample(x, y, model_func(x, *popt), n_boot, kind, rng)
+    chunks = [(X[i:i + chunk_size], Y[i:i + chunk_size], popt) for i in range(0, n_boot, chunk_size)] # start every refit from the point estimate
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(processes) as pool:
+            samples = np.concatenate(list(pool.map(_fit_chunk, *zip(*chunks))))
+    else:
+        samples = np.concatenate([_fit_chunk(*chunk) for chunk in chunks])
+
+    low, high = interval(samples, level)
+    names = ('a', 'b', 'd')
+    return {'estimate': dict(zip(names, popt)), 'samples': samples,
+            'interval': {name: (low[i], high[i]) for i, name in enumerate(names)}}
+
+
+if __name__ == '__main__':
+    import time
+    start = time.perf_counter()
+    calibration = bootstrap_calibration(n_boot=2000, seed=0)
+    print(f'calibration bootstrap took {time.perf_counter() - start:.1f} s')
+    for name, (low, high) in calibration['interval'].items():
+        print(f"{name} = {calibration['estimate'][name]:.5g}  95% interval [{low:.5g}, {high:.5g}]")
+
+    # steady state k at 27 and 30 C from the same slices of experiment14.10.csv as Cal_curve+k0ea_calculations.py
+    from ptplab import DATA_DIR
+    from ptplab.calibration import cstr_rate_constant
+    from ptplab.historian import read_historian, split_tags
+    conductivity = split_tags(*read_historian(os.path.join(DATA_DIR, 'CSTR_Data', 'experiment14.10.csv')))['Q210_PV'][1]
+    steady = np.concatenate([conductivity[43:49], conductivity[80:86]])
+    T = np.repeat([27 + 273, 30 + 273], 6)
+    c_aa = model_func(steady, *[calibration['estimate'][name] for name in 'abd'])*1e-3 # mol/L -> mol/ml
+    k = cstr_rate_constant(c_aa, 174.5, 14, 593.66)
+    start = time.perf_counter()
+    arrhenius = bootstrap_arrhenius(T, k, n_boot=100000, seed=0)
+    print(f'arrhenius bootstrap took {time.perf_counter() - start:.2f} s')
+    for name, (low, high) in arrhenius['interval'].items():
+        print(f"{name} = {arrhenius['estimate'][name]:.4g}  95% interval [{low:.4g}, {high:.4g}]")
@@ -0,0 +1,216 @@
+'''Calibration curves and the Arrhenius fit from Cal_curve+k0ea_calculations.py and Calibration_PFR_Conc_cond.py. \n
+The scripts refit a*exp(b*x)+d with curve_fit every time they run and convert a few numbers at a time.
+conductivity_calibration(instrument, date) fits every calibration set once per process and returns a
+ConductivityCalibration that converts whole Q210_PV / QT210_PV arrays to concentration and model concentrations
+back to conductivity, with their propagated standard deviation. \n
+Conductivity depends on temperature and the reactor runs from 20 to 45 C, so the curve is the slice at the
+calibration temperature of a surface conductivity(c, T) = conductivity(c, T_cal) (1 + alpha (T - T_cal)).
+runs_concentration converts every run against its paired temperature tag in one array operation. \n
+None of the calibration sets has the temperature of its points yet, so T_cal and alpha are textbook values and
+not fitted. Every tool therefore converts without compensation by default (the curve as it is, like the
+scripts), compensate=True opts in. Once a set with temperatures is added, alpha is fitted from it.
+'''
+import numpy as np
+
+from ptplab.models import cw_pure, caah_pure
+
+R_GAS = 8.3145 # J/mol/K, value used for Ea in Cal_curve+k0ea_calculations.py
+
+# Conductivity (uS/cm) of known acetic acid concentrations (mol/L)
+CSTR_CAL_COND = [1695, 1636, 1594, 1530, 1429, 1274, 963, 690, 523] # Q210_PV
+CSTR_CAL_CONC = [1.74, 1.566, 1.392, 1.218, 1.044, 0.87, 0.435, 0.2175, 0.10875]
+PBR_CAL_COND = [1145, 1095, 977, 735, 539] # QT210_PV
+PBR_CAL_CONC = [1.74, 0.87, 0.435, 0.2175, 0.10875]
+# Calibration points of every conductivity instrument as (date, conductivity, concentration[, temperature]), oldest
+# first. A set is used for runs from its date (YYYY-MM-DD) on, None = from the beginning. Sets without the
+# temperature of every point were measured at CALIBRATION_TEMPERATURE. A new calibration is a new line here.
+CALIBRATIONS = {
+    'Q210_PV': [(None, CSTR_CAL_COND, CSTR_CAL_CONC)], # CSTR
+    'QT210_PV': [(None, PBR_CAL_COND, PBR_CAL_CONC)], # PBR
+}
+REACTOR_INSTRUMENTS = {'CSTR': 'Q210_PV', 'PBR': 'QT210_PV'}
+TEMPERATURE_TAGS = {'Q210_PV': 'T200_PV', 'QT210_PV': 'T208_PV'} # probe next to the conductivity cell (PBR: last tank)
+# Conductivity rises by about 2 %/K in dilute electrolytes (linear compensation of DIN EN 27888), the
+# calibration solutions were made up and measured at room temperature. Both are assumed, not measured.
+CALIBRATION_TEMPERATURE = 22 # C
+TEMPERATURE_COEFFICIENT = 0.02 # 1/K
+TEMPERATURE_COEFFICIENT_STD = 0.005 # 1/K, used when the calibration points carry no temperature to fit it from
+
+_curves = {} # (instrument, date of the set) -> ConductivityCalibration, every set is fitted once per process
+
+def model_func(x, a, b, d):
+    '''Calibration curve, concentration (mol/L) = a * exp(b * conductivity) + d'''
+    return a * np.exp(b * x) + d
+
+def surface_func(X, a, b, d, alpha, temperature=CALIBRATION_TEMPERATURE):
+    '''Calibration surface, model_func of the conductivity brought back to the calibration temperature. \n
+    X = (conductivity, T in C), conductivity(c, T) = conductivity(c, temperature) * (1 + alpha (T - temperature))
+    '''
+    conductivity, T = X
+    return model_func(conductivity/(1 + alpha*(T - temperature)), a, b, d)
+
+def fit_surface(cal_cond, cal_conc, cal_temp, temperature=CALIBRATION_TEMPERATURE):
+    '''Fits surface_func to calibration points measured at different temperatures. \n
+    returns popt = (a, b, d, alpha) and pcov
+    '''
+    from scipy.optimize import curve_fit
+    X = (np.asarray(cal_cond, dtype=float), np.asarray(cal_temp, dtype=float))
+    popt, _ = fit_calibration(X[0]/(1 + TEMPERATURE_COEFFICIENT*(X[1] - temperature)), cal_conc) # start from the usual alpha
+    return curve_fit(lambda X, a, b, d, alpha: surface_func(X, a, b, d, alpha, temperature), X, cal_conc,
+                     p0=tuple(popt) + (TEMPERATURE_COEFFICIENT,))
+
+def fit_calibration(cal_cond=CSTR_CAL_COND, cal_conc=CSTR_CAL_CONC):
+    '''Fits model_func to calibration points like the scripts do. \n
+    returns popt = (a, b, d) and pcov
+    '''
+    from scipy.optimize import curve_fit
+    return curve_fit(model_func, cal_cond, cal_conc, p0=(1, -0.001, 0))
+
+class ConductivityCalibration:
+    '''Fitted calibration surface of one conductivity instrument, converts whole arrays both ways. \n
+    cal_cond, cal_conc = calibration points (uS/cm, mol/L) \n
+    cal_temp = temperature of every point (C), when given alpha is fitted with the curve, else the points are taken at
+    temperature and alpha is the TEMPERATURE_COEFFICIENT with its std \n
+    Attributes popt = (a, b, d) of model_func at the calibration temperature, alpha and cov, the covariance of
+    (a, b, d, alpha) that the uncertainties are propagated from to first order. \n
+    Without T the conversions use the curve as it is, like the scripts.
+    '''
+    def __init__(self, cal_cond, cal_conc, instrument=None, date=None, cal_temp=None, temperature=CALIBRATION_TEMPERATURE,
+                 alpha=TEMPERATURE_COEFFICIENT, alpha_std=TEMPERATURE_COEFFICIENT_STD):
+        self.instrument = instrument
+        self.date = date
+        self.temperature = temperature
+        self.cal_cond = np.asarray(cal_cond, dtype=float)
+        self.cal_conc = np.asarray(cal_conc, dtype=float)
+        if cal_temp is None:
+            popt, pcov = fit_calibration(self.cal_cond, self.cal_conc)
+            popt = tuple(popt) + (alpha,)
+            self.cov = np.zeros((4, 4))
+            self.cov[:3, :3] = pcov
+            self.cov[3, 3] = alpha_std**2
+        else:
+            popt, self.cov = fit_surface(self.cal_cond, self.cal_conc, cal_temp, temperature)
+        self.popt = tuple(float(value) for value in popt[:3])
+        self.alpha = float(popt[3])
+        self.pcov = self.cov[:3, :3]
+
+    def _std(self, gradient, slope, noise):
+        '''Standard deviation from the gradient to (a, b, d, alpha) (..., 4) and the measurement noise through slope'''
+        variance = np.einsum('...i,ij,...j->...', gradient, self.cov, gradient) + (slope*noise)**2
+        return np.sqrt(np.maximum(variance, 0))
+
+    def _factor(self, T):
+        '''1 + alpha (T - calibration temperature) and T - calibration temperature, 1 and 0 without T'''
+        if T is None:
+            return 1.0, 0.0
+        difference = np.asarray(T, dtype=float) - self.temperature
+        return 1 + self.alpha*difference, difference
+
+    def concentration(self, conductivity, T=None, return_std=False, noise=0):
+        '''Acetic acid (mol/L) of conductivity (uS/cm) measured at T (C), arrays of any shape that broadcast. \n
+        return_std = also return the standard deviation from the fit and the conductivity noise (uS/cm)
+        '''
+        a, b, d = self.popt
+        factor, difference = self._factor(T)
+        x = np.asarray(conductivity, dtype=float)/factor # at the calibration temperature
+        growth = np.exp(b*x)
+        c = a*growth + d
+        if not return_std:
+            return c
+        slope = a*b*growth # dc/dx
+        gradient = np.stack(np.broadcast_arrays(growth, a*x*growth, 1.0, -slope*x*difference/factor), axis=-1)
+        return c, self._std(gradient, slope/factor, noise)
+
+    __call__ = concentration
+
+    def conductivity(self, concentration, T=None, return_std=False, noise=0):
+        '''Conductivity (uS/cm) at T (C) the surface maps to concentration (mol/L), for example from a model. When
+        d > 0 the curve has no inverse below d, those points sit at its lower end. \n
+        return_std = also return the standard deviation from the fit and the concentration noise (mol/L)
+        '''
+        a, b, d = self.popt
+        factor, difference = self._factor(T)
+        excess = np.maximum(np.asarray(concentration, dtype=float) - d, 1e-3*a + 1e-6)
+        x = np.log(excess/a)/b # at the calibration temperature
+        if not return_std:
+            return x*factor
+        gradient = np.stack(np.broadcast_arrays(-factor/(a*b), -x*factor/b, -factor/(b*excess), x*difference), axis=-1)
+        return x*factor, self._std(gradient, factor/(b*excess), noise)
+
+def conductivity_calibration(instrument, date=None):
+    '''Calibration of an instrument ('Q210_PV', 'QT210_PV' or the reactor 'CSTR', 'PBR') that was valid on date
+    (datetime, numpy datetime64 or YYYY-MM-DD, default the latest), fitted on first use and cached'''
+    instrument = REACTOR_INSTRUMENTS.get(instrument, instrument)
+    day = None if date is None else str(np.datetime64(date, 'D'))
+    sets = [entry for entry in CALIBRATIONS[instrument] if day is None or entry[0] is None or entry[0] <= day]
+    if not sets:
+        raise KeyError(f'no calibration of {instrument} on or before {day}')
+    valid_from, cal_cond, cal_conc, *cal_temp = sets[-1]
+    key = (instrument, valid_from)
+    if key not in _curves:
+        _curves[key] = ConductivityCalibration(cal_cond, cal_conc, instrument=instrument, date=valid_from,
+                                               cal_temp=cal_temp[0] if cal_temp else None)
+    return _curves[key]
+
+def runs_concentration(runs, instrument, compensate=False, return_std=False, noise=0):
+    '''Acetic acid (mol/L) over historian.load_run outputs, with the calibration valid at the start of every run.
+    The conductivity and paired temperature tag of all runs that share a calibration are put end to end and
+    converted in one call. \n
+    compensate = bring the conductivity to the calibration temperature with the TEMPERATURE_TAGS probe (off by
+    default, the coefficient is not fitted yet) \n
+    returns list with the concentration of every run (and list of standard deviations with return_std)
+    '''
+    instrument = REACTOR_INSTRUMENTS.get(instrument, instrument)
+    calibrations = [conductivity_calibration(instrument, run['start_time']) for run in runs]
+    results = [None]*len(runs)
+    stds = [None]*len(runs)
+    for calibration in dict.fromkeys(calibrations):
+        members = [i for i, other in enumerate(calibrations) if other is calibration]
+        conductivity = [runs[i]['tags'][instrument]['values'] for i in members]
+        T = None
+        if compensate:
+            paired = TEMPERATURE_TAGS[instrument]
+            T = np.concatenate([np.interp(runs[i]['tags'][instrument]['elapsed_time'], runs[i]['tags'][paired]['elapsed_time'],
+                                          runs[i]['tags'][paired]['values']) for i in members])
+        converted = calibration.concentration(np.concatenate(conductivity), T=T, return_std=return_std, noise=noise)
+        c, std = converted if return_std else (converted, None)
+        splits = np.cumsum([len(values) for values in conductivity])[:-1]
+        std_pieces = np.split(std, splits) if return_std else [None]*len(members)
+        for i, piece, std_piece in zip(members, np.split(c, splits), std_pieces):
+            results[i], stds[i] = piece, std_piece
+    return (results, stds) if return_std else results
+
+def run_concentration(run, instrument, compensate=False, return_std=False, noise=0):
+    '''runs_concentration of a single run'''
+    converted = runs_concentration([run], instrument, compensate=compensate, return_std=return_std, noise=noise)
+    return (converted[0][0], converted[1][0]) if return_std else converted[0]
+
+def lin_func(x, a, b):
+    return a * x + b
+
+def fit_arrhenius(T, k):
+    '''Fits ln k = ln k0 - Ea/(R T) \n
+    T = temperatures in kelvin \n
+    k = rate constants \n
+    returns popt = (slope, intercept) of ln k against 1/T and pcov
+    '''
+    from scipy.optimize import curve_fit
+    return curve_fit(lin_func, 1/np.asarray(T, dtype=float), np.log(k), p0=(1, 0))
+
+def arrhenius_parameters(slope, intercept):
+    '''Slope and intercept of ln k against 1/T -> (k0, Ea)'''
+    return np.exp(intercept), -slope*R_GAS
+
+def cstr_rate_constant(c_aa, fv1, fv2, V):
+    '''Rate constant from a steady state CSTR outlet concentration, same balance as k_eq in
+    Cal_curve+k0ea_calculations.py. \n
+    c_aa = acetic acid concentration in mol/ml \n
+    fv1, fv2 = water and anhydride flow in ml/min \n
+    V = volume in ml \n
+    returns k in ml/mol/s
+    '''
+    v_w, v_aah = fv1/60, fv2/60
+    v_f = v_w + v_aah
+    c_w0 = cw_pure * v_w/v_f
+    c_aah0 = caah_pure * v_aah/v_f
+    return 2*c_aa*v_f/(V*(2*c_w0 - c_aa)*(2*c_aah0 - c_aa))
@@ -0,0 +1,95 @@
+import os
+import numpy as np
+
+from ptplab import DATA_DIR
+from ptplab.historian import load_run
+from ptplab.models import PBR_PROBES, CSTR_PROBE
+
+# Every experimental run in Submission/Data. step_change runs have the flow or bath temperature changed
+# halfway so they cannot be compared to the constant inlet models, their 'steps' are the settings the
+# step change scripts use (times in seconds, flows in ml/min, T1 missing = the measured inlet temperature).
+RUNS = [
+    {'name': 'CSTR 22c', 'reactor': 'CSTR', 'file': 'CSTR_Data/23.09 22c.csv', 'V': 567, 'step_change': False},
+    {'name': 'CSTR 27c', 'reactor': 'CSTR', 'file': 'CSTR_Data/CSTR 27c.csv', 'V': 567, 'step_change': False},
+    {'name': 'CSTR 37c', 'reactor': 'CSTR', 'file': 'CSTR_Data/25.09 37c.csv', 'V': 567, 'step_change': False},
+    {'name': 'CSTR 42c', 'reactor': 'CSTR', 'file': 'CSTR_Data/42c 25.09.csv', 'V': 567, 'step_change': False},
+    {'name': 'CSTR 25c 100 15', 'reactor': 'CSTR', 'file': 'CSTR_Data/CSTR_25_100_15.csv', 'V': 567, 'step_change': False},
+    {'name': 'CSTR 25c 100 10', 'reactor': 'CSTR', 'file': 'CSTR_Data/CST_25_100_10.2.csv', 'V': 567, 'step_change': False},
+    {'name': 'CSTR 27c-30c', 'reactor': 'CSTR', 'file': 'CSTR_Data/experiment14.10.csv', 'V': 567, 'step_change': True,
+     'steps': {'T1': 26.9, 'T2': 29.99, 'fv1': 185.83, 'fv2': 14.89, 't_change': 1800}},
+    {'name': 'PBR 20c', 'reactor': 'PBR', 'file': 'PBR_Data/23.09.20C.csv', 'V': 131, 'n': 9, 'step_change': False},
+    {'name': 'PBR 22c', 'reactor': 'PBR', 'file': 'PBR_Data/25.09.22C(att.55.conductivityweird).csv', 'V': 131, 'n': 9, 'step_change': False},
+    {'name': 'PBR 30c', 'reactor': 'PBR', 'file': 'PBR_Data/25.09.30C.csv', 'V': 131, 'n': 9, 'step_change': False},
+    {'name': 'PBR 33c', 'reactor': 'PBR', 'file': 'PBR_Data/25.09.33C.csv', 'V': 131, 'n': 9, 'step_change': False},
+    {'name': 'PBR 40c', 'reactor': 'PBR', 'file': 'PBR_Data/18.09.40C_again.csv', 'V': 131, 'n': 9, 'step_change': False},
+    {'name': 'PBR 30c-35c', 'reactor': 'PBR', 'file': 'PBR_Data/PFR_30-35_100_10-20.csv', 'V': 131, 'n': 9, 'step_change': True,
+     'steps': {'T2': 35, 'fv1': 24.3216648101807, 'fv2_1': 1.8605090379715, 'fv2_2': 3.3137059211731, 't_change1': 11*60+20, 't_change2': 25*60+55}},
+]
+
+def get_run(name):
+    '''Looks up a catalog entry by name'''
+    for entry in RUNS:
+        if entry['name'] == name:
+            return entry
+    raise KeyError(f'No run called {name!r} in the catalog')
+
+def select_runs(reactor=None, step_change=False):
+    '''Catalog entries for one reactor type ('CSTR', 'PBR' or None for both). \n
+    step_change = False leaves out the step change runs, None keeps everything
+    '''
+    return [entry for entry in RUNS
+            if (reactor is None or entry['reactor'] == reactor)
+            and (step_change is None or entry['step_change'] == step_change)]
+
+def run_path(entry):
+    return os.path.join(DATA_DIR, entry['file'])
+
+def probes(entry):
+    '''Temperature probes that are compared with the model for this run'''
+    return PBR_PROBES if entry['reactor'] == 'PBR' else [CSTR_PROBE]
+
+def load_catalog_run(entry, t_max=None, probe_table='latest', probe_health='drop'):
+    '''Loads a catalog run and pulls out what the models need. \n
+    entry = catalog entry (dictionary from RUNS) \n
+    t_max = only keep data up to this many minutes after the start (default keeps everything) \n
+    probe_table = probe calibration applied to the temperatures: 'latest' version in probes.TABLE_PATH (if there
+    is one), a version number, a table or None for the raw readings \n
+    probe_health = what happens to PBR probes that health.py flags as drifting or stuck: 'drop' leaves them out of
+    'probes' when the flags are the run's own entry in the probe history read with the same table (a run that is
+    only checked against the history keeps them), 'flag' only lists them in 'probe_flags', None skips the check \n
+    returns dictionary with the inlet temperature (same as the scripts: minimum of T200_PV), the median flows
+    after the start, for every probe the elapsed time (min) and temperature rise above its value before the start,
+    and the 'probe_flags' {probe: reasons}
+    '''
+    if probe_table == 'latest' or isinstance(probe_table, int):
+        from ptplab.probes import load_table
+        probe_table = load_table(version=None if probe_table == 'latest' else probe_table)
+    run = load_run(run_path(entry), calibration=probe_table)
+    tags = run['tags']
+
+    def after_start(tag):
+        elapsed_time = tags[tag]['elapsed_time']
+        return tags[tag]['values'][elapsed_time >= 0]
+
+    prepared = dict(entry)
+    prepared['T_in'] = float(np.min(tags['T200_PV']['values'])) # Minimum temp = ini temp
+    prepared['fv_water'] = float(np.median(after_start('P100_Flow'))) # median because the signal is noisy
+    prepared['fv_aah'] = float(np.median(after_start('P120_Flow')))
+    prepared['probe_flags'] = {}
+    stored = False
+    if probe_health is not None and entry['reactor'] == 'PBR':
+        from ptplab.health import run_flags
+        prepared['probe_flags'], stored = run_flags(entry, run, probe_table)
+    prepared['probes'] = {}
+    for probe in probes(entry):
+        if probe_health == 'drop' and stored and probe in prepared['probe_flags']:
+            continue
+        elapsed_time = tags[probe]['elapsed_time']
+        values = tags[probe]['values']
+        before = elapsed_time <= 0
+        baseline = np.mean(values[before]) if np.any(before) else values[0]
+        keep = elapsed_time >= 0
+        if t_max is not None:
+            keep &= elapsed_time <= t_max
+        prepared['probes'][probe] = {'elapsed_time': elapsed_time[keep], 'rise': values[keep] - baseline}
+    return prepared
@@ -0,0 +1,202 @@
+'''Command line entry point for batch work on a server, without a display. \n
+    python -m ptplab simulate --config runs.json
+    python -m ptplab fit --runs "PBR 40c" "CSTR 27c" --output results
+    python -m ptplab scan --processes 8
+    python -m ptplab report \n
+Every command reads an optional JSON config, options given on the command line win. Results are written to
+the output directory (default ./ptplab_results), figures are rendered with the Agg backend. Example config: \n
+    {
+     "output": "results",
+     "processes": 8,
+     "runs": ["PBR 40c", "CSTR 27c"],
+     "kinetics": {"k0": 4.4e14, "Ea": 9.825e4, "U": 1.2122e-4},
+     "simulate": {"cases": [{"name": "pbr 35c", "reactor": "PBR", "T": 35, "fv_water": 26.8, "fv_aah": 4.1, "n": 9}]},
+     "fit": {"fit": ["k0", "Ea"], "t_max": 30},
+     "scan": {"n": [8, 19]},
+     "report": {"figures": ["probes", "tanks", "volumes", "step"]}
+    }
+'''
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+
+DEFAULT_OUTPUT = 'ptplab_results'
+COMMANDS = ('simulate', 'fit', 'scan', 'report')
+
+def load_config(path=None):
+    '''Reads a JSON config, an empty config when there is no file'''
+    if path is None:
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def catalog_runs(names=None):
+    '''Catalog entries by name, default every run without a step change'''
+    from ptplab.catalog import get_run, select_runs
+    if not names:
+        return select_runs()
+    return [get_run(name) for name in names]
+
+def run_pool(function, jobs, processes, initializer=None, initargs=()):
+    '''function(job) for every job, on a process pool when processes > 1. initializer(*initargs) runs once per
+    worker (or once here) before the jobs, to hand them data they share.'''
+    if processes > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(processes, len(jobs)), initializer=initializer, initargs=initargs) as pool:
+            return list(pool.map(function, jobs))
+    if initializer is not None:
+        initializer(*initargs)
+    return [function(job) for job in jobs]
+
+def safe_name(name):
+    return ''.join(char if char.isalnum() or char in '-_.' else '_' for char in name)
+
+def write_columns(path, columns):
+    '''Writes a dictionary of equally long columns to a csv file'''
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(list(columns))
+        writer.writerows(zip(*columns.values()))
+
+def _simulate_case(job):
+    '''One simulation, either a catalog run or a case from the config'''
+    from ptplab.models import CSTR_model, PBR_model, PBR_PROBES, probe_tank
+    case, kinetics, n_eval = job
+    if 'file' in case: # catalog run, same inputs as the fits use
+        from ptplab.estimation import prepare_runs, simulate_run
+        run = prepare_runs([case])[0]
+        t, temps, sol = simulate_run(run, kinetics, n_eval=n_eval)
+        if temps is None:
+            return case['name'], None, sol.message
+        columns = {'time_min': t}
+        columns.update({probe: temp - 273.15 for probe, temp in temps.items()})
+        columns['C_AA_out'] = (sol.y[2] if run['reactor'] == 'CSTR' else sol.y[-3])*1e3
+        return case['name'], columns, sol.message
+
+    t_end = case.get('t_end', 3600)
+    t_eval = np.linspace(0, t_end, n_eval)
+    options = {'method': 'LSODA', 'rtol': 1e-6, 'atol': 1e-9}
+    n = case.get('n', 9)
+    if case['reactor'] == 'CSTR':
+        sol = CSTR_model(case['T'], case['fv_water'], case['fv_aah'], V=case.get('V', 567), tspan=[0, t_end], t_eval=t_eval, kinetics=kinetics, **options)
+    else:
+        sol = PBR_model(case['T'], case['fv_water'], case['fv_aah'], V=case.get('V', 131), tspan=[0, t_end], n=n, t_eval=t_eval, kinetics=kinetics, **options)
+    if not sol.success:
+        return case['name'], None, sol.message
+    if case['reactor'] == 'CSTR':
+        temps, c_aa = {'T200_PV': sol.y[3]}, sol.y[2]
+    else:
+        temps, c_aa = {probe: sol.y[3 + 5*probe_tank(i, n)] for i, probe in enumerate(PBR_PROBES)}, sol.y[-3]
+    columns = {'time_min': sol.t/60}
+    columns.update({probe: temp - 273.15 for probe, temp in temps.items()})
+    columns['C_AA_out'] = c_aa*1e3
+    return case['name'], columns, sol.message
+
+def simulate(config, output, processes):
+    '''Model output for every case (or catalog run) in the config, one csv per case'''
+    settings = config.get('simulate', {})
+    cases = settings.get('cases') or catalog_runs(config.get('runs'))
+    jobs = [(case, config.get('kinetics'), settings.get('n_eval', 400)) for case in cases]
+    summary = {}
+    for name, columns, message in run_pool(_simulate_case, jobs, processes):
+        if columns is None:
+            summary[name] = {'success': False, 'message': message}
+            continue
+        path = os.path.join(output, f'simulate_{safe_name(name)}.csv')
+        write_columns(path, columns)
+        summary[name] = {'success': True, 'file': path}
+    return summary
+
+def fit(config, output, processes):
+    '''Global fit of the kinetics (estimation.fit_kinetics) against the selected runs'''
+    from ptplab.estimation import PARAMETERS, fit_kinetics
+    settings = config.get('fit', {})
+    fitted = fit_kinetics(catalog_runs(config.get('runs')), start=config.get('kinetics'), fit=settings.get('fit', PARAMETERS),
+                          processes=processes, t_max=settings.get('t_max'))
+    return {
+        'kinetics': fitted['kinetics'],
+        'fit': list(fitted['fit']),
+        'stderr': {name: float(value) for name, value in fitted['stderr'].items()},
+        'cov': fitted['cov'].tolist(),
+        'cost': float(fitted['cost']),
+        'run_rms': fitted['run_rms'],
+        'success': bool(fitted['result'].success),
+        'message': fitted['result'].message,
+    }
+
+# The prepared runs of a scan are sent to every worker once instead of being read again for every n
+_worker_runs = None
+
+def _init_worker(runs):
+    global _worker_runs
+    _worker_runs = runs
+
+def _scan_point(job):
+    from ptplab.estimation import run_residuals
+    from ptplab.models import PBR_KINETICS
+    index, n, kinetics = job
+    run = dict(_worker_runs[index], n=n)
+    residuals = run_residuals(run, kinetics or PBR_KINETICS)
+    return run['name'], n, float(np.sum(residuals**2)), float(np.sqrt(np.mean(residuals**2)))
+
+def scan(config, output, processes):
+    '''Sum of squared errors of the PBR runs for a range of tank counts, like PBR_Number_of_Tanks.py'''
+    from ptplab.estimation import prepare_runs
+    low, high = config.get('scan', {}).get('n', [8, 19])
+    runs = prepare_runs([entry for entry in catalog_runs(config.get('runs')) if entry['reactor'] == 'PBR'])
+    jobs = [(index, n, config.get('kinetics')) for index in range(len(runs)) for n in range(low, high + 1)]
+    results = run_pool(_scan_point, jobs, processes, initializer=_init_worker, initargs=(runs,))
+    write_columns(os.path.join(output, 'scan.csv'), {
+        'run': [name for name, _, _, _ in results],
+        'n': [n for _, n, _, _ in results],
+        'sse': [sse for _, _, sse, _ in results],
+        'rms': [rms for _, _, _, rms in results],
+    })
+    best = {}
+    for name, n, sse, rms in results:
+        if name not in best or sse < best[name]['sse']:
+            best[name] = {'n': n, 'sse': sse, 'rms': rms}
+    return {'best': best, 'file': os.path.join(output, 'scan.csv')}
+
+def report(config, output, processes):
+    '''Model against data figures for every selected run (report.build_report), step change runs included
+    when no runs are given'''
+    from ptplab.catalog import select_runs
+    from ptplab.report import FIGURES, build_report
+    runs = catalog_runs(config['runs']) if config.get('runs') else select_runs(step_change=None)
+    return build_report(output, runs=runs, kinetics=config.get('kinetics'), figures=config.get('report', {}).get('figures', FIGURES),
+                        processes=processes)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='ptplab', description='Batch simulations, fits, tank scans and reports for the reactor lab')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('--config', help='JSON run config')
+    parser.add_argument('--output', help=f'directory for the results (default {DEFAULT_OUTPUT})')
+    parser.add_argument('--processes', type=int, help='worker processes (default all cores)')
+    parser.add_argument('--runs', nargs='+', help='catalog run names (default every run without a step change)')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = load_config(args.config)
+    if args.runs:
+        config['runs'] = args.runs
+    output = args.output or config.get('output', DEFAULT_OUTPUT)
+    processes = args.processes or config.get('processes') or os.cpu_count() or 1
+    os.makedirs(output, exist_ok=True)
+
+    command = {'simulate': simulate, 'fit': fit, 'scan': scan, 'report': report}[args.command]
+    result = command(config, output, processes)
+    path = os.path.join(output, f'{args.command}.json')
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=1, default=str)
+    print(f'{args.command} done, summary in {path}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+'''Fits one set of kinetic parameters (k0, Ea and the bead heat transfer coefficient U) against the
+temperature probes of all selected CSTR and PBR runs at the same time, instead of tuning k0 and Ea per script.
+'''
+import os
+from itertools import repeat
+import numpy as np
+
+from ptplab.catalog import select_runs, load_catalog_run
+from ptplab.models import CSTR_model, PBR_model, PBR_KINETICS, CSTR_PROBE, PBR_PROBES, probe_tank
+
+PARAMETERS = ('k0', 'Ea', 'U')
+# Solver settings for fitting. The default solve_ivp tolerance is too loose for finite difference jacobians,
+# and LSODA because large k0 trial values make the equations stiff.
+SOLVER_OPTIONS = {'method': 'LSODA', 'rtol': 1e-6, 'atol': 1e-9}
+# Range the optimizer is allowed to search in
+BOUNDS = {'k0': (1e3, 1e25), 'Ea': (2e4, 2e5), 'U': (1e-7, 1e-1)}
+N_EVAL = 200 # model points per run, the data is interpolated onto these like the scripts do
+
+def to_x(kinetics, fit=PARAMETERS):
+    '''Kinetic parameters -> optimizer variables. k0 and U are fitted as logarithms because they span
+    orders of magnitude, Ea in kJ/mol so every variable is of order 1-100.'''
+    scale = {'k0': np.log, 'Ea': lambda Ea: Ea/1e3, 'U': np.log}
+    return np.array([scale[name](kinetics[name]) for name in fit])
+
+def from_x(x, fit=PARAMETERS, fixed=None):
+    '''Inverse of to_x. fixed = dictionary with the parameters that are not fitted'''
+    unscale = {'k0': np.exp, 'Ea': lambda x: x*1e3, 'U': np.exp}
+    kinetics = dict(PBR_KINETICS if fixed is None else fixed)
+    for name, value in zip(fit, x):
+        kinetics[name] = float(unscale[name](value))
+    return kinetics
+
+def x_jacobian(kinetics, fit=PARAMETERS):
+    '''d(parameter)/d(x) for every fitted parameter, used to carry the covariance back to k0, Ea, U'''
+    derivative = {'k0': kinetics['k0'], 'Ea': 1e3, 'U': kinetics['U']}
+    return np.array([derivative[name] for name in fit])
+
+def simulate_run(run, kinetics, n_eval=N_EVAL, **options):
+    '''Runs the model that belongs to a prepared run (see catalog.load_catalog_run). \n
+    returns model time in minutes, dictionary {probe: model temperature in K} and the solve_ivp solution.
+    Time and dictionary are None when the solver gave up.
+    '''
+    t_end = max(np.max(probe['elapsed_time']) for probe in run['probes'].values())
+    tspan = [0, 60*max(t_end, 1)]
+    t_eval = np.linspace(tspan[0], tspan[1], n_eval)
+    options = dict(SOLVER_OPTIONS, **options)
+    if run['reactor'] == 'CSTR':
+        sol = CSTR_model(run['T_in'], run['fv_water'], run['fv_aah'], V=run['V'], tspan=tspan, t_eval=t_eval, kinetics=kinetics, **options)
+        if not sol.success:
+            return None, None, sol
+        temps = {CSTR_PROBE: sol.y[3]}
+    else:
+        n = run['n']
+        sol = PBR_model(run['T_in'], run['fv_water'], run['fv_aah'], V=run['V'], tspan=tspan, n=n, t_eval=t_eval, kinetics=kinetics, **options)
+        if not sol.success:
+            return None, None, sol
+        temps = {probe: sol.y[3 + 5*probe_tank(i, n)] for i, probe in enumerate(PBR_PROBES)}
+    return sol.t/60, temps, sol
+
+def run_residuals(run, kinetics, **options):
+    '''Residuals (measured - model temperature rise, in K) for every probe of one run, stacked'''
+    n_data = sum(len(probe['rise']) for probe in run['probes'].values())
+    t, temps, sol = simulate_run(run, kinetics, **options)
+    if temps is None:
+        return np.full(n_data, 1e3) # big but finite so least_squares backs off
+
+    residuals = []
+    for name, probe in run['probes'].items():
+        model_rise = np.interp(probe['elapsed_time'], t, temps[name] - (run['T_in']+273.15))
+        residuals.append(probe['rise'] - model_rise)
+    return np.concatenate(residuals)
+
+# The prepared runs are sent to every worker once instead of with every residual evaluation
+_worker_runs = None
+
+def _init_worker(runs):
+    global _worker_runs
+    _worker_runs = runs
+
+def _worker_residuals(index, kinetics):
+    return run_residuals(_worker_runs[index], kinetics)
+
+def prepare_runs(runs=None, t_max=None):
+    '''Loads catalog entries (default: every run without a step change). Already prepared runs are passed through.'''
+    if runs is None:
+        runs = select_runs()
+    return [run if 'probes' in run else load_catalog_run(run, t_max=t_max) for run in runs]
+
+def fit_kinetics(runs=None, start=None, fit=PARAMETERS, processes=None, t_max=None, diff_step=1e-3, **options):
+    '''Fits the kinetic parameters to all probes of all runs at once with scipy.optimize.least_squares. \n
+    runs = catalog entries or prepared runs (default: every run without a step change) \n
+    start = dictionary with the starting values (default PBR_KINETICS), parameters that are not fitted are kept at these values \n
+    fit = which of 'k0', 'Ea', 'U' to fit \n
+    processes = number of worker processes evaluating the runs in parallel (default all cores, 1 runs everything here) \n
+    t_max = only use data up to this many minutes after the start \n
+    diff_step = relative finite difference step for the jacobian \n
+    other keyword arguments are passed on to least_squares \n
+    returns dictionary with the fitted 'kinetics', their covariance 'cov' (order of fit), 'stderr', 'cost',
+    the rms residual per run 'run_rms' and the raw least_squares result 'result'
+    '''
+    from scipy.optimize import least_squares
+    runs = prepare_runs(runs, t_max=t_max)
+    fixed = dict(PBR_KINETICS if start is None else start)
+    fit = tuple(fit)
+    x0 = to_x(fixed, fit)
+    bounds = (to_x({name: low for name, (low, high) in BOUNDS.items()}, fit),
+              to_x({name: high for name, (low, high) in BOUNDS.items()}, fit))
+    if processes is None:
+        processes = min(len(runs), os.cpu_count() or 1)
+
+    def evaluate(x, pool):
+        kinetics = from_x(x, fit, fixed)
+        if pool is None:
+            return [run_residuals(run, kinetics) for run in runs]
+        return list(pool.map(_worker_residuals, range(len(runs)), repeat(kinetics)))
+
+    def fit_with(pool):
+        result = least_squares(lambda x: np.concatenate(evaluate(x, pool)), x0, bounds=bounds, diff_step=diff_step, **options)
+        return result, evaluate(result.x, pool)
+
+    if processes > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(runs,)) as pool:
+            result, per_run = fit_with(pool)
+    else:
+        result, per_run = fit_with(None)
+
+    kinetics = from_x(result.x, fit, fixed)
+    cov_x = covariance(result)
+    D = np.diag(x_jacobian(kinetics, fit))
+    cov = D @ cov_x @ D
+
+    return {
+        'kinetics': kinetics,
+        'fit': fit,
+        'x': result.x,
+        'cov_x': cov_x,
+        'cov': cov,
+        'stderr': dict(zip(fit, np.sqrt(np.diag(cov)))),
+        'cost': result.cost,
+        'run_rms': {run['name']: float(np.sqrt(np.mean(res**2))) for run, res in zip(runs, per_run)},
+        'result': result,
+    }
+
+def covariance(result):
+    '''Covariance of the fitted variables from the jacobian at the solution, cov = s^2 (J^T J)^-1. \n
+    pinv instead of inv because U has no influence when only CSTR runs are fitted.
+    '''
+    J = result.jac
+    dof = max(len(result.fun) - len(result.x), 1)
+    s_sq = 2*result.cost/dof # cost is half the sum of squares
+    return s_sq*np.linalg.pinv(J.T @ J)
+
+
+if __name__ == '__main__':
+    fitted = fit_kinetics(verbose=1)
+    for name in fitted['fit']:
+        print(f"{name} = {fitted['kinetics'][name]:.4e} +/- {fitted['stderr'][name]:.2e}")
+    for name, rms in fitted['run_rms'].items():
+        print(f'{name}: rms residual {rms:.3f} K')
@@ -0,0 +1,145 @@
+'''Thermal runaway forecaster for the PBR. \n
+Every sample the current state estimate (kalman.PBRKalmanFilter) is rolled forward over a horizon with the
+batched model (models.pbr_ensemble_der_func on integrators.ensemble_master_function). The ensemble members
+differ in their starting state (drawn from the filter covariance), k0, U and inlet temperature, so the whole
+uncertainty band comes out of one solve. An alert is raised when the predicted peak liquid temperature of
+enough members crosses the limit. The buffers are allocated once; a forecast cycle of 64 members over
+15 minutes takes about 0.1 s, far inside the 15 s historian interval.
+'''
+import time
+
+import numpy as np
+
+from ptplab.models import PBR_KINETICS, pbr_ensemble_der_func, pbr_ensemble_params
+
+LIMIT = 50 # C, peak liquid temperature that raises an alert
+HORIZON = 15 # minutes
+MEMBERS = 64
+STEP = 5 # s, rk4 step of the ensemble (the flow term alone allows up to about 80 s with 9 tanks)
+ALERT_PROBABILITY = 0.05 # alert when at least this fraction of the members crosses the limit
+# Spread of the ensemble: ln k0 and ln U (1 sigma) and the inlet temperature in K
+KINETICS_STD = {'k0': 0.3, 'U': 0.5}
+INLET_STD = 0.2
+
+class RunawayForecaster:
+    '''Ensemble forecasts of the peak liquid temperature in the PBR. \n
+    T, fv1, fv2, V, n, kinetics = run conditions as in PBR_model \n
+    horizon = minutes to look ahead, step = integrator step in seconds \n
+    members = ensemble size, limit = alert temperature in C \n
+    kinetics_std = 1 sigma of ln k0 and ln U, inlet_std = 1 sigma of the inlet temperature in K \n
+    seed = random seed of the ensemble draws
+    '''
+    def __init__(self, T, fv1, fv2, V=131, n=9, kinetics=None, horizon=HORIZON, step=STEP, members=MEMBERS, limit=LIMIT,
+                 kinetics_std=KINETICS_STD, inlet_std=INLET_STD, alert_probability=ALERT_PROBABILITY, seed=None):
+        self.n = n
+        self.V = V
+        self.members = members
+        self.limit = limit
+        self.alert_probability = alert_probability
+        self.kinetics_std = dict(kinetics_std)
+        self.inlet_std = inlet_std
+        self.rng = np.random.default_rng(seed)
+        self.number_of_points = max(int(round(horizon*60/step)), 1)
+        self.horizon = self.number_of_points*step/60
+        self.out = np.empty((self.number_of_points + 1, members, 5*n)) # reused by every forecast
+        self.set_inputs(T, fv1, fv2, kinetics)
+
+    def set_inputs(self, T, fv1, fv2, kinetics=None):
+        '''Run conditions and kinetics the next forecasts start from (after a step change or a new MHE fit)'''
+        self.T, self.fv1, self.fv2 = T, fv1, fv2
+        self.kinetics = dict(PBR_KINETICS if kinetics is None else kinetics)
+
+    def draw(self, x, P=None):
+        '''Ensemble of starting states (members, 5n) and the parameters of every member'''
+        M = self.members
+        z = self.rng.standard_normal((M, 3))
+        kinetics = dict(self.kinetics)
+        kinetics['k0'] = self.kinetics['k0']*np.exp(self.kinetics_std.get('k0', 0)*z[:, 0])
+        kinetics['U'] = self.kinetics['U']*np.exp(self.kinetics_std.get('U', 0)*z[:, 1])
+        params = pbr_ensemble_params(self.T + self.inlet_std*z[:, 2], self.fv1, self.fv2, V=self.V, n=self.n, kinetics=kinetics)
+
+        y0 = np.tile(np.asarray(x, dtype=float), (M, 1))
+        if P is not None:
+            values, vectors = np.linalg.eigh(P) # the tapered filter covariance is not always exactly positive definite
+            root = vectors*np.sqrt(np.maximum(values, 0))
+            y0 += self.rng.standard_normal((M, len(x))) @ root.T
+            y0.reshape(M, self.n, 5)[:, :, :3] = np.maximum(y0.reshape(M, self.n, 5)[:, :, :3], 0) # no negative concentrations
+        return y0, params
+
+    def forecast(self, x, P=None, t=0):
+        '''Rolls the ensemble forward from state x (covariance P) at time t (s). \n
+        returns dictionary with the peak liquid temperature of every member 'peaks' (C), its 'median' and 'p95',
+        the 'probability' that the limit is crossed, the earliest 'time_to_limit' (min, None if no member
+        crosses), 'alert' and the wall time of the forecast 'latency' (s)
+        '''
+        from ptplab.integrators import ensemble_master_function
+        start = time.perf_counter()
+        y0, params = self.draw(x, P)
+        times, y = ensemble_master_function(pbr_ensemble_der_func, [t, t + self.horizon*60], y0, method='rk4',
+                                            number_of_points=self.number_of_points, args=(params, self.n), out=self.out)
+        liquid = y[:, :, 3::5] - 273.15 # (time, member, tank)
+        hottest = np.max(liquid, axis=2) # (time, member)
+        hottest[~np.isfinite(hottest)] = np.inf # a member that blew up counts as a runaway
+        peaks = np.max(hottest, axis=0)
+        crossed = hottest >= self.limit
+        probability = float(np.mean(np.any(crossed, axis=0)))
+        time_to_limit = None
+        if probability > 0:
+            time_to_limit = float((times[np.argmax(np.any(crossed, axis=1))] - t)/60)
+        return {
+            't': t,
+            'peaks': peaks,
+            'median': float(np.median(peaks)),
+            'p95': float(np.percentile(peaks, 95)),
+            'probability': probability,
+            'time_to_limit': time_to_limit,
+            'alert': probability >= self.alert_probability,
+            'latency': time.perf_counter() - start,
+        }
+
+def watch(entry, limit=LIMIT, kinetics=None, every=1, **options):
+    '''Runs the filter and the forecaster over a recorded PBR run like they would run live. \n
+    entry = catalog entry of a PBR run \n
+    every = forecast after every this many samples \n
+    other keyword arguments go to RunawayForecaster \n
+    returns list of forecasts (without the member peaks), each with the 'cycle' time of filter plus forecast
+    '''
+    from ptplab.calibration import conductivity_calibration
+    from ptplab.catalog import load_catalog_run, run_path
+    from ptplab.historian import load_run
+    from ptplab.probes import load_table
+    from ptplab.kalman import CONDUCTIVITY_TAG, PBRKalmanFilter, aligned_readings, probe_offsets
+    from ptplab.models import PBR_PROBES
+    prepared = load_catalog_run(entry)
+    run = load_run(run_path(entry), tags=PBR_PROBES + [CONDUCTIVITY_TAG], calibration=load_table())
+    ekf = PBRKalmanFilter(prepared['T_in'], prepared['fv_water'], prepared['fv_aah'], V=entry['V'], n=entry['n'],
+                          kinetics=kinetics, offsets=probe_offsets(run, prepared['T_in']),
+                          calibration=conductivity_calibration(CONDUCTIVITY_TAG, run['start_time']))
+    forecaster = RunawayForecaster(prepared['T_in'], prepared['fv_water'], prepared['fv_aah'], V=entry['V'], n=entry['n'],
+                                   kinetics=kinetics, limit=limit, **options)
+    times = run['tags'][CONDUCTIVITY_TAG]['elapsed_time']
+    readings = aligned_readings(run, PBR_PROBES, times) # the probes as they read at every conductivity time stamp
+    history = []
+    for count, j in enumerate(np.flatnonzero(times >= 0)):
+        start = time.perf_counter()
+        temperatures = {probe: readings[p, j] for p, probe in enumerate(PBR_PROBES) if np.isfinite(readings[p, j])}
+        ekf.step(times[j]*60, temperatures, run['tags'][CONDUCTIVITY_TAG]['values'][j])
+        if count % every:
+            continue
+        result = forecaster.forecast(ekf.x, ekf.covariance(), t=ekf.t)
+        result.pop('peaks')
+        result['cycle'] = time.perf_counter() - start
+        history.append(result)
+    return history
+
+
+if __name__ == '__main__':
+    from ptplab.catalog import get_run
+    from ptplab.synthetic import RESOLUTION
+    for limit in (LIMIT, 42):
+        history = watch(get_run('PBR 40c'), limit=limit, seed=0)
+        cycles = np.array([result['cycle'] for result in history])
+        alerts = [result['t']/60 for result in history if result['alert']]
+        print(f'limit {limit} C: {len(history)} forecasts, cycle median {np.median(cycles)*1e3:.1f} ms, max {np.max(cycles)*1e3:.1f} ms '
+              f'(sample interval {RESOLUTION/1e3:.1f} s), first alert at {alerts[0]:.1f} min' if alerts else
+              f'limit {limit} C: {len(history)} forecasts, cycle median {np.median(cycles)*1e3:.1f} ms, no alert')
@@ -0,0 +1,275 @@
+'''Drift and fault detection of the PBR temperature probes T201_PV..T208_PV across runs. \n
+Every run gets a few numbers per probe from its isothermal windows (probes.detect_isothermal) with the
+calibration table applied: the bias against the bath relative to the other probes of the run (a bath that is off
+moves all probes alike, a probe that drifts moves alone), the noise within the windows and, when the bath went
+through enough temperatures in the run, the slope. These are compared with the runs before through streaming
+statistics kept per probe (Welford mean and variance, and an EWMA that picks up a slow drift before a single run
+stands out). A probe that hardly moves during the reaction while the others rise is stuck. \n
+The history lives in probe_health.json next to the data. catalog.load_catalog_run looks the run up there and
+leaves the probes flagged in its entry out of the fits. A run that is not in the history is checked against it
+and its flags are only reported, and runs read with another probe table than the history was built with are
+not checked at all (the bias baseline only holds for that table). \n
+    history = build_history() # every PBR run in the order they were measured
+    flags = ingest(load_run(path, calibration=load_table()), 'PBR 45c') # a new run, added to the history
+'''
+import json
+import os
+
+import numpy as np
+
+from ptplab import DATA_DIR
+from ptplab.historian import START_TAG, START_THRESHOLD
+from ptplab.models import PBR_PROBES
+from ptplab.probes import REFERENCE_TAG, WINDOW, _windows, detect_isothermal, file_hash, fit_probes, stack_runs
+
+HISTORY_PATH = os.path.join(DATA_DIR, 'probe_health.json')
+STATISTICS = ('bias', 'slope', 'noise')
+MIN_RUN_SAMPLES = 4 # isothermal samples a run needs before its bias and noise count
+MIN_SPAN = 3 # C, range of the bath over the isothermal samples before a run gets its own slope
+MIN_HISTORY = 3 # runs in the history before a new run is compared with it
+Z_LIMIT = 4 # a single run further than this many standard deviations from the history is an outlier
+ALPHA = 0.3 # EWMA weight of the newest run
+DRIFT_LIMIT = 2.5 # EWMA control limit in standard deviations of the EWMA
+STD_FLOOR = {'bias': 0.1, 'slope': 0.02, 'noise': 0.05} # smallest spread of the history (0.1 C is one logging step)
+STUCK_TOLERANCE = 0.1 # C, a probe that moves by no more than one logging step during the run ...
+STUCK_CONTRAST = 0.5 # C, ... while the median of the other probes moves by at least this much is stuck
+
+def run_statistics(run, probes=PBR_PROBES):
+    '''Numbers of one run the history tracks. \n
+    run = historian.load_run output, with the probe calibration applied \n
+    returns dictionary with an array over the probes for every name in STATISTICS (NaN when the run does not
+    tell), 'movement' (range of every probe while the AAH pump is on, C), 'present' and the number of
+    'isothermal' samples
+    '''
+    statistics = {name: np.full(len(probes), np.nan) for name in STATISTICS + ('movement',)}
+    statistics['present'] = np.array([probe in run['tags'] for probe in probes])
+    statistics['isothermal'] = 0
+    if REFERENCE_TAG not in run['tags']:
+        return statistics
+    stacked = stack_runs([run], probes)
+    mask, _ = detect_isothermal(stacked)
+    readings = np.where(stacked['present'], stacked['readings'], np.nan)
+    statistics['isothermal'] = int(np.count_nonzero(mask))
+
+    if statistics['isothermal'] >= MIN_RUN_SAMPLES:
+        bias = np.mean(readings[:, mask] - stacked['reference'][mask], axis=1)
+        statistics['bias'] = bias - np.nanmedian(bias)
+        windows, _, _ = _windows(stacked['run'], WINDOW)
+        statistics['noise'] = np.sqrt(np.mean(np.var(readings[:, windows[mask]], axis=2), axis=1))
+        if np.ptp(stacked['reference'][mask]) >= MIN_SPAN:
+            present = statistics['present']
+            coefficients = fit_probes(readings[present][:, mask], stacked['reference'][mask], degree=1)[0]
+            statistics['slope'][present] = coefficients[:, 0]
+    pump_on = stacked['flow'] >= START_THRESHOLD
+    if np.any(pump_on):
+        statistics['movement'] = np.ptp(readings[:, pump_on], axis=1)
+    return statistics
+
+def _to_json(array):
+    return [None if not np.isfinite(value) else float(value) for value in np.ravel(array)]
+
+def _from_json(values, shape):
+    return np.array([np.nan if value is None else value for value in values], dtype=float).reshape(shape)
+
+class ProbeHistory:
+    '''Streaming statistics of every probe over the runs, one Welford accumulator and one EWMA per probe and
+    statistic (arrays of shape (statistics, probes)). \n
+    probes = probe tags, alpha = EWMA weight of the newest run
+    '''
+    def __init__(self, probes=PBR_PROBES, alpha=ALPHA):
+        self.probes = list(probes)
+        self.alpha = alpha
+        shape = (len(STATISTICS), len(self.probes))
+        self.count = np.zeros(shape)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.ewma = np.full(shape, np.nan)
+        self.runs = [] # name, file hash, start time, statistics and flags of every run taken in
+        self.table_version = None
+
+    def std(self):
+        '''Spread of every statistic over the runs so far, not below STD_FLOOR'''
+        floor = np.array([STD_FLOOR[name] for name in STATISTICS])[:, None]
+        return np.maximum(np.sqrt(self.m2/np.maximum(self.count - 1, 1)), floor)
+
+    def _values(self, statistics):
+        return np.array([statistics[name] for name in STATISTICS], dtype=float)
+
+    def _next_ewma(self, values):
+        seen = np.isfinite(values)
+        first = seen & np.isnan(self.ewma)
+        return np.where(first, values, np.where(seen, self.alpha*values + (1 - self.alpha)*self.ewma, self.ewma))
+
+    def check(self, statistics):
+        '''Compares one run with the history without changing it. \n
+        statistics = run_statistics output \n
+        returns {probe: list of reasons} for the flagged probes, reasons are 'missing', 'stuck',
+        '<statistic> outlier' and '<statistic> drift'
+        '''
+        values = self._values(statistics)
+        ready = self.count >= MIN_HISTORY
+        std = self.std()
+        outlier = ready & np.isfinite(values) & (np.abs(values - self.mean) > Z_LIMIT*std)
+        ewma = self._next_ewma(values)
+        ewma_std = std*np.sqrt(self.alpha/(2 - self.alpha)) # steady state spread of an EWMA of independent runs
+        drift = ready & np.isfinite(ewma) & (np.abs(ewma - self.mean) > DRIFT_LIMIT*ewma_std)
+
+        movement = statistics['movement']
+        others = np.array([np.nanmedian(np.delete(movement, p)) if np.any(np.isfinite(np.delete(movement, p))) else np.nan
+                           for p in range(len(self.probes))])
+        stuck = (movement <= STUCK_TOLERANCE) & (others >= STUCK_CONTRAST)
+
+        flags = {}
+        for p, probe in enumerate(self.probes):
+            reasons = []
+            if not statistics['present'][p]:
+                reasons.append('missing')
+            if stuck[p]:
+                reasons.append('stuck')
+            reasons += [f'{name} outlier' for s, name in enumerate(STATISTICS) if outlier[s, p]]
+            reasons += [f'{name} drift' for s, name in enumerate(STATISTICS) if drift[s, p] and not outlier[s, p]]
+            if reasons:
+                flags[probe] = reasons
+        return flags
+
+    def add(self, statistics, flags=None, name=None, digest=None, start=None):
+        '''Takes one run into the history. The EWMA sees every value so a drift keeps showing, the Welford
+        mean and variance leave out flagged values and stuck probes so a drifting probe does not drag along the
+        baseline it is judged against.'''
+        flags = self.check(statistics) if flags is None else flags
+        values = self._values(statistics)
+        self.ewma = self._next_ewma(values)
+        use = np.isfinite(values)
+        for p, probe in enumerate(self.probes):
+            reasons = flags.get(probe, [])
+            if 'stuck' in reasons:
+                use[:, p] = False
+            for s, statistic in enumerate(STATISTICS):
+                if f'{statistic} outlier' in reasons or f'{statistic} drift' in reasons:
+                    use[s, p] = False
+        self.count += use
+        delta = np.where(use, values - self.mean, 0)
+        self.mean += np.where(use, delta/np.maximum(self.count, 1), 0)
+        self.m2 += np.where(use, delta*(np.where(use, values, 0) - self.mean), 0)
+        self.runs.append({'name': name, 'hash': digest, 'start': start, 'flags': flags,
+                          'statistics': {key: _to_json(statistics[key]) for key in STATISTICS + ('movement',)},
+                          'isothermal': int(statistics['isothermal'])})
+        return flags
+
+    def lookup(self, name, digest):
+        '''Flags stored for a run that is already in the history (same name and file contents), else None'''
+        for run in self.runs:
+            if run['name'] == name and run['hash'] == digest:
+                return run['flags']
+        return None
+
+    def to_dict(self):
+        state = {key: _to_json(getattr(self, key)) for key in ('count', 'mean', 'm2', 'ewma')}
+        return dict(state, probes=self.probes, statistics=list(STATISTICS), alpha=self.alpha,
+                    table_version=self.table_version, runs=self.runs)
+
+    @classmethod
+    def from_dict(cls, contents):
+        history = cls(contents['probes'], contents['alpha'])
+        shape = history.count.shape
+        for key in ('count', 'mean', 'm2', 'ewma'):
+            setattr(history, key, _from_json(contents[key], shape))
+        history.table_version = contents['table_version']
+        history.runs = contents['runs']
+        return history
+
+def load_history(path=HISTORY_PATH):
+    '''Probe history from the file, None when there is none'''
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        return ProbeHistory.from_dict(json.load(file))
+
+def save_history(history, path=HISTORY_PATH):
+    with open(path, 'w') as file:
+        json.dump(history.to_dict(), file, indent=1)
+
+def ingest(run, name, history=None, path=HISTORY_PATH, save=True):
+    '''Checks a new run against the history and takes it in. \n
+    run = historian.load_run output with the probe calibration applied, name = name of the run \n
+    history = ProbeHistory (default the one in path, a new one when there is no file) \n
+    save = write the history back to path \n
+    returns {probe: list of reasons} for the flagged probes
+    '''
+    history = history or load_history(path) or ProbeHistory()
+    digest = file_hash(run['path'])
+    flags = history.lookup(name, digest)
+    if flags is None:
+        flags = history.add(run_statistics(run, history.probes), name=name, digest=digest, start=str(run['start_time']))
+        if save:
+            save_history(history, path)
+    return flags
+
+def build_history(entries=None, path=HISTORY_PATH, table='latest'):
+    '''Starts the history over from the catalog runs, taken in the order they were measured. \n
+    entries = catalog entries (default every PBR run, step change runs included) \n
+    table = probe calibration applied ('latest', a version number or None for raw readings) \n
+    returns the ProbeHistory, also written to path (None writes nothing)
+    '''
+    from ptplab.catalog import run_path, select_runs
+    from ptplab.historian import load_run
+    from ptplab.probes import load_table
+    if table == 'latest' or isinstance(table, int):
+        table = load_table(version=None if table == 'latest' else table)
+    if entries is None:
+        entries = select_runs('PBR', step_change=None)
+    runs = [(load_run(run_path(entry), tags=PBR_PROBES + [REFERENCE_TAG, START_TAG], calibration=table), entry['name'])
+            for entry in entries]
+    runs.sort(key=lambda item: item[0]['start_time'])
+    history = ProbeHistory()
+    history.table_version = table_version(table)
+    for run, name in runs:
+        ingest(run, name, history=history, save=False)
+    if path is not None:
+        save_history(history, path)
+    return history
+
+def run_key(name, digest, path=HISTORY_PATH):
+    '''What the flags of a run depend on, for the pipeline keys: the stored entry of the run when it is in the
+    history (same name and file hash), else the baseline it is checked against. None when there is no history.'''
+    history = load_history(path)
+    if history is None:
+        return None
+    for run in history.runs:
+        if run['name'] == name and run['hash'] == digest:
+            return {'flags': run['flags']}
+    return dict(history.to_dict(), runs=len(history.runs))
+
+def table_version(table):
+    '''Version of a probe calibration table as the history stores it, None for raw readings'''
+    return None if table is None else table.get('version', 'unsaved')
+
+def run_flags(entry, run, table=None, path=HISTORY_PATH):
+    '''Flags of a catalog run for catalog.load_catalog_run. \n
+    run = historian.load_run output read with the probe calibration table (None for raw readings) \n
+    returns {probe: reasons} and whether they are the run's own entry in the history taken with the same table
+    (only those are safe to leave probes out for). A run that is not in the history is checked against it
+    without being added, unless it was read with another table than the history: then there are no flags.
+    ({}, False) when there is no history.
+    '''
+    history = load_history(path)
+    if history is None:
+        return {}, False
+    same_table = table_version(table) == history.table_version
+    flags = history.lookup(entry['name'], file_hash(run['path']))
+    if flags is not None:
+        return flags, same_table
+    if not same_table:
+        return {}, False
+    return history.check(run_statistics(run, history.probes)), False
+
+
+if __name__ == '__main__':
+    history = build_history()
+    std = history.std()
+    for p, probe in enumerate(history.probes):
+        print(f"{probe}: bias {history.mean[0, p]:+.3f} +- {std[0, p]:.3f} C over {history.count[0, p]:.0f} runs, "
+              f"noise {history.mean[2, p]:.3f} C, EWMA bias {history.ewma[0, p]:+.3f} C")
+    for run in history.runs:
+        print(f"{run['start'][:16]} {run['name']}: {run['isothermal']} isothermal samples, "
+              + (', '.join(f'{probe} {reasons}' for probe, reasons in run['flags'].items()) or 'no flags'))
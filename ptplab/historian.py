@@ -0,0 +1,69 @@
+import numpy as np
+
+ENCODING = 'ISO-8859-1' # the historian writes the degree sign in latin-1
+START_TAG = 'P120_Flow' # AAH pump, switching it on is the start of the experiment
+START_THRESHOLD = 1 # ml/min
+
+def read_historian(path):
+    '''Reads a historian export (TagName;DateTime;Value;vValue;...) in one go. \n
+    path = path to the csv file \n
+    returns three arrays: tag names, time stamps (datetime64, whole seconds) and values. Rows with (null) are dropped.
+    '''
+    raw = np.loadtxt(path, delimiter=';', dtype=str, skiprows=1, usecols=(0, 1, 3), encoding=ENCODING, ndmin=2)
+    valid = raw[:, 2] != '(null)' # same as the scripts, nulls do weird things
+    raw = raw[valid]
+    tags = raw[:, 0]
+    times = raw[:, 1].astype('U19').astype('datetime64[s]') # drop the fractional seconds like split('.')[0] did
+    values = raw[:, 2].astype(float)
+    return tags, times, values
+
+def split_tags(tags, times, values):
+    '''Groups the rows of a historian export per instrument. \n
+    returns dictionary like {tag: (times, values)} with each series sorted in time
+    '''
+    names, inverse = np.unique(tags, return_inverse=True)
+    order = np.lexsort((times, inverse)) # sort by tag, then time
+    bounds = np.searchsorted(inverse[order], np.arange(len(names) + 1))
+    series = {}
+    for j, name in enumerate(names):
+        rows = order[bounds[j]:bounds[j + 1]]
+        series[str(name)] = (times[rows], values[rows])
+    return series
+
+def find_start_time(series, tag=START_TAG, threshold=START_THRESHOLD):
+    '''Finds the moment the AAH pump is switched on (flow goes from below to above the threshold). \n
+    series = output of split_tags \n
+    returns the time stamp or None if the pump never switches on in this file
+    '''
+    if tag not in series:
+        return None
+    times, flow = series[tag]
+    switched_on = np.flatnonzero((flow[:-1] < threshold) & (flow[1:] > threshold))
+    if len(switched_on) == 0:
+        return None
+    return times[switched_on[0] + 1]
+
+def load_run(path, tags=None, calibration=None):
+    '''Loads a historian export and puts every instrument on an elapsed time axis. \n
+    path = path to the csv file \n
+    tags = list of instruments to keep (default keeps all of them) \n
+    calibration = probe calibration table (probes.load_table()) applied to the values, default raw values \n
+    returns dictionary with 'path', 'start_time', 'start_detected' and 'tags' = {tag: {'elapsed_time': minutes, 'values': array}}.
+    If the pump is never switched on in the file the first time stamp is used as start.
+    '''
+    series = split_tags(*read_historian(path))
+    start_time = find_start_time(series)
+    start_detected = start_time is not None
+    if not start_detected:
+        start_time = min(times[0] for times, _ in series.values())
+
+    run = {'path': path, 'start_time': start_time, 'start_detected': start_detected, 'tags': {}}
+    for tag, (times, values) in series.items():
+        if tags is not None and tag not in tags:
+            continue
+        elapsed_time = (times - start_time) / np.timedelta64(1, 's') / 60 # minutes like the plots
+        run['tags'][tag] = {'elapsed_time': elapsed_time, 'values': values}
+    if calibration is not None:
+        from ptplab.probes import apply_table
+        apply_table(run['tags'], calibration)
+    return run
@@ -0,0 +1,167 @@
+'''Opt-in instrumentation of the model solves. \n
+Every solve in models.py goes through models.solve. While a recorder is active that call is timed and
+its solver statistics are kept: function evaluations, jacobian evaluations, LU decompositions, accepted
+and rejected steps, the wall time spent in the right hand side versus the solver itself and a hash of
+the parameters, so slow solves across many runs can be traced back to the settings that caused them. \n
+    with record() as recorder:
+        PBR_model(40, 26.8, 4.1, n=50)
+    recorder.to_csv('solves.csv') \n
+Only solves in the current process are recorded, the worker processes of the fits and the surrogate
+tables keep their own (inactive) state. Without an active recorder models.solve calls solve_ivp directly.
+'''
+import csv
+import json
+import time
+from contextlib import contextmanager
+import numpy as np
+
+FIELDS = ['function', 'params_hash', 'method', 'n_states', 't0', 't1', 'rtol', 'atol', 'nfev', 'njev', 'nlu',
+          'accepted_steps', 'rejected_steps', 'wall_time', 'rhs_time', 'solver_time', 'success', 'message']
+
+_recorders = [] # active recorders, innermost last
+
+def active():
+    '''True when at least one recorder is listening'''
+    return bool(_recorders)
+
+class SolveRecorder:
+    '''Collects one record (dictionary with FIELDS) per solve while it is active, see record()'''
+    def __init__(self):
+        self.records = []
+
+    def add(self, entry):
+        self.records.append(entry)
+
+    def summary(self):
+        '''Totals per right hand side function: solves, nfev, njev, nlu, steps and times'''
+        totals = {}
+        for entry in self.records:
+            total = totals.setdefault(entry['function'], {'solves': 0, 'failed': 0, 'nfev': 0, 'njev': 0, 'nlu': 0,
+                                                          'accepted_steps': 0, 'rejected_steps': 0,
+                                                          'wall_time': 0.0, 'rhs_time': 0.0, 'solver_time': 0.0})
+            total['solves'] += 1
+            total['failed'] += not entry['success']
+            for key in ('nfev', 'njev', 'nlu', 'accepted_steps', 'rejected_steps', 'wall_time', 'rhs_time', 'solver_time'):
+                total[key] += entry[key] or 0 # rejected_steps is None for the implicit methods
+        return totals
+
+    def to_json(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.records, file, indent=1)
+
+    def to_csv(self, path):
+        with open(path, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+@contextmanager
+def record(recorder=None):
+    '''Records every model solve inside the with block. Recorders can be nested, an outer one also
+    gets the solves of the inner blocks. \n
+    recorder = SolveRecorder to add to (default a new one) \n
+    yields the recorder
+    '''
+    if recorder is None:
+        recorder = SolveRecorder()
+    _recorders.append(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorders.remove(recorder)
+
+def parameter_hash(fun, y0, tspan, args, method, options):
+    '''Short hash of everything that decides the outcome of a solve'''
+    import hashlib
+    def plain(value):
+        if isinstance(value, dict):
+            return {key: plain(value[key]) for key in sorted(value)}
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [plain(item) for item in np.asarray(value, dtype=object).ravel()]
+        if isinstance(value, (float, np.floating)):
+            return repr(float(value))
+        return value if isinstance(value, (int, str, bool, type(None))) else repr(value)
+
+    content = [getattr(fun, '__name__', repr(fun)), plain(y0), plain(tspan), plain(args), plain(method), plain(options)]
+    return hashlib.sha1(json.dumps(content).encode()).hexdigest()[:12]
+
+def _counting_method(method):
+    '''Subclass of the solver that counts accepted steps, and for explicit Runge-Kutta methods the rejected
+    ones (every attempt costs n_stages function evaluations, the ones beyond the first attempt were rejected)'''
+    import scipy.integrate
+    base = getattr(scipy.integrate, method) if isinstance(method, str) else method
+    if not (isinstance(base, type) and issubclass(base, scipy.integrate.OdeSolver)):
+        raise ValueError(f'Unknown method {method!r}')
+    explicit = issubclass(base, (scipy.integrate.RK23, scipy.integrate.RK45, scipy.integrate.DOP853))
+
+    class Counting(base):
+        accepted = 0
+        attempts = 0
+        is_explicit_rk = explicit
+
+        def step(self):
+            nfev = self.nfev
+            message = super().step()
+            if self.status != 'failed':
+                Counting.accepted += 1
+            if explicit:
+                Counting.attempts += (self.nfev - nfev)//self.n_stages
+            return message
+
+    return Counting
+
+def instrumented_solve(fun, tspan, y0, args=(), t_eval=None, method='RK45', **options):
+    '''solve_ivp with the statistics sent to the active recorders, called by models.solve'''
+    from scipy.integrate import solve_ivp
+    rhs_time = [0.0]
+
+    def timed_fun(t, y, *args):
+        start = time.perf_counter()
+        try:
+            return fun(t, y, *args)
+        finally:
+            rhs_time[0] += time.perf_counter() - start
+
+    counting = _counting_method(method)
+    start = time.perf_counter()
+    sol = solve_ivp(timed_fun, tspan, y0, method=counting, t_eval=t_eval, args=args, **options)
+    wall_time = time.perf_counter() - start
+
+    entry = {
+        'function': getattr(fun, '__name__', repr(fun)),
+        'params_hash': parameter_hash(fun, y0, tspan, args, method, options),
+        'method': method if isinstance(method, str) else method.__name__,
+        'n_states': len(y0),
+        't0': float(tspan[0]),
+        't1': float(tspan[1]),
+        'rtol': options.get('rtol', 1e-3),
+        'atol': options.get('atol', 1e-6),
+        'nfev': int(sol.nfev),
+        'njev': int(sol.njev),
+        'nlu': int(sol.nlu),
+        'accepted_steps': counting.accepted,
+        'rejected_steps': counting.attempts - counting.accepted if counting.is_explicit_rk else None,
+        'wall_time': wall_time,
+        'rhs_time': rhs_time[0],
+        'solver_time': wall_time - rhs_time[0],
+        'success': bool(sol.success),
+        'message': sol.message,
+    }
+    for recorder in _recorders:
+        recorder.add(entry)
+    return sol
+
+
+if __name__ == '__main__':
+    from ptplab import instrumentation # the module models.py reports to, not this __main__ copy
+    from ptplab.models import PBR_model
+
+    with instrumentation.record() as recorder:
+        for n in (6, 20, 50):
+            for method in ('RK45', 'LSODA', 'BDF'):
+                PBR_model(40, 26.8, 4.1, n=n, method=method)
+    print(f"{'n':>4} {'method':>6} {'nfev':>7} {'njev':>5} {'nlu':>5} {'steps':>6} {'rejected':>8} {'rhs s':>7} {'solver s':>8}")
+    for entry in recorder.records:
+        rejected = '-' if entry['rejected_steps'] is None else entry['rejected_steps']
+        print(f"{entry['n_states']//5:4d} {entry['method']:>6} {entry['nfev']:7d} {entry['njev']:5d} {entry['nlu']:5d} "
+              f"{entry['accepted_steps']:6d} {rejected:>8} {entry['rhs_time']:7.3f} {entry['solver_time']:8.3f}")
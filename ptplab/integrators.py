@@ -0,0 +1,415 @@
+'''The fixed step integrator from Numerical Methods (master_function, as in pbr_test.py) and an ensemble
+version of it that integrates M initial conditions or parameter sets at once. master_function also has adaptive
+modes (embedded Dormand-Prince and Bogacki-Shampine pairs with step size control and dense output) and
+implicit modes for stiff runs (backward Euler, BDF2, SDIRK) that solve every step with Newton iterations on a
+dense, banded or sparse jacobian. \n
+The ensemble works on a state of shape (M, d). The right hand side writes into a buffer instead of returning
+a new array, and all stage buffers are allocated once before the step loop, so a step allocates nothing.
+models.py has ensemble versions of the CSTR and PBR equations in this form.
+'''
+import numpy as np
+
+METHODS = ('euler', 'midpoint', 'rk2', 'rk4')
+ADAPTIVE_METHODS = ('dopri5', 'bs23')
+IMPLICIT_METHODS = ('backward_euler', 'bdf2', 'sdirk')
+SDIRK_GAMMA = 1 - 1/np.sqrt(2) # two stage, second order, L-stable SDIRK (Alexander 1977)
+MAX_NEWTON = 10
+
+# Butcher tableaus of the embedded pairs: c, a, b (the solution), e (b minus the embedded weights, last entry for
+# the first same as last stage), p (dense output polynomial) and the order of the error estimate.
+TABLEAUS = {
+    'dopri5': {
+        'c': np.array([0, 1/5, 3/10, 4/5, 8/9, 1]),
+        'a': np.array([
+            [0, 0, 0, 0, 0],
+            [1/5, 0, 0, 0, 0],
+            [3/40, 9/40, 0, 0, 0],
+            [44/45, -56/15, 32/9, 0, 0],
+            [19372/6561, -25360/2187, 64448/6561, -212/729, 0],
+            [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]]),
+        'b': np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]),
+        'e': np.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40]),
+        'p': np.array([
+            [1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+            [0, 0, 0, 0],
+            [0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+            [0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+            [0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+            [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+            [0, 40617522/29380423, -110615467/29380423, 69997945/29380423]]),
+        'error_order': 4,
+    },
+    'bs23': {
+        'c': np.array([0, 1/2, 3/4]),
+        'a': np.array([
+            [0, 0],
+            [1/2, 0],
+            [0, 3/4]]),
+        'b': np.array([2/9, 1/3, 4/9]),
+        'e': np.array([5/72, -1/12, -1/9, 1/8]),
+        'p': np.array([
+            [1, -4/3, 5/9],
+            [0, 1, -2/3],
+            [0, 4/3, -8/9],
+            [0, -1, 1]]),
+        'error_order': 2,
+    },
+}
+SAFETY = 0.9 # step size controller, same values as solve_ivp
+MIN_FACTOR = 0.2
+MAX_FACTOR = 10
+
+def master_function(fun, tspan, y0, method='rk4', number_of_points=100, t_eval=None, rtol=1e-3, atol=1e-6, max_step=np.inf, jac=None, band=None):
+    '''General function to solve system of differential equations. Does not work on single differential equations. \n
+    fun = function
+    y0 = vector of initial conditions
+    optional:\n
+    method = You can select the method with which your system of differential equations will be evaluated. Default set to fourth order Runge-Kutta. \n
+    Supported methods : midpoint method ('midpoint'), euler method ('euler'), Classical second order Runge-Kutta ('rk2'), classical fourth order Runge-Kutta ('rk4').
+    number_of_points = how many steps. Default set to 100. Increasing this reduces error but increases computation time. \n
+    Adaptive methods: Dormand-Prince 5(4) ('dopri5') and Bogacki-Shampine 3(2) ('bs23') pick their own steps from
+    rtol and atol (same meaning as in solve_ivp) and max_step. The solution is given at t_eval, or else at
+    number_of_points+1 evenly spaced times, from the dense output of the method. \n
+    Implicit methods for stiff systems: backward Euler ('backward_euler'), BDF2 ('bdf2') and SDIRK ('sdirk'), with
+    number_of_points fixed steps like the explicit ones. jac = function jac(t, y) giving the jacobian (array or
+    scipy.sparse matrix), by default it is done with finite differences. band = (lower, upper) bandwidth of the
+    jacobian (models.PBR_BAND for the PBR), then the finite differences and the Newton solves are banded. '''
+    if method in ADAPTIVE_METHODS:
+        if t_eval is None:
+            t_eval = np.linspace(tspan[0], tspan[1], number_of_points+1)
+        t, y, _ = embedded_rk(fun, tspan, y0, method=method, t_eval=t_eval, rtol=rtol, atol=atol, max_step=max_step)
+        return t, y
+    if method in IMPLICIT_METHODS:
+        t, y, _ = implicit_fixed_step(fun, tspan, y0, method=method, number_of_points=number_of_points, jac=jac, band=band, rtol=rtol, atol=atol)
+        return t, y
+    dt = (tspan[1] - tspan[0])/number_of_points
+    t = np.linspace(tspan[0], tspan[1], number_of_points+1)
+    y = np.zeros((number_of_points+1, len(y0))) # len(y0) because you would need an initial condition for each derivative.
+    y[0, :] = y0
+    if method == 'midpoint':
+        for i in range(number_of_points):
+            k1 = fun(t[i], y[i,:])
+            k2 = fun(t[i] + dt*0.5, y[i,:] + 0.5*dt*k1)
+            y[i+1,:] = y[i,:] + dt * k2
+    elif method == 'euler':
+        for i in range(number_of_points):
+            y[i+1,:] = y[i,:] + dt * fun(t[i], y[i,:])
+    elif method == 'rk2':
+        for i in range(number_of_points):
+            k1 = fun(t[i], y[i,:])
+            k2 = fun(t[i] + dt, y[i] + dt*k1)
+            y[i+1,:] = y[i] + dt*0.5*(k1+k2)
+    elif method == 'rk4':
+        for i in range(number_of_points):
+            k1 = fun(t[i], y[i,:])
+            k2 = fun(t[i] + dt*0.5, y[i,:] + 0.5*dt*k1)
+            k3 = fun(t[i] + dt*0.5, y[i,:] + 0.5*dt*k2)
+            k4 = fun(t[i] +dt, y[i,:] + dt*k3)
+            y[i+1,:] = y[i] + dt*((1/6)*k1 + (1/3)*(k2+k3) + (1/6)*k4)
+    else:
+        return 'Unknown method specified. Check documentation for supported methods' # In case an unknown method is specified
+    return t, y
+
+def _rms(x):
+    return np.sqrt(np.mean(x**2))
+
+def initial_step(fun, t0, y0, f0, error_order, rtol, atol):
+    '''Starting step size, Hairer, Norsett and Wanner (1993) section II.4'''
+    scale = atol + np.abs(y0)*rtol
+    d0, d1 = _rms(y0/scale), _rms(f0/scale)
+    h0 = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01*d0/d1
+    f1 = fun(t0 + h0, y0 + h0*f0)
+    d2 = _rms((f1 - f0)/scale)/h0
+    if max(d1, d2) <= 1e-15:
+        h1 = max(1e-6, h0*1e-3)
+    else:
+        h1 = (0.01/max(d1, d2))**(1/(error_order + 1))
+    return min(100*h0, h1)
+
+def embedded_rk(fun, tspan, y0, method='dopri5', t_eval=None, rtol=1e-3, atol=1e-6, max_step=np.inf, first_step=None):
+    '''Adaptive explicit Runge-Kutta with an embedded error estimate and dense output. \n
+    fun = function fun(t, y) returning dy/dt \n
+    tspan = [t_start, t_end] \n
+    y0 = initial conditions \n
+    method = 'dopri5' (Dormand-Prince 5(4)) or 'bs23' (Bogacki-Shampine 3(2)) \n
+    t_eval = times to give the solution at (default the accepted steps) \n
+    rtol, atol = tolerances, a step is accepted when the rms of error/(atol + rtol*|y|) is below 1 \n
+    returns t, y with shape (len(t), len(y0)), and dictionary with nfev, accepted and rejected steps
+    '''
+    tableau = TABLEAUS[method]
+    c, a, b, e, p = tableau['c'], tableau['a'], tableau['b'], tableau['e'], tableau['p']
+    exponent = -1/(tableau['error_order'] + 1)
+    t0, t_end = float(tspan[0]), float(tspan[1])
+    y = np.array(y0, dtype=float)
+    if t_eval is not None:
+        t_eval = np.asarray(t_eval, dtype=float)
+        if np.any(np.diff(t_eval) < 0) or (len(t_eval) and (t_eval[0] < t0 or t_eval[-1] > t_end)):
+            raise ValueError('t_eval has to be sorted and inside tspan')
+
+    f = np.asarray(fun(t0, y), dtype=float)
+    nfev = 1
+    if first_step is None:
+        h = initial_step(fun, t0, y, f, tableau['error_order'], rtol, atol)
+        nfev += 1
+    else:
+        h = first_step
+    K = np.empty((len(b) + 1, len(y)))
+    ts, ys = [t0], [y.copy()]
+    next_eval = 0 # index of the first t_eval point not given yet
+    if t_eval is not None:
+        out = np.empty((len(t_eval), len(y)))
+        while next_eval < len(t_eval) and t_eval[next_eval] == t0:
+            out[next_eval] = y
+            next_eval += 1
+    accepted = rejected = 0
+    t = t0
+    while t < t_end:
+        min_step = 10*np.spacing(t)
+        h = min(max(h, min_step), max_step)
+        step_rejected = False
+        while True:
+            if h < min_step:
+                raise RuntimeError(f'Step size became too small at t = {t}, the problem may be stiff')
+            # like solve_ivp the step that would pass t_end ends on it exactly, even when t is only rounding
+            # off short of it (steps of max_step add up to 1 ulp below t_end)
+            t_new = min(t + h, t_end)
+            h = t_new - t
+            K[0] = f
+            for s in range(1, len(b)):
+                K[s] = fun(t + c[s]*h, y + h*(a[s, :s] @ K[:s]))
+            y_new = y + h*(b @ K[:-1])
+            f_new = np.asarray(fun(t + h, y_new), dtype=float)
+            K[-1] = f_new
+            nfev += len(b)
+            scale = atol + np.maximum(np.abs(y), np.abs(y_new))*rtol
+            error = _rms(h*(e @ K)/scale)
+            if error < 1:
+                break
+            h *= max(MIN_FACTOR, SAFETY*error**exponent)
+            rejected += 1
+            step_rejected = True
+
+        if t_eval is None:
+            ts.append(t_new)
+            ys.append(y_new.copy())
+        else:
+            stop = np.searchsorted(t_eval, t_new, side='right')
+            if stop > next_eval: # dense output for the t_eval points in this step
+                theta = (t_eval[next_eval:stop] - t)/h
+                powers = np.cumprod(np.repeat(theta[:, None], p.shape[1], axis=1), axis=1)
+                out[next_eval:stop] = y + h*(powers @ (K.T @ p).T)
+                next_eval = stop
+        accepted += 1
+        factor = MAX_FACTOR if error == 0 else min(MAX_FACTOR, SAFETY*error**exponent)
+        if step_rejected:
+            factor = min(1, factor)
+        t, y, f = t_new, y_new, f_new
+        h *= factor
+
+    stats = {'nfev': nfev, 'accepted': accepted, 'rejected': rejected}
+    if t_eval is None:
+        return np.array(ts), np.array(ys), stats
+    return t_eval, out, stats
+
+def fd_jacobian(fun, t, y, f0, band=None):
+    '''Forward difference jacobian of fun at (t, y), f0 = fun(t, y). \n
+    band = (lower, upper): columns further apart than the band width are perturbed together, so a banded
+    jacobian costs lower + upper + 1 evaluations whatever the size of y. The result is then in the
+    (lower + upper + 1, len(y)) storage of scipy.linalg.solve_banded. \n
+    returns the jacobian and the number of function evaluations
+    '''
+    d = len(y)
+    step = np.sqrt(np.finfo(float).eps)*np.maximum(np.abs(y), 1e-8)
+    if band is None:
+        J = np.empty((d, d))
+        for j in range(d):
+            y_step = y.copy()
+            y_step[j] += step[j]
+            J[:, j] = (fun(t, y_step) - f0)/step[j]
+        return J, d
+
+    lower, upper = band
+    width = lower + upper + 1
+    ab = np.zeros((width, d))
+    columns = np.arange(d)
+    for group in range(min(width, d)):
+        cols = columns[group::width]
+        y_step = y.copy()
+        y_step[cols] += step[cols]
+        df = fun(t, y_step) - f0
+        for k in range(-upper, lower + 1): # row i = column j + k lands on ab[upper + k, j]
+            rows = cols + k
+            valid = (rows >= 0) & (rows < d)
+            ab[upper + k, cols[valid]] = df[rows[valid]]/step[cols[valid]]
+    return ab, min(width, d)
+
+class NewtonMatrix:
+    '''Factorization of I - gamma*h*J for the Newton iterations of the implicit methods. J can be dense,
+    banded (solve_banded storage, band = (lower, upper)) or a scipy.sparse matrix.'''
+    def __init__(self, J, gamma_h, band=None):
+        from scipy.linalg import lu_factor
+        self.band = band
+        if band is not None:
+            self.ab = -gamma_h*J
+            self.ab[band[1]] += 1 # the diagonal
+        elif hasattr(J, 'tocsc'): # scipy.sparse
+            from scipy.sparse import identity
+            from scipy.sparse.linalg import splu
+            self.lu = splu((identity(J.shape[0], format='csc') - gamma_h*J).tocsc())
+        else:
+            self.lu = lu_factor(np.eye(len(J)) - gamma_h*J)
+
+    def solve(self, rhs):
+        from scipy.linalg import lu_solve, solve_banded
+        if self.band is not None:
+            return solve_banded(self.band, self.ab, rhs)
+        if hasattr(self.lu, 'solve'):
+            return self.lu.solve(rhs)
+        return lu_solve(self.lu, rhs)
+
+def implicit_fixed_step(fun, tspan, y0, method='bdf2', number_of_points=100, jac=None, band=None, rtol=1e-3, atol=1e-6):
+    '''Fixed step implicit integration for stiff systems. \n
+    fun = function fun(t, y) returning dy/dt \n
+    method = 'backward_euler' (order 1), 'bdf2' (order 2, starts with one backward Euler step) or
+    'sdirk' (two stage L-stable SDIRK, order 2) \n
+    number_of_points = number of steps \n
+    jac = function jac(t, y) returning the jacobian, dense or scipy.sparse (default finite differences) \n
+    band = (lower, upper) bandwidth of the jacobian, used for the finite differences and the Newton solves.
+    A supplied jac has to be in solve_banded storage when band is given. \n
+    rtol, atol = the Newton iterations stop when the rms of the update over atol + rtol*|y| is below
+    the same tolerance solve_ivp's BDF uses \n
+    The jacobian is evaluated once per step (simplified Newton). When the iterations do not converge it is
+    evaluated again at the last iterate, if that does not help either a RuntimeError is raised. \n
+    returns t, y with shape (number_of_points+1, len(y0)) and dictionary with nfev, njev and newton iterations
+    '''
+    if method not in IMPLICIT_METHODS:
+        raise ValueError(f'Unknown method {method!r}, use one of {IMPLICIT_METHODS}')
+    dt = (tspan[1] - tspan[0])/number_of_points
+    t = np.linspace(tspan[0], tspan[1], number_of_points+1)
+    y = np.zeros((number_of_points+1, len(y0)))
+    y[0] = y0
+    newton_tol = max(10*np.finfo(float).eps/rtol, min(0.03, rtol**0.5))
+    stats = {'nfev': 0, 'njev': 0, 'newton': 0}
+
+    def f(ti, yi):
+        stats['nfev'] += 1
+        return np.asarray(fun(ti, yi), dtype=float)
+
+    def jacobian(ti, yi, fi):
+        stats['njev'] += 1
+        if jac is not None:
+            return jac(ti, yi)
+        J, nfev = fd_jacobian(fun, ti, yi, fi, band=band)
+        stats['nfev'] += nfev
+        return J
+
+    def newton(t_new, known, gamma_h, guess, step):
+        '''Solves Y = known + gamma_h*fun(t_new, Y) starting from guess. step holds the jacobian of this step
+        and its factorization, which is reused by the stages with the same gamma_h.'''
+        for attempt in (0, 1):
+            if step.get('gamma_h') != gamma_h:
+                step['matrix'] = NewtonMatrix(step['J'], gamma_h, band=band)
+                step['gamma_h'] = gamma_h
+            Y = guess.copy()
+            for _ in range(MAX_NEWTON):
+                stats['newton'] += 1
+                delta = step['matrix'].solve(known + gamma_h*f(t_new, Y) - Y)
+                Y += delta
+                if _rms(delta/(atol + rtol*np.abs(Y))) < newton_tol:
+                    return Y, f(t_new, Y)
+            # jacobian too far off, try once more with a fresh one
+            step['J'] = jacobian(t_new, Y, f(t_new, Y))
+            step['gamma_h'] = None
+        raise RuntimeError(f'Newton iterations did not converge at t = {t_new}, use more points')
+
+    f_n = f(t[0], y[0])
+    for i in range(number_of_points):
+        step = {'J': jacobian(t[i], y[i], f_n)}
+        guess = y[i] + dt*f_n # explicit Euler predictor
+        if method == 'backward_euler' or (method == 'bdf2' and i == 0):
+            y[i+1], f_n = newton(t[i+1], y[i], dt, guess, step)
+        elif method == 'bdf2':
+            y[i+1], f_n = newton(t[i+1], (4*y[i] - y[i-1])/3, 2*dt/3, guess, step)
+        else: # sdirk, the second stage is the new state (stiffly accurate)
+            gamma = SDIRK_GAMMA
+            Y1, f_1 = newton(t[i] + gamma*dt, y[i], gamma*dt, y[i] + gamma*dt*f_n, step)
+            y[i+1], f_n = newton(t[i+1], y[i] + (1 - gamma)*dt*f_1, gamma*dt, guess, step)
+    return t, y, stats
+
+def buffered(fun):
+    '''Turns a right hand side that returns its derivatives (and broadcasts over the rows of the state) into the
+    out= form ensemble_master_function wants. Handy for trying things, but the returned array is allocated every call.'''
+    def rhs(t, y, *args):
+        *args, out = args
+        out[...] = fun(t, y, *args)
+    return rhs
+
+def ensemble_master_function(fun, tspan, y0, method='rk4', number_of_points=100, args=(), save_every=1, out=None):
+    '''master_function for a batch of M systems at once. \n
+    fun = right hand side fun(t, y, *args, out) that writes dy/dt of the (M, d) state y into out \n
+    tspan = [t_start, t_end] \n
+    y0 = initial conditions, shape (M, d) \n
+    method = 'euler', 'midpoint', 'rk2' or 'rk4' \n
+    number_of_points = number of steps \n
+    args = extra arguments for fun (for example the parameter dictionary) \n
+    save_every = only keep every save_every-th step, must divide number_of_points (long runs of big ensembles
+    do not fit in memory otherwise) \n
+    out = preallocated (number_of_points//save_every + 1, M, d) array for the solution (default a new one) \n
+    returns t and y with y[i] the (M, d) state at t[i]
+    '''
+    if method not in METHODS:
+        raise ValueError(f'Unknown method {method!r}, use one of {METHODS}')
+    if number_of_points % save_every:
+        raise ValueError('save_every has to divide number_of_points')
+    y0 = np.asarray(y0, dtype=float)
+    n_saved = number_of_points//save_every + 1
+    if out is None:
+        out = np.empty((n_saved,) + y0.shape)
+    elif out.shape != (n_saved,) + y0.shape:
+        raise ValueError(f'out has shape {out.shape}, expected {(n_saved,) + y0.shape}')
+
+    dt = (tspan[1] - tspan[0])/number_of_points
+    t = np.linspace(tspan[0], tspan[1], n_saved)
+    y = y0.copy()
+    trial = np.empty_like(y) # state at which a stage is evaluated
+    k = np.empty((4,) + y.shape) # stage derivatives
+    out[0] = y
+
+    for i in range(number_of_points):
+        ti = tspan[0] + i*dt
+        fun(ti, y, *args, k[0])
+        if method == 'euler':
+            k[0] *= dt
+            y += k[0]
+        elif method == 'midpoint':
+            np.multiply(k[0], 0.5*dt, out=trial)
+            trial += y
+            fun(ti + 0.5*dt, trial, *args, k[1])
+            k[1] *= dt
+            y += k[1]
+        elif method == 'rk2':
+            np.multiply(k[0], dt, out=trial)
+            trial += y
+            fun(ti + dt, trial, *args, k[1])
+            k[0] += k[1]
+            k[0] *= 0.5*dt
+            y += k[0]
+        else: # rk4
+            np.multiply(k[0], 0.5*dt, out=trial)
+            trial += y
+            fun(ti + 0.5*dt, trial, *args, k[1])
+            np.multiply(k[1], 0.5*dt, out=trial)
+            trial += y
+            fun(ti + 0.5*dt, trial, *args, k[2])
+            np.multiply(k[2], dt, out=trial)
+            trial += y
+            fun(ti + dt, trial, *args, k[3])
+            k[1] += k[2]
+            k[1] *= 2
+            k[0] += k[1]
+            k[0] += k[3]
+            k[0] *= dt/6
+            y += k[0]
+        if (i + 1) % save_every == 0:
+            out[(i + 1)//save_every] = y
+    return t, out
@@ -0,0 +1,276 @@
+'''Extended Kalman filter soft sensor for the PBR: live tank concentrations, bead temperatures and conversion. \n
+During a run only T201_PV..T208_PV and the outlet conductivity QT210_PV are measured. The filter uses the
+tanks in series model (models.pbr_der_func) as process model and corrects it with every historian sample. \n
+Predict: one linearly implicit Euler step x += dt (I - dt J)^-1 f(x) per substep, J is the analytic banded
+jacobian (models.pbr_jacobian) so the step stays stable at the 15 s sample interval. The covariance goes
+through the same matrix, P = A^-1 P A^-T + Q dt with A = I - dt J. \n
+Update: the probes and the conductivity each see one state (a tank temperature, the acetic acid of the last
+tank after the calibration curve turns conductivity into concentration), so they are applied one at a time
+as scalar updates without any matrix inverse. \n
+The covariance is tapered with a Gaspari-Cohn function of the distance between tanks, so only the blocks of
+tanks closer than 2*taper are ever nonzero and only those are stored: block rows of shape (n, 5, 5*width),
+width = the tanks on either side within the taper and the tank itself. A couples every tank only to itself
+and the tank upstream (the flow), so A^-1 P A^-T is two sweeps down the tanks, one 5x5 solve per tank, and
+whatever reaches further than the stored band is left out. A predict and a sample cost O(n).
+'''
+import numpy as np
+
+from ptplab.calibration import TEMPERATURE_TAGS
+from ptplab.models import PBR_BAND, PBR_PROBES, inlet_concentrations, pbr_der_func, pbr_initial_state, pbr_jacobian, pbr_params, probe_tank
+
+CONDUCTIVITY_TAG = 'QT210_PV'
+# Standard deviations. Process noise per state of a tank [c_water, c_AAH, c_AA (mol/ml), T, T glass (K)] per sqrt(second)
+PROCESS_NOISE = [2e-6, 2e-6, 4e-6, 0.01, 0.005]
+INITIAL_STD = [1e-4, 1e-5, 1e-5, 0.2, 0.2]
+TEMPERATURE_NOISE = 0.1 # K, the probes read in steps of 0.1 C
+CONCENTRATION_NOISE = 0.02 # mol/L after the calibration curve
+TAPER = 2 # tanks, half width of the Gaspari-Cohn taper (correlations vanish beyond 2*TAPER tanks)
+
+def gaspari_cohn(r):
+    '''Gaspari-Cohn fifth order compactly supported correlation function, 1 at r = 0 and 0 for r >= 2'''
+    r = np.abs(np.asarray(r, dtype=float))
+    taper = np.zeros_like(r)
+    near = r <= 1
+    far = (r > 1) & (r < 2)
+    x = r[near]
+    taper[near] = -x**5/4 + x**4/2 + 5*x**3/8 - 5*x**2/3 + 1
+    x = r[far]
+    taper[far] = x**5/12 - x**4/2 + 5*x**3/8 + 5*x**2/3 - 5*x + 4 - 2/(3*x)
+    return taper
+
+class PBRKalmanFilter:
+    '''Streaming EKF over the states [c_water, c_AAH, c_AA, T, T glass] of the n tanks. \n
+    T = inlet temperature (C), fv1, fv2 = water and anhydride flow (ml/min), V, n, kinetics as in PBR_model \n
+    taper = half width of the covariance taper in tanks, None keeps the full covariance \n
+    calibration = calibration.ConductivityCalibration of QT210_PV (default the cached one of today) \n
+    compensate = convert the conductivity at the T208_PV reading of the same time stamp (calibration surface) \n
+    offsets = {probe: reading - true temperature} in K, subtracted from the probe readings \n
+    substeps = implicit Euler steps per predict, one step of 15 s is within 1e-5 K of solve_ivp
+    '''
+    def __init__(self, T, fv1, fv2, V=131, n=9, kinetics=None, taper=TAPER, calibration=None, offsets=None, substeps=1,
+                 compensate=False):
+        from scipy.linalg.lapack import dgbtrf, dgbtrs
+        self._gbtrf, self._gbtrs = dgbtrf, dgbtrs
+        if calibration is None:
+            from ptplab.calibration import conductivity_calibration
+            calibration = conductivity_calibration(CONDUCTIVITY_TAG)
+        self.calibration = calibration
+        self.compensate = compensate
+        self.n = n
+        self.params = pbr_params(T, fv1, fv2, V=V, n=n, kinetics=kinetics)
+        self.substeps = substeps
+        self.offsets = offsets or {}
+        self.t = 0.0
+        self.x = pbr_initial_state(T, n).astype(float)
+        # P[5a + r, 5(a + m) + c] is self.P_band[a, r, 5(m + h) + c] for the tanks m = -h..h away, h = self.half_width
+        self.half_width = n - 1 if taper is None else min(int(np.ceil(2*taper)) - 1, n - 1)
+        h = self.half_width
+        neighbour = np.arange(n)[:, None] + np.arange(-h, h + 1)[None, :]
+        inside = (neighbour >= 0) & (neighbour < n)
+        weight = np.ones(2*h + 1) if taper is None else gaspari_cohn(np.arange(-h, h + 1)/taper)
+        self.taper = np.repeat(np.where(inside, weight, 0), 5, axis=1)[:, None, :] # (n, 1, 5*width), 0 outside the reactor
+        self.P_band = np.zeros((n, 5, 5*(2*h + 1)))
+        self.P_band[:, range(5), 5*h + np.arange(5)] = np.array(INITIAL_STD)**2
+        self.q = np.tile(PROCESS_NOISE, n).reshape(n, 5)**2
+        self.probe_index = {probe: 3 + 5*probe_tank(i, n) for i, probe in enumerate(PBR_PROBES)}
+        self.outlet_index = 5*(n - 1) + 2
+
+    def set_inputs(self, T=None, fv1=None, fv2=None):
+        '''New inlet temperature or flows for the next predictions (step changes during a run)'''
+        if T is not None:
+            self.params['Inlet temperature'] = T + 273.15
+        if fv1 is not None or fv2 is not None:
+            fv1 = self.params['flow'][0]*60 if fv1 is None else fv1
+            fv2 = self.params['flow'][1]*60 if fv2 is None else fv2
+            self.params['C_in_water'], self.params['C_in_AAH'], self.params['flow'] = inlet_concentrations(fv1, fv2)
+
+    def predict(self, t):
+        '''Moves the estimate forward to time t (seconds)'''
+        dt = (t - self.t)/self.substeps
+        if dt <= 0:
+            return
+        lower, upper = PBR_BAND
+        d = len(self.x)
+        rows, cols = np.divmod(np.arange(25), 5) # states inside a tank
+        for _ in range(self.substeps):
+            J = pbr_jacobian(self.t, self.x, self.params, self.n)
+            # the state: LU of A = I - dt J in the (2 lower + upper + 1, d) storage of lapack gbtrf
+            A = np.zeros((2*lower + upper + 1, d))
+            A[lower:] = -dt*J
+            A[lower + upper] += 1
+            lu, piv, _ = self._gbtrf(A, lower, upper)
+            step, _ = self._gbtrs(lu, lower, upper, pbr_der_func(self.t, self.x, self.params, self.n), piv)
+            # the covariance: 5x5 blocks of A on the diagonal and of dt J from the tank upstream below it
+            diagonal = np.zeros((self.n, 25))
+            upstream = np.zeros((self.n, 25))
+            for k in range(-upper, lower + 1): # row - column of the entries J[upper + k] holds
+                within = rows - cols == k
+                diagonal[:, within] = -dt*J[upper + k, 5*np.arange(self.n)[:, None] + cols[within]]
+                across = rows - cols + 5 == k
+                upstream[1:, across] = dt*J[upper + k, 5*np.arange(self.n - 1)[:, None] + cols[across]]
+            diagonal = diagonal.reshape(self.n, 5, 5) + np.eye(5)
+            inverse = np.linalg.inv(diagonal)
+            upstream = upstream.reshape(self.n, 5, 5)
+            half = self._sweep(inverse, upstream, self.P_band) # A^-1 P
+            P = self._sweep(inverse, upstream, self._transpose(half)) # A^-1 (A^-1 P)^T = A^-1 P A^-T
+            self.P_band = (P + self._transpose(P))/2 # only symmetric up to the part left out
+            self.P_band[:, range(5), 5*self.half_width + np.arange(5)] += self.q*dt
+            self.x = self.x + dt*step
+            self.t += dt
+        self.P_band *= self.taper
+        self.t = t
+
+    def _sweep(self, inverse, upstream, B):
+        '''Block rows of A^-1 B for B in band storage, one tank after the other from the inlet: tank a is
+        (B_a + dt J_a,a-1 Y_a-1)/A_a,a. What the tank upstream has beyond the band is left out.'''
+        Y = np.empty_like(B)
+        previous = np.zeros(B.shape[1:])
+        for a in range(self.n):
+            shifted = np.zeros_like(previous) # the columns of tank a-1 moved onto the band of tank a
+            shifted[:, :-5] = previous[:, 5:]
+            Y[a] = inverse[a] @ (B[a] + upstream[a] @ shifted)
+            previous = Y[a]
+        return Y
+
+    def _transpose(self, B):
+        '''Band storage of the transpose of the matrix held in the band storage B'''
+        h = self.half_width
+        width = 2*h + 1
+        blocks = np.zeros((self.n + 2*h, 5, width, 5)) # padded with h empty tanks on either side
+        blocks[h:h + self.n] = B.reshape(self.n, 5, width, 5)
+        tank = np.arange(self.n)[:, None]
+        offset = np.arange(width)[None, :]
+        # the transpose holds P[5(a + m) + c, 5a + r], that is block row a + m at offset -m
+        swapped = blocks[tank + offset, :, width - 1 - offset, :] # (n, width, c, r)
+        return swapped.transpose(0, 3, 1, 2).reshape(B.shape)
+
+    def _scalar_update(self, index, z, variance):
+        '''Measurement z of state index with the given noise variance'''
+        h = self.half_width
+        tank, state = divmod(index, 5)
+        column = self.P_band[tank, state].copy() # P is symmetric, the row of index is its column
+        S = column[5*h + state] + variance
+        K = column/S
+        innovation = z - self.x[index]
+        first = 5*(tank - h)
+        lo, hi = max(first, 0), min(first + len(K), len(self.x))
+        self.x[lo:hi] += K[lo - first:hi - first]*innovation
+        # P -= K column^T on the tanks that are in both the band of the measured tank and the band of the row
+        for m in range(max(-h, -tank), min(h, self.n - 1 - tank) + 1):
+            start, stop = max(0, -m), min(2*h, 2*h - m) + 1
+            self.P_band[tank + m, :, 5*start:5*stop] -= np.outer(K[5*(m + h):5*(m + h + 1)], column[5*(start + m):5*(stop + m)])
+        return innovation
+
+    def covariance(self):
+        '''The covariance as a full (5n, 5n) matrix'''
+        h = self.half_width
+        d = len(self.x)
+        P = np.zeros((d, d + 10*h))
+        for a in range(self.n): # block row a holds the columns of tanks a-h..a+h, shifted by h tanks here
+            P[5*a:5*a + 5, 5*a:5*(a + 2*h + 1)] = self.P_band[a]
+        return P[:, 5*h:5*h + d]
+
+    def update(self, temperatures=None, conductivity=None):
+        '''Corrects the estimate with the samples of one time stamp. \n
+        temperatures = {probe: reading in C} for any of T201_PV..T208_PV \n
+        conductivity = QT210_PV reading in uS/cm \n
+        returns dictionary with the innovation of every measurement
+        '''
+        innovations = {}
+        for probe, value in (temperatures or {}).items():
+            z = value + 273.15 - self.offsets.get(probe, 0)
+            innovations[probe] = self._scalar_update(self.probe_index[probe], z, TEMPERATURE_NOISE**2)
+        if conductivity is not None:
+            T = (temperatures or {}).get(TEMPERATURE_TAGS[CONDUCTIVITY_TAG]) if self.compensate else None
+            z = float(self.calibration.concentration(conductivity, T))*1e-3 # mol/L -> mol/ml
+            innovations[CONDUCTIVITY_TAG] = self._scalar_update(self.outlet_index, z, (CONCENTRATION_NOISE*1e-3)**2)
+        return innovations
+
+    def step(self, t, temperatures=None, conductivity=None):
+        '''predict to t (seconds) and update with the samples at t, returns the estimate'''
+        self.predict(t)
+        self.update(temperatures, conductivity)
+        return self.estimate()
+
+    def estimate(self):
+        '''Current estimate: time (s), conversion of anhydride at the outlet (from the acetic acid, the state
+        the conductivity sees) with its standard deviation, the outlet acetic acid (mol/L) and per tank
+        concentrations and temperatures'''
+        states = self.x.reshape(self.n, 5)
+        c_in = 2*self.params['C_in_AAH'] # acetic acid at full conversion
+        return {
+            't': self.t,
+            'conversion': states[-1, 2]/c_in,
+            'conversion_std': np.sqrt(max(self.P_band[-1, 2, 5*self.half_width + 2], 0))/c_in,
+            'c_AA_out': states[-1, 2]*1e3,
+            'c_AAH': states[:, 1]*1e3,
+            'T': states[:, 3] - 273.15,
+            'T_glass': states[:, 4] - 273.15,
+        }
+
+def probe_offsets(run, T_in):
+    '''Reading of every probe before the start minus the inlet temperature (same baseline as load_catalog_run). \n
+    run = output of historian.load_run
+    '''
+    offsets = {}
+    for probe in PBR_PROBES:
+        series = run['tags'][probe]
+        before = series['elapsed_time'] <= 0
+        baseline = np.mean(series['values'][before]) if np.any(before) else series['values'][0]
+        offsets[probe] = baseline - T_in
+    return offsets
+
+def aligned_readings(run, tags, times):
+    '''Reading of every tag at each of times (minutes): its latest sample at or before that time, since the
+    historian logs on change and a tag can miss a time stamp. NaN before the first sample and for missing tags. \n
+    returns array (len(tags), len(times))
+    '''
+    readings = np.full((len(tags), len(times)), np.nan)
+    for i, tag in enumerate(tags):
+        if tag not in run['tags']:
+            continue
+        series = run['tags'][tag]
+        index = np.searchsorted(series['elapsed_time'], times, side='right') - 1
+        readings[i, index >= 0] = series['values'][index[index >= 0]]
+    return readings
+
+def replay(entry, n=None, kinetics=None, **options):
+    '''Runs the filter over a recorded PBR run sample by sample, like it would run live. \n
+    entry = catalog entry of a PBR run \n
+    The flows and inlet temperature are taken like load_catalog_run does, the probe offsets are the readings
+    before the start minus the inlet temperature. Other keyword arguments go to PBRKalmanFilter. \n
+    returns dictionary of arrays: 't' (min), 'conversion', 'conversion_std', 'c_AA_out', 'T' (n tanks per row)
+    and 'latency' (seconds per sample)
+    '''
+    import time
+    from ptplab.calibration import conductivity_calibration
+    from ptplab.catalog import load_catalog_run, run_path
+    from ptplab.historian import load_run
+    from ptplab.probes import load_table
+    prepared = load_catalog_run(entry)
+    run = load_run(run_path(entry), tags=PBR_PROBES + [CONDUCTIVITY_TAG], calibration=load_table())
+    options.setdefault('calibration', conductivity_calibration(CONDUCTIVITY_TAG, run['start_time']))
+    ekf = PBRKalmanFilter(prepared['T_in'], prepared['fv_water'], prepared['fv_aah'], V=entry['V'], n=n or entry['n'],
+                          kinetics=kinetics, offsets=probe_offsets(run, prepared['T_in']), **options)
+
+    # one filter step per conductivity sample after the start, with the probes as they read at that time
+    times = run['tags'][CONDUCTIVITY_TAG]['elapsed_time']
+    readings = aligned_readings(run, PBR_PROBES, times)
+    history = {'t': [], 'conversion': [], 'conversion_std': [], 'c_AA_out': [], 'T': [], 'latency': []}
+    for j in np.flatnonzero(times >= 0):
+        temperatures = {probe: readings[p, j] for p, probe in enumerate(PBR_PROBES) if np.isfinite(readings[p, j])}
+        start = time.perf_counter()
+        estimate = ekf.step(times[j]*60, temperatures, run['tags'][CONDUCTIVITY_TAG]['values'][j])
+        history['latency'].append(time.perf_counter() - start)
+        history['t'].append(times[j])
+        for key in ('conversion', 'conversion_std', 'c_AA_out', 'T'):
+            history[key].append(estimate[key])
+    return {key: np.array(value) for key, value in history.items()}
+
+
+if __name__ == '__main__':
+    from ptplab.catalog import get_run
+    history = replay(get_run('PBR 40c'))
+    print(f"{len(history['t'])} samples, median latency {np.median(history['latency'])*1e3:.3f} ms, "
+          f"max {np.max(history['latency'])*1e3:.3f} ms")
+    print(f"conversion at the end {history['conversion'][-1]:.3f} +- {history['conversion_std'][-1]:.3f}")
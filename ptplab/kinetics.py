@@ -0,0 +1,209 @@
+'''Rate constants from the transient conductivity of a CSTR run and an online Arrhenius fit. \n
+Getting_Ea_inshallah.py smooths a normalised conductivity with a pandas rolling mean, differentiates with
+np.gradient and cuts the start and the end off with fixed trims ([8:-25]). Here: \n
+concentration = the cached calibration (calibration.conductivity_calibration), optionally compensated with the
+T200_PV probe \n
+dc/dt = local quadratic fit over a sliding window of samples (Savitzky-Golay on the real time stamps, the historian
+logs on change so the spacing varies from 1 to 25 s), value and slope at the centre of the window \n
+k(T) = the transient CSTR balance, dc_AA/dt = 2 k c_w c_AAH - F/V c_AA with c_AAH and c_w from the inert balances
+of anhydride and water since the pump started (at steady state this is calibration.cstr_rate_constant) \n
+Arrhenius = recursive least squares of ln k against 1/T, updated with every accepted sample \n
+Instead of trims a sample is used when its whole window lies in the pumping period and the acid is above
+MIN_CONCENTRATION. The same code runs over an archived run (extract, all windows in one batched solve) and
+sample by sample on a live tail (KineticsExtractor.add, an estimate WINDOW//2 samples behind the newest one).
+'''
+from collections import deque
+
+import numpy as np
+
+from ptplab.calibration import R_GAS, TEMPERATURE_TAGS, arrhenius_parameters
+from ptplab.historian import START_TAG, START_THRESHOLD
+from ptplab.models import cw_pure, inlet_concentrations
+
+CONDUCTIVITY_TAG = 'Q210_PV'
+WINDOW = 9 # samples in the local fit (about two minutes)
+ORDER = 2
+MIN_CONCENTRATION = 0.05 # mol/L, below this the conductivity hardly tells acid from water
+REFERENCE_TEMPERATURE = 303.15 # K, the intercept of the fit is ln k at 30 C
+
+def local_polynomial(t, y, window=WINDOW, order=ORDER):
+    '''Least squares polynomial through every run of window consecutive samples, all windows in one solve. \n
+    t, y = samples (t need not be evenly spaced) \n
+    returns time of the centre sample, smoothed value and first derivative there (one per window)
+    '''
+    from numpy.lib.stride_tricks import sliding_window_view
+    tw = sliding_window_view(np.asarray(t, dtype=float), window)
+    yw = sliding_window_view(np.asarray(y, dtype=float), window)
+    centre = tw[:, window//2]
+    X = np.power((tw - centre[:, None])[:, :, None], np.arange(order + 1)) # (windows, window, order + 1)
+    A = np.einsum('nwi,nwj->nij', X, X)
+    b = np.einsum('nwi,nw->ni', X, yw)
+    coefficients = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    return centre, coefficients[:, 0], coefficients[:, 1]
+
+def transient_rate_constant(t, c_aa, dcdt, fv1, fv2, V, c_start=0):
+    '''Rate constant of a CSTR from the acid concentration and its slope during the filling transient. \n
+    t = seconds after the AAH pump started, c_aa = acetic acid (mol/ml), dcdt = its slope (mol/ml/s) \n
+    fv1, fv2 = water and anhydride flow (ml/min), V = volume (ml) \n
+    c_start = acetic acid in the reactor when the pump started (mol/ml), the rest is water \n
+    returns k (ml/mol/s) and the anhydride left (mol/ml), same shape as t
+    '''
+    c_w_in, c_aah_in, flows = inlet_concentrations(fv1, fv2)
+    dilution = sum(flows)/V
+    decay = np.exp(-dilution*np.maximum(t, 0))
+    # c_AAH + c_AA/2 and c_w + c_AA/2 are not changed by the reaction, they only wash in
+    anhydride = c_aah_in + (c_start/2 - c_aah_in)*decay - c_aa/2
+    water = c_w_in + (cw_pure - c_w_in)*decay - c_aa/2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = (dcdt + dilution*c_aa)/(2*water*anhydride)
+    return k, anhydride
+
+class RecursiveArrhenius:
+    '''Recursive least squares of ln k = intercept + slope (T_ref/T - 1), the regressor is scaled so a vague prior
+    stays vague (1/T itself is of order 1e-5). \n
+    forgetting = weight of the past per update (1 keeps every sample, below 1 lets the fit follow changes) \n
+    prior_std = standard deviation of the starting guess (0, 0), large means no prior
+    '''
+    def __init__(self, T_ref=REFERENCE_TEMPERATURE, forgetting=1.0, prior_std=1e4):
+        self.T_ref = T_ref
+        self.forgetting = forgetting
+        self.theta = np.zeros(2) # slope (-Ea/(R T_ref)), intercept (ln k at T_ref)
+        self.P = np.eye(2)*prior_std**2
+        self.count = 0
+        self.rss = 0.0 # weighted sum of squared residuals, exact for forgetting = 1
+
+    def add(self, T, k):
+        '''One rate constant k at temperature T (K)'''
+        x = np.array([self.T_ref/T - 1, 1.0])
+        Px = self.P @ x
+        gain = Px/(self.forgetting + x @ Px)
+        error = np.log(k) - x @ self.theta # a priori
+        self.theta = self.theta + gain*error
+        self.rss = self.forgetting*self.rss + error**2*self.forgetting/(self.forgetting + x @ Px)
+        self.P = (self.P - np.outer(gain, Px))/self.forgetting
+        self.count += 1
+
+    def result(self):
+        '''k0 (ml/mol/s) and Ea (J/mol) with their standard errors (first order), count of samples'''
+        slope, intercept = self.theta
+        k0, Ea = arrhenius_parameters(slope*self.T_ref, intercept - slope) # ln k = (intercept - slope) + slope T_ref/T
+        cov = self.P*self.rss/max(self.count - 2, 1)
+        var_ln_k0 = cov[1, 1] - 2*cov[0, 1] + cov[0, 0]
+        return {'k0': k0, 'Ea': Ea, 'ln_k0_std': float(np.sqrt(max(var_ln_k0, 0))), 'Ea_std': float(np.sqrt(cov[0, 0]))*R_GAS*self.T_ref,
+                'k_ref': float(np.exp(intercept)), 'count': self.count}
+
+class KineticsExtractor:
+    '''Sample by sample k(T) of one CSTR run for a live historian tail. \n
+    fv1, fv2 = water and anhydride flow (ml/min), V = volume (ml) \n
+    calibration = calibration.ConductivityCalibration (default the Q210_PV one of today) \n
+    compensate = convert the conductivity at the probe temperature (calibration surface, off by default like
+    calibration.runs_concentration) \n
+    arrhenius = RecursiveArrhenius to add the accepted samples to (default a new one, pass one to pool runs)
+    '''
+    def __init__(self, fv1, fv2, V=567, calibration=None, compensate=False, window=WINDOW, order=ORDER, arrhenius=None):
+        if calibration is None:
+            from ptplab.calibration import conductivity_calibration
+            calibration = conductivity_calibration(CONDUCTIVITY_TAG)
+        self.fv1, self.fv2, self.V = fv1, fv2, V
+        self.calibration = calibration
+        self.compensate = compensate
+        self.window = window
+        self.order = order
+        self.arrhenius = arrhenius or RecursiveArrhenius()
+        self.buffer = deque(maxlen=window) # (t s, c mol/ml, T C, pumping)
+        self.c_start = 0.0
+
+    def add(self, t, conductivity, T, flow):
+        '''New sample: t (minutes after the start, negative before), Q210_PV, T200_PV and P120_Flow. \n
+        returns the estimate at the centre of the window (see extract for the keys) once the window is full, else None
+        '''
+        c = float(self.calibration.concentration(conductivity, T if self.compensate else None))*1e-3
+        if t <= 0:
+            self.c_start = max(c, 0)
+        self.buffer.append((t*60, c, T, flow >= START_THRESHOLD and t >= 0))
+        if len(self.buffer) < self.window:
+            return None
+        times, concentrations, temperatures, pumping = (np.array(column) for column in zip(*self.buffer))
+        centre, c_aa, dcdt = (value[0] for value in local_polynomial(times, concentrations, self.window, self.order))
+        T_centre = local_polynomial(times, temperatures, self.window, self.order)[1][0]
+        k, anhydride = transient_rate_constant(centre, c_aa, dcdt, self.fv1, self.fv2, self.V, self.c_start)
+        accepted = bool(np.all(pumping) and c_aa*1e3 >= MIN_CONCENTRATION and anhydride > 0 and np.isfinite(k) and k > 0)
+        if accepted:
+            self.arrhenius.add(T_centre + 273.15, k)
+        return {'t': centre/60, 'T': T_centre, 'c_aa': c_aa*1e3, 'dcdt': dcdt*1e3*60, 'k': k, 'accepted': accepted}
+
+def _run_inputs(entry, run=None):
+    '''Samples of a CSTR run on the Q210_PV time stamps and its median flows, like load_catalog_run takes them'''
+    from ptplab.catalog import run_path
+    from ptplab.historian import load_run
+    run = run or load_run(run_path(entry), tags=[CONDUCTIVITY_TAG, TEMPERATURE_TAGS[CONDUCTIVITY_TAG], START_TAG, 'P100_Flow'])
+    tags = run['tags']
+    t = tags[CONDUCTIVITY_TAG]['elapsed_time']
+    on_grid = lambda tag: np.interp(t, tags[tag]['elapsed_time'], tags[tag]['values'])
+    after_start = lambda tag: tags[tag]['values'][tags[tag]['elapsed_time'] >= 0]
+    return run, {'t': t, 'conductivity': tags[CONDUCTIVITY_TAG]['values'], 'T': on_grid(TEMPERATURE_TAGS[CONDUCTIVITY_TAG]),
+                 'flow': on_grid(START_TAG), 'fv1': float(np.median(after_start('P100_Flow'))), 'fv2': float(np.median(after_start(START_TAG)))}
+
+def extract(entry, compensate=False, window=WINDOW, order=ORDER, arrhenius=None, run=None):
+    '''k(T) over a whole archived CSTR run in one pass. \n
+    entry = catalog entry of a CSTR run, run = its historian.load_run output if already loaded \n
+    compensate, window, order, arrhenius as in KineticsExtractor \n
+    returns dictionary of arrays at the window centres: 't' (min), 'T' (C), 'c_aa' (mol/L), 'dcdt' (mol/L/min),
+    'k' (ml/mol/s), 'accepted', and the 'arrhenius' fit the accepted samples were added to
+    '''
+    from ptplab.calibration import conductivity_calibration
+    run, inputs = _run_inputs(entry, run)
+    calibration = conductivity_calibration(CONDUCTIVITY_TAG, run['start_time'])
+    t = inputs['t']*60
+    c = calibration.concentration(inputs['conductivity'], inputs['T'] if compensate else None)*1e-3
+    before = np.flatnonzero(inputs['t'] <= 0)
+    c_start = max(c[before[-1]], 0) if len(before) else 0.0
+
+    centre, c_aa, dcdt = local_polynomial(t, c, window, order)
+    T = local_polynomial(t, inputs['T'], window, order)[1]
+    k, anhydride = transient_rate_constant(centre, c_aa, dcdt, inputs['fv1'], inputs['fv2'], entry['V'], c_start)
+    from numpy.lib.stride_tricks import sliding_window_view
+    pumping = np.all(sliding_window_view((inputs['flow'] >= START_THRESHOLD) & (inputs['t'] >= 0), window), axis=1)
+    with np.errstate(invalid='ignore'):
+        accepted = pumping & (c_aa*1e3 >= MIN_CONCENTRATION) & (anhydride > 0) & np.isfinite(k) & (k > 0)
+
+    arrhenius = arrhenius or RecursiveArrhenius()
+    for T_sample, k_sample in zip(T[accepted], k[accepted]):
+        arrhenius.add(T_sample + 273.15, k_sample)
+    return {'t': centre/60, 'T': T, 'c_aa': c_aa*1e3, 'dcdt': dcdt*1e3*60, 'k': k, 'accepted': accepted, 'arrhenius': arrhenius}
+
+def stream(entry, compensate=False, arrhenius=None, **options):
+    '''Feeds an archived CSTR run to a KineticsExtractor one sample at a time, like a live tail. \n
+    returns the list of estimates and the extractor
+    '''
+    from ptplab.calibration import conductivity_calibration
+    run, inputs = _run_inputs(entry)
+    extractor = KineticsExtractor(inputs['fv1'], inputs['fv2'], V=entry['V'], compensate=compensate, arrhenius=arrhenius,
+                                  calibration=conductivity_calibration(CONDUCTIVITY_TAG, run['start_time']), **options)
+    estimates = []
+    for j in range(len(inputs['t'])):
+        estimate = extractor.add(inputs['t'][j], inputs['conductivity'][j], inputs['T'][j], inputs['flow'][j])
+        if estimate is not None:
+            estimates.append(estimate)
+    return estimates, extractor
+
+
+if __name__ == '__main__':
+    from ptplab.catalog import RUNS
+    pooled = RecursiveArrhenius()
+    for entry in RUNS:
+        if entry['reactor'] != 'CSTR':
+            continue
+        try:
+            result = extract(entry, arrhenius=pooled)
+        except KeyError: # no conductivity logged in this run
+            continue
+        single = extract(entry)['arrhenius'].result()
+        accepted = result['accepted']
+        if not np.any(accepted):
+            print(f"{entry['name']}: no usable samples (conductivity never rises)")
+            continue
+        print(f"{entry['name']}: {np.count_nonzero(accepted)} samples, T {np.min(result['T'][accepted]):.1f}-{np.max(result['T'][accepted]):.1f} C, "
+              f"k at 30 C {single['k_ref']:.3f} ml/mol/s, Ea {single['Ea']/1e3:.0f} +- {single['Ea_std']/1e3:.0f} kJ/mol")
+    fit = pooled.result()
+    print(f"all runs: {fit['count']} samples, k0 = {fit['k0']:.3e} ml/mol/s, Ea = {fit['Ea']:.4e} +- {fit['Ea_std']:.1e} J/mol")
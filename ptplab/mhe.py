@@ -0,0 +1,203 @@
+'''Moving horizon estimation of the bead heat transfer coefficient U and a k0 multiplier during a PBR run. \n
+U is the hard coded 'Oliver calc' value and k0 differs from run to run, so both are re-fitted over a sliding
+window of the most recent probe data. The parameters are theta = (ln U, ln m) with k0 = m * k0 of the kinetics. \n
+Each window is one model solve with forward sensitivities S = dx/dtheta (dS/dt = J S + df/dtheta, J from
+models.pbr_jacobian), so a Gauss-Newton iteration costs one solve instead of a solve per parameter. Windows
+are warm started: theta starts at the previous solution, the state at the start of the window and its
+sensitivity are read off the previous window's trajectory (x0 moves with theta as x0 + S0 dtheta) and the
+previous fit enters as an arrival cost. A new window then needs two or three iterations instead of a full
+refit, more only while U is moving far from where it started (it is weakly identified until the beads lag).
+'''
+import numpy as np
+
+from ptplab.models import PBR_KINETICS, PBR_PROBES, pbr_der_func, pbr_initial_state, pbr_jacobian, pbr_params, probe_tank, PBR_BAND
+from ptplab.kalman import TEMPERATURE_NOISE
+
+WINDOW = 8 # minutes of data in a window
+STEP = 2 # minutes between fits
+MAX_ITER = 6
+MAX_HALVINGS = 4
+TOL = 1e-2 # stop when the Gauss-Newton step in ln U and ln m is below this (1 %)
+MAX_STEP = 1.0 # largest change of ln U or ln m in one iteration
+PRIOR_STD = 1.0 # std of ln U and ln m before the first window
+DRIFT_STD = 0.05 # growth of the arrival cost std per minute, lets U and k0 drift
+SOLVER_OPTIONS = {'method': 'LSODA', 'rtol': 1e-6, 'atol': 1e-9}
+
+def _dense(ab, n):
+    '''Dense matrix from the solve_banded storage of pbr_jacobian'''
+    lower, upper = PBR_BAND
+    d = 5*n
+    J = np.zeros((d, d))
+    for offset in range(-upper, lower + 1): # row = column + offset
+        columns = np.arange(max(0, -offset), min(d, d - offset))
+        J[columns + offset, columns] = ab[upper + offset, columns]
+    return J
+
+def sensitivity_der_func(t, z, parameters, n):
+    '''pbr_der_func together with the sensitivities to ln U and ln k0. \n
+    z = [states (5n), dx/dlnU (5n), dx/dlnk0 (5n)]
+    '''
+    d = 5*n
+    x = z[:d]
+    S = z[d:].reshape(2, d).T
+    C = x.reshape(n, 5)
+    reaction_rate = C[:, 0]*C[:, 1]*parameters['k0']*np.exp(-parameters['Ea']/(parameters['R']*C[:, 3]))
+    heat_to_beads = parameters['U']*parameters['Area_bead_per_tank']*(C[:, 4] - C[:, 3])
+    V = parameters['V']
+
+    df = np.zeros((n, 5, 2))
+    df[:, 3, 0] = heat_to_beads/(parameters['rho_water']*parameters['cp_water']*V) # d/dlnU = U d/dU
+    df[:, 4, 0] = -heat_to_beads/(parameters['rho_glass']*parameters['cp_glass']*V)
+    beta = -parameters['H']/(parameters['rho_water']*parameters['cp_water'])
+    df[:, :, 1] = reaction_rate[:, None]*np.array([-1, -1, 2, beta, 0]) # d/dlnk0 = k0 d/dk0
+
+    dz = np.empty_like(z)
+    dz[:d] = pbr_der_func(t, x, parameters, n)
+    dS = _dense(pbr_jacobian(t, x, parameters, n), n) @ S + df.reshape(d, 2)
+    dz[d:] = dS.T.ravel()
+    return dz
+
+class MovingHorizonEstimator:
+    '''Sliding window fit of U and the k0 multiplier for one PBR run. \n
+    T, fv1, fv2, V, n = run conditions as in PBR_model \n
+    kinetics = starting k0, Ea, U (default PBR_KINETICS), k0 here is the one the multiplier scales \n
+    window, step = window length and time between fits in minutes \n
+    Feed data with add(), it fits whenever step minutes of new data came in.
+    '''
+    def __init__(self, T, fv1, fv2, V=131, n=9, kinetics=None, window=WINDOW, step=STEP):
+        self.T, self.fv1, self.fv2, self.V, self.n = T, fv1, fv2, V, n
+        self.kinetics = dict(PBR_KINETICS if kinetics is None else kinetics)
+        self.window = window
+        self.step = step
+        self.theta = np.array([np.log(self.kinetics['U']), 0.0])
+        self.prior = self.theta.copy()
+        self.prior_cov = np.diag([PRIOR_STD**2, PRIOR_STD**2])
+        self.probe_index = np.array([3 + 5*probe_tank(i, n) for i in range(len(PBR_PROBES))])
+        self.times = [] # minutes
+        self.values = [] # K, one row of probes per time
+        # state and sensitivity at the start of the current window, the run starts with water at T and S = 0
+        self.t0 = 0.0
+        self.x0 = pbr_initial_state(T, n).astype(float)
+        self.S0 = np.zeros((5*n, 2))
+        self.last_fit = None
+        self.history = []
+
+    def parameters(self, theta=None):
+        theta = self.theta if theta is None else theta
+        return {'U': float(np.exp(theta[0])), 'k0_multiplier': float(np.exp(theta[1])), 'k0': float(self.kinetics['k0']*np.exp(theta[1]))}
+
+    def simulate(self, theta, x0, t_eval):
+        '''States and sensitivities over the window at the data times (minutes). \n
+        returns x with shape (len(t_eval), 5n) and S with shape (len(t_eval), 5n, 2)
+        '''
+        from ptplab.models import solve
+        values = self.parameters(theta)
+        params = pbr_params(self.T, self.fv1, self.fv2, V=self.V, n=self.n, kinetics=dict(self.kinetics, U=values['U'], k0=values['k0']))
+        d = 5*self.n
+        z0 = np.concatenate([x0, self.S0.T.ravel()])
+        t_eval = np.asarray(t_eval)*60
+        sol = solve(sensitivity_der_func, [self.t0*60, t_eval[-1]], z0, args=(params, self.n), t_eval=t_eval, **SOLVER_OPTIONS)
+        if not sol.success:
+            raise RuntimeError(f'model solve failed in the window starting at {self.t0:.1f} min: {sol.message}')
+        return sol.y[:d].T, sol.y[d:].T.reshape(len(t_eval), 2, d).transpose(0, 2, 1)
+
+    def add(self, t, temperatures):
+        '''New probe sample. t in minutes after the start, temperatures = 8 readings in C (PBR_PROBES order). \n
+        returns the fit result when a window was fitted, else None
+        '''
+        self.times.append(t)
+        self.values.append(np.asarray(temperatures, dtype=float) + 273.15)
+        last = self.history[-1]['t'] if self.history else 0
+        if t - last >= self.step and t - self.t0 >= min(self.window, self.step):
+            return self.fit()
+        return None
+
+    def fit(self):
+        '''Gauss-Newton on the current window, warm started from the previous one'''
+        t_end = self.times[-1]
+        new_t0 = max(t_end - self.window, 0)
+        if new_t0 > self.t0 and self.last_fit is not None:
+            self._shift(new_t0)
+        first = np.searchsorted(self.times, self.t0, side='right') # samples before the window are not used again
+        del self.times[:first], self.values[:first]
+        t_eval = np.array(self.times)
+        measured = np.array(self.values)[:, :len(self.probe_index)]
+
+        theta_start = self.theta.copy()
+        x0_start = self.x0.copy()
+        information = np.linalg.inv(self.prior_cov)
+
+        def evaluate(theta):
+            x0 = x0_start + self.S0 @ (theta - theta_start) # the start of the window moves with theta
+            x, S = self.simulate(theta, x0, t_eval)
+            residuals = (measured - x[:, self.probe_index]).ravel()/TEMPERATURE_NOISE
+            G = S[:, self.probe_index, :].reshape(-1, 2)/TEMPERATURE_NOISE # d model / d theta
+            deviation = theta - self.prior
+            return x0, x, S, residuals, G, residuals @ residuals + deviation @ information @ deviation
+
+        x0, x, S, residuals, G, cost = evaluate(self.theta)
+        iterations = 0
+        for iterations in range(1, MAX_ITER + 1):
+            gradient = G.T @ residuals - information @ (self.theta - self.prior)
+            delta = np.clip(np.linalg.solve(G.T @ G + information, gradient), -MAX_STEP, MAX_STEP)
+            for _ in range(MAX_HALVINGS): # U only shows in the probes once the beads lag behind, so steps can overshoot
+                trial = evaluate(self.theta + delta)
+                if trial[-1] <= cost:
+                    break
+                delta = delta/2
+            else: # no halving lowered the cost, theta stays where it is
+                break
+            self.theta = self.theta + delta
+            x0, x, S, residuals, G, cost = trial
+            if np.max(np.abs(delta)) < TOL:
+                break
+        cov = np.linalg.inv(G.T @ G + information)
+
+        self.x0 = x0
+        self.last_fit = {'t': t_eval, 'x': x, 'S': S, 'cov': cov}
+        result = dict(self.parameters(), t=float(t_end), window_start=float(self.t0), iterations=iterations,
+                      rms=float(np.sqrt(np.mean(residuals**2)))*TEMPERATURE_NOISE, std_ln=np.sqrt(np.diag(cov)))
+        self.history.append(result)
+        return result
+
+    def _shift(self, new_t0):
+        '''Moves the start of the window to new_t0: state and sensitivity from the previous trajectory, the
+        previous fit becomes the arrival cost'''
+        fit = self.last_fit
+        k = np.searchsorted(fit['t'], new_t0)
+        k = min(k, len(fit['t']) - 1)
+        self.x0 = fit['x'][k]
+        self.S0 = fit['S'][k]
+        elapsed = fit['t'][k] - self.t0
+        self.t0 = float(fit['t'][k])
+        self.prior = self.theta.copy()
+        self.prior_cov = fit['cov'] + np.eye(2)*DRIFT_STD**2*elapsed
+
+def track(entry, n=None, kinetics=None, **options):
+    '''Runs the estimator over a recorded PBR run sample by sample. \n
+    entry = catalog entry of a PBR run, the probes are used like load_catalog_run prepares them (all eight, the
+    estimator needs every probe, flagged ones included) \n
+    other keyword arguments go to MovingHorizonEstimator \n
+    returns the list of window results
+    '''
+    from ptplab.catalog import load_catalog_run
+    run = load_catalog_run(entry, probe_health='flag')
+    estimator = MovingHorizonEstimator(run['T_in'], run['fv_water'], run['fv_aah'], V=run['V'], n=n or run['n'],
+                                       kinetics=kinetics, **options)
+    times = run['probes'][PBR_PROBES[0]]['elapsed_time']
+    temperatures = np.column_stack([run['probes'][probe]['rise'] + run['T_in'] for probe in PBR_PROBES])
+    for t, row in zip(times, temperatures):
+        if t > 0:
+            estimator.add(t, row)
+    return estimator.history
+
+
+if __name__ == '__main__':
+    import time
+    from ptplab.catalog import get_run
+    start = time.perf_counter()
+    history = track(get_run('PBR 40c'))
+    for result in history:
+        print(f"{result['t']:5.1f} min  U = {result['U']:.3e}  k0 x {result['k0_multiplier']:.3f}  "
+              f"iterations {result['iterations']}  rms {result['rms']:.3f} K")
+    print(f'{len(history)} windows in {time.perf_counter() - start:.1f} s')
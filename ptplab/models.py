@@ -0,0 +1,430 @@
+import math
+import numpy as np
+
+from ptplab import instrumentation
+
+# Reaction: Water + Acetic Anhydride -> 2 * Acetic acid
+# Assume reaction is 1st order wrt both components
+# Assume constant density
+
+#Water
+mm_water = 18.01528 # (g/mol)
+rho_water = 0.999842 # (g/ml)
+cw_pure = rho_water/mm_water # (mol/ml)
+
+#Acetic anhydride
+mm_AAH = 102.089 # (g/mol)
+rho_AAH = 1.082 # (g/ml)
+caah_pure = rho_AAH/mm_AAH # (mol/ml)
+
+# Kinetic parameters as they are hard coded in the Submission scripts. estimation.py fits new ones.
+CSTR_KINETICS = {
+    "k0": 4.4e15,         # Reaction rate constant (ml/mol/s)
+    "Ea": 9.62e4,         # Activation energy (J/mol)
+}
+PBR_KINETICS = {
+    "k0": 4.4e14,         # Reaction rate constant (ml/mol/s)
+    "Ea": 9.825e4,        # Activation energy (J/mol)
+    "U": 1.2122e-4,       # Heat transfer coefficient liquid to beads (W/cm2/K), Oliver calc
+}
+
+N_PROBES = 8 # T201_PV ... T208_PV along the PBR
+PBR_PROBES = ['T201_PV', 'T202_PV', 'T203_PV', 'T204_PV', 'T205_PV', 'T206_PV', 'T207_PV', 'T208_PV']
+CSTR_PROBE = 'T200_PV'
+# Bandwidth (lower, upper) of the PBR jacobian: a tank depends on the tank before it (5 states back) and
+# its own states, the liquid temperature sits 3 places after c_water
+PBR_BAND = (5, 3)
+
+
+def solve(fun, tspan, y0, args=(), t_eval=None, method='RK45', **options):
+    '''Every model solve goes through here so the solver settings are in one place. \n
+    Same arguments as scipy.integrate.solve_ivp. Inside instrumentation.record() the solve is timed and counted.
+    '''
+    if instrumentation.active():
+        return instrumentation.instrumented_solve(fun, tspan, y0, args=args, t_eval=t_eval, method=method, **options)
+    from scipy.integrate import solve_ivp # imported on first use, scipy takes longer to import than the package itself
+    return solve_ivp(fun, tspan, y0, method=method, t_eval=t_eval, args=args, **options)
+
+def inlet_concentrations(fv1, fv2):
+    '''Inlet concentrations after mixing the water and anhydride streams. \n
+    fv1 = flow rate of water in units ml/min \n
+    fv2 = flow rate of acetic anhydride ml/min \n
+    returns (C_in_water, C_in_AAH) in mol/ml and the flows in ml/s
+    '''
+    flow_array = [fv1/60, fv2/60] # ml/min to ml/s
+    total_flow = flow_array[0] + flow_array[1]
+    return (flow_array[0]*cw_pure)/total_flow, (flow_array[1]*caah_pure)/total_flow, flow_array
+
+def cstr_params(T, fv1, fv2, V=500, kinetics=None):
+    '''Builds the parameter dictionary used by cstr_der_func. \n
+    T = inlet temperature in celsius \n
+    fv1 = flow rate of water in units ml/min \n
+    fv2 = flow rate of acetic anhydride ml/min \n
+    V = volume of the reactor in units ml \n
+    kinetics = dictionary overriding k0 and/or Ea (default CSTR_KINETICS)
+    '''
+    C_in_water, C_in_AAH, flow_array = inlet_concentrations(fv1, fv2)
+    params = { # Stores the relevant thermodynamic constants as a dictionary
+        "C_in_water": C_in_water,
+        "C_in_AAH": C_in_AAH,
+        "Inlet temperature": T+273.15, # Temp but now in kelvin
+        "flow": flow_array,
+        "V": V,  # Volume in ml
+        "R": 8.314,              # Gas constant (J/mol/K)
+        "H": -56.6e3,            # Enthalpy change (J/mol)
+        "rho": 1,                # Density (g/ml)
+        "cp": 4.186              # Heat capacity (J/g/K)
+    }
+    params.update(CSTR_KINETICS)
+    if kinetics is not None:
+        params.update({key: kinetics[key] for key in ('k0', 'Ea') if key in kinetics})
+    return params
+
+def cstr_der_func(t, C, parameters):
+    '''This function contains the differential equations to solve the reaction A+B->2C in an adiabatic
+    CSTR. \n
+    t=time (seconds) \n
+    c = Concentration vector like [c_water, c_AAH, c_AA, Temperature]\n
+    parameters = dictionary containing thermodynamic constants
+    '''
+    dcdt = np.zeros(4)
+
+    C_in_w = parameters['C_in_water']
+    C_in_AAH = parameters['C_in_AAH']
+    flow = parameters['flow']
+    V = parameters['V']
+    k0 = parameters['k0']
+    Ea = parameters['Ea']
+    R = parameters['R']
+    H = parameters['H']
+    rho = parameters['rho']
+    cp = parameters['cp']
+    inlet_temp = parameters["Inlet temperature"]
+
+    reaction_rate = C[0]*C[1] * k0 * np.exp(-Ea/(R*C[3]))
+    total_flow = flow[0]+flow[1]
+
+    dcdt[0] = (total_flow/V)*(C_in_w - C[0]) - reaction_rate # Water
+    dcdt[1] = (total_flow/V)*(C_in_AAH - C[1]) - reaction_rate # Anhydride
+    dcdt[2] = (total_flow/V)*(0 - C[2]) + 2*reaction_rate # Acetic acid
+    dcdt[3] = (total_flow/V) * (inlet_temp-C[3]) - H/(rho*cp) * reaction_rate # Temperature
+    return dcdt
+
+def CSTR_model(T, fv1, fv2, V=500, tspan=[0, 3600], t_eval=None, kinetics=None, **options):
+    '''Models the behavior of the reaction: Water + Acetic Anhydride -> 2 * Acetic acid in an adiabatic CSTR reactor. \n
+    Required Arguments: \n
+    T = inlet temperature for the reactor given in units celsius \n
+    fv1 = flow rate of water in units ml/min \n
+    fv2 = flow rate of acetic anhydride ml/min \n
+    Optional Arguments: \n
+    V = volume of the reactor in units ml (default set to 500ml) \n
+    tspan = list of evaluation time in units seconds (default set to [0,3600]) \n
+    t_eval = times at which to store the solution (seconds) \n
+    kinetics = dictionary overriding k0 and/or Ea \n
+    other keyword arguments are passed on to solve_ivp \n
+    returns the solve_ivp solution, y rows are [c_water, c_AAH, c_AA, T]
+    '''
+    params = cstr_params(T, fv1, fv2, V=V, kinetics=kinetics)
+    xini = [cw_pure, 0, 0, T+273.15] # Reactor starts full of water at inlet temperature
+    return solve(cstr_der_func, tspan, xini, args=(params,), t_eval=t_eval, **options)
+
+def CSTR_model_step_change(T1, T2, fv1, fv2, V=500, tspan=[0, 3600], t_change=1800, kinetics=None, **options):
+    '''CSTR model with a step change in inlet temperature from T1 to T2 at t_change (seconds). \n
+    Other arguments are the same as CSTR_model. \n
+    returns combined time and solution arrays
+    '''
+    params = cstr_params(T1, fv1, fv2, V=V, kinetics=kinetics)
+    xini = [cw_pure, 0, 0, T1+273.15]
+    sol_1 = solve(cstr_der_func, [tspan[0], t_change], xini, args=(params,), **options)
+
+    params["Inlet temperature"] = T2+273.15 # Change temp
+    sol_2 = solve(cstr_der_func, [t_change, tspan[1]], sol_1.y[:, -1], args=(params,), **options)
+
+    combined_time = np.concatenate((sol_1.t, sol_2.t))
+    combined_y = np.concatenate((sol_1.y, sol_2.y), axis=1)
+    return combined_time, combined_y
+
+def pbr_params(T, fv1, fv2, V=131, n=6, kinetics=None):
+    '''Builds the parameter dictionary used by pbr_der_func. \n
+    T = inlet temperature in celsius \n
+    fv1 = flow rate of water in units ml/min \n
+    fv2 = flow rate of acetic anhydride ml/min \n
+    V = liquid volume of the packed bed in units ml \n
+    n = number of tanks in series \n
+    kinetics = dictionary overriding k0, Ea and/or U (default PBR_KINETICS)
+    '''
+    C_in_water, C_in_AAH, flow_array = inlet_concentrations(fv1, fv2)
+
+    # Calculations for glass beads
+    V_total = 337 #cm3
+    V_beads = V_total-V #cm3 should be like 206cm3
+    epsilon = (V_total-V_beads)/(V_total) #void fraction
+    diameter_bead = 2e-1 # 2mm diameter in cm
+    A_total = (3*V_beads*diameter_bead)/2
+    A_per_tank = A_total/n
+
+    params = {
+        "C_in_water": C_in_water,
+        "C_in_AAH": C_in_AAH,
+        "Inlet temperature": T+273.15,
+        "flow": flow_array,
+        "V": V/n,  # Volume per tank in ml
+        "R": 8.314,              # Gas constant (J/mol/K)
+        "H": -56.6e3,            # Enthalpy change (J/mol)
+        "rho_water": 1,          # Density (g/ml)
+        "rho_glass": 2.4,        # Density (g/ml)
+        "epsilon": epsilon,
+        "cp_water": 4.186,       # Heat capacity (J/g/K)
+        "cp_glass": 0.84,        # Heat capacity (J/g/K)
+        "Area_bead_per_tank": A_per_tank,
+    }
+    params.update(PBR_KINETICS)
+    if kinetics is not None:
+        params.update({key: kinetics[key] for key in ('k0', 'Ea', 'U') if key in kinetics})
+    return params
+
+def pbr_der_func(t, C, parameters, n=6):
+    '''Differential equations for n tanks in series with glass beads. \n
+    t=time (seconds) \n
+    C = state vector [c_water, c_AAH, c_AA, T liquid, T glass beads] repeating for every tank \n
+    parameters = dictionary containing thermodynamic constants \n
+    The tanks are done all at once as rows of a (n, 5) array instead of looping over 5*n entries.
+    '''
+    C = np.reshape(C, (n, 5))
+    V = parameters['V']
+    k0 = parameters['k0']
+    Ea = parameters['Ea']
+    R = parameters['R']
+    H = parameters['H']
+    rho_water = parameters['rho_water']
+    rho_glass = parameters['rho_glass']
+    cp_water = parameters['cp_water']
+    cp_glass = parameters['cp_glass']
+    A = parameters["Area_bead_per_tank"]
+    U = parameters["U"]
+    flow = parameters['flow']
+    total_flow = flow[0]+flow[1]
+
+    # what flows into every tank: the feed for the first one, the previous tank for the rest
+    upstream = np.empty((n, 4))
+    upstream[0] = [parameters['C_in_water'], parameters['C_in_AAH'], 0, parameters["Inlet temperature"]]
+    upstream[1:] = C[:-1, :4]
+
+    reaction_rate = C[:, 0]*C[:, 1]*k0*np.exp(-Ea/(R*C[:, 3]))
+    heat_to_beads = U*A*(C[:, 4] - C[:, 3])
+
+    dcdt = np.empty((n, 5))
+    dcdt[:, :4] = (total_flow/V)*(upstream - C[:, :4])
+    dcdt[:, 0] -= reaction_rate # Water
+    dcdt[:, 1] -= reaction_rate # AAH
+    dcdt[:, 2] += 2*reaction_rate # AA
+    dcdt[:, 3] += -H/(rho_water*cp_water)*reaction_rate + heat_to_beads/(rho_water*cp_water*V) # Liquid temperature
+    dcdt[:, 4] = -heat_to_beads/(rho_glass*cp_glass*V) # Glass bead temperature
+    return dcdt.ravel()
+
+def pbr_jacobian(t, C, parameters, n=6):
+    '''Analytic jacobian of pbr_der_func in the (lower + upper + 1, 5n) storage of scipy.linalg.solve_banded
+    with (lower, upper) = PBR_BAND'''
+    C = np.reshape(C, (n, 5))
+    V = parameters['V']
+    F = (parameters['flow'][0] + parameters['flow'][1])/V
+    k = parameters['k0']*np.exp(-parameters['Ea']/(parameters['R']*C[:, 3]))
+    w, h = C[:, 0], C[:, 1]
+    r_w, r_h = h*k, w*k # derivatives of the reaction rate
+    r_T = w*h*k*parameters['Ea']/(parameters['R']*C[:, 3]**2)
+    beta = -parameters['H']/(parameters['rho_water']*parameters['cp_water'])
+    UA = parameters['U']*parameters['Area_bead_per_tank']
+    to_liquid = UA/(parameters['rho_water']*parameters['cp_water']*V)
+    to_glass = UA/(parameters['rho_glass']*parameters['cp_glass']*V)
+
+    lower, upper = PBR_BAND
+    ab = np.zeros((lower + upper + 1, 5*n))
+    def put(row, col, value): # row and col of the states inside a tank
+        ab[upper + row - col, col::5] = value
+    put(0, 0, -F - r_w); put(0, 1, -r_h); put(0, 3, -r_T)
+    put(1, 0, -r_w); put(1, 1, -F - r_h); put(1, 3, -r_T)
+    put(2, 0, 2*r_w); put(2, 1, 2*r_h); put(2, 2, -F); put(2, 3, 2*r_T)
+    put(3, 0, beta*r_w); put(3, 1, beta*r_h); put(3, 3, -F + beta*r_T - to_liquid); put(3, 4, to_liquid)
+    put(4, 3, to_glass); put(4, 4, -to_glass)
+    ab[upper + 5, :-5] = np.tile([F, F, F, F, 0], n)[:-5] # inflow from the tank before
+    return ab
+
+def pbr_initial_state(T, n):
+    '''Reactor full of water at inlet temperature, beads at the same temperature'''
+    return np.tile([cw_pure, 0, 0, T+273.15, T+273.15], n)
+
+def PBR_model(T, fv1, fv2, V=131, tspan=[0, 3600], n=6, t_eval=None, kinetics=None, **options):
+    '''Models the behavior of the reaction: Water + Acetic Anhydride -> 2 * Acetic acid in an adiabatic PBR reactor
+    as n tanks in series exchanging heat with the glass beads. \n
+    Required Arguments: \n
+    T = inlet temperature for the reactor given in units celsius \n
+    fv1 = flow rate of water in units ml/min \n
+    fv2 = flow rate of acetic anhydride ml/min \n
+    Optional Arguments: \n
+    V = volume of the reactor in units ml (default set to 131ml) \n
+    tspan = list of evaluation time in units seconds (default set to [0,3600]) \n
+    n = number of tanks (default 6) \n
+    t_eval = times at which to store the solution (default 400 points like the scripts) \n
+    kinetics = dictionary overriding k0, Ea and/or U \n
+    other keyword arguments are passed on to solve_ivp \n
+    returns the solve_ivp solution, the temperature of tank i is row 3 + 5*i
+    '''
+    params = pbr_params(T, fv1, fv2, V=V, n=n, kinetics=kinetics)
+    if t_eval is None:
+        t_eval = np.linspace(tspan[0], tspan[1], 400)
+    return solve(pbr_der_func, tspan, pbr_initial_state(T, n), args=(params, n), t_eval=t_eval, **options)
+
+def PBR_model_step_change(T1, T2, fv1, fv2_1, fv2_2, V=131, tspan=[0, 3600], t_change1=1800, t_change2=2400, n=6, kinetics=None, **options):
+    '''PBR model with a step change in anhydride flow (fv2_1 -> fv2_2 at t_change1) followed by
+    a step change in inlet temperature (T1 -> T2 at t_change2). Times in seconds. \n
+    returns combined time and solution arrays
+    '''
+    params = pbr_params(T1, fv1, fv2_1, V=V, n=n, kinetics=kinetics)
+    sol_1 = solve(pbr_der_func, [tspan[0], t_change1], pbr_initial_state(T1, n), args=(params, n), **options)
+
+    params['C_in_water'], params['C_in_AAH'], params['flow'] = inlet_concentrations(fv1, fv2_2)
+    tight = dict({'rtol': 1e-8, 'atol': 1e-10}, **options) # the scripts needed tight tolerances after the change
+    sol_2 = solve(pbr_der_func, [t_change1, t_change2], sol_1.y[:, -1], args=(params, n), **tight)
+
+    params['Inlet temperature'] = T2+273.15
+    sol_3 = solve(pbr_der_func, [t_change2, tspan[1]], sol_2.y[:, -1], args=(params, n), **tight)
+
+    combined_time = np.concatenate((sol_1.t, sol_2.t, sol_3.t))
+    combined_y = np.concatenate((sol_1.y, sol_2.y, sol_3.y), axis=1)
+    return combined_time, combined_y
+
+def probe_tank(i, n):
+    '''Which tank (0 based) temperature probe i (0 = T201_PV ... 7 = T208_PV) sits in when the bed is n tanks,
+    same mapping as PBR_model.py
+    '''
+    if i == 0:
+        tank = 1
+    else:
+        tank = math.floor((i * n) / N_PROBES) + 1
+    return min(tank, n-1)
+
+def _ensemble(*values):
+    '''Broadcasts numbers and arrays to one (M,) float array each'''
+    return np.broadcast_arrays(*(np.atleast_1d(np.asarray(value, dtype=float)) for value in values))
+
+def cstr_ensemble_params(T, fv1, fv2, V=500, kinetics=None):
+    '''cstr_params for M cases at once. Every argument, and every value in kinetics, can be a number or an
+    array of length M. Coefficients that do not change during a solve are worked out here, and scratch
+    space for cstr_ensemble_der_func is allocated here so the derivative itself allocates nothing.
+    '''
+    kinetics = dict(CSTR_KINETICS, **{key: kinetics[key] for key in ('k0', 'Ea') if kinetics and key in kinetics})
+    T, fv1, fv2, V, k0, Ea = _ensemble(T, fv1, fv2, V, kinetics['k0'], kinetics['Ea'])
+    single = cstr_params(0, 1, 1) # the constants
+    C_in_water, C_in_AAH, flow = inlet_concentrations(fv1, fv2)
+    return {
+        "C_in_water": C_in_water,
+        "C_in_AAH": C_in_AAH,
+        "Inlet temperature": T + 273.15,
+        "dilution": (flow[0] + flow[1])/V, # total flow/V (1/s)
+        "k0": k0,
+        "minus_Ea_over_R": -Ea/single['R'],
+        "reaction_heat": -single['H']/(single['rho']*single['cp']),
+        "work": np.empty(len(T)),
+    }
+
+def cstr_ensemble_der_func(t, C, parameters, out):
+    '''cstr_der_func for a batch, C and out are (M, 4) with rows [c_water, c_AAH, c_AA, Temperature].
+    The derivatives are written into out, see integrators.ensemble_master_function.'''
+    rate = parameters['work']
+    np.divide(parameters['minus_Ea_over_R'], C[:, 3], out=rate)
+    np.exp(rate, out=rate)
+    rate *= parameters['k0']
+    rate *= C[:, 0]
+    rate *= C[:, 1]
+    dilution = parameters['dilution']
+
+    np.subtract(parameters['C_in_water'], C[:, 0], out=out[:, 0])
+    np.subtract(parameters['C_in_AAH'], C[:, 1], out=out[:, 1])
+    np.negative(C[:, 2], out=out[:, 2])
+    np.subtract(parameters['Inlet temperature'], C[:, 3], out=out[:, 3])
+    out *= dilution[:, None]
+    out[:, 0] -= rate
+    out[:, 1] -= rate
+    out[:, 2] += rate
+    out[:, 2] += rate
+    rate *= parameters['reaction_heat']
+    out[:, 3] += rate
+
+def pbr_ensemble_params(T, fv1, fv2, V=131, n=6, kinetics=None):
+    '''pbr_params for M cases at once (n is the same for all of them, it sets the size of the state).
+    Arguments and kinetics values can be numbers or arrays of length M, see cstr_ensemble_params.'''
+    kinetics = dict(PBR_KINETICS, **{key: kinetics[key] for key in ('k0', 'Ea', 'U') if kinetics and key in kinetics})
+    T, fv1, fv2, V, k0, Ea, U = _ensemble(T, fv1, fv2, V, kinetics['k0'], kinetics['Ea'], kinetics['U'])
+    single = pbr_params(0, 1, 1, V=V[0], n=n)
+    C_in_water, C_in_AAH, flow = inlet_concentrations(fv1, fv2)
+    V_tank = V/n
+    A = (3*(337 - V)*2e-1)/2/n # bead area per tank, same as pbr_params
+    M = len(T)
+    column = lambda value: np.asarray(value)[:, None] # (M, 1) so it broadcasts over the tanks
+    return {
+        "inlet": np.stack([C_in_water, C_in_AAH, np.zeros(M), T + 273.15], axis=1), # (M, 4)
+        "dilution": column((flow[0] + flow[1])/V_tank),
+        "k0": column(k0),
+        "minus_Ea_over_R": column(-Ea/single['R']),
+        "UA": column(U*A),
+        "reaction_heat": -single['H']/(single['rho_water']*single['cp_water']),
+        "liquid_heat": column(1/(single['rho_water']*single['cp_water']*V_tank)),
+        "glass_heat": column(-1/(single['rho_glass']*single['cp_glass']*V_tank)),
+        "work": np.empty((2, M, n)),
+    }
+
+def pbr_ensemble_der_func(t, C, parameters, n, out):
+    '''pbr_der_func for a batch, C and out are (M, 5*n) with the same order as pbr_der_func.
+    The derivatives are written into out, see integrators.ensemble_master_function.'''
+    M = C.shape[0]
+    C = C.reshape(M, n, 5)
+    D = out.reshape(M, n, 5)
+    rate, heat = parameters['work']
+
+    np.divide(parameters['minus_Ea_over_R'], C[:, :, 3], out=rate)
+    np.exp(rate, out=rate)
+    rate *= parameters['k0']
+    rate *= C[:, :, 0]
+    rate *= C[:, :, 1]
+    np.subtract(C[:, :, 4], C[:, :, 3], out=heat)
+    heat *= parameters['UA']
+
+    # flow term: the feed into the first tank, the previous tank into the rest
+    np.subtract(parameters['inlet'], C[:, 0, :4], out=D[:, 0, :4])
+    np.subtract(C[:, :-1, :4], C[:, 1:, :4], out=D[:, 1:, :4])
+    D[:, :, :4] *= parameters['dilution'][:, :, None]
+
+    D[:, :, 0] -= rate
+    D[:, :, 1] -= rate
+    D[:, :, 2] += rate
+    D[:, :, 2] += rate
+    np.multiply(heat, parameters['glass_heat'], out=D[:, :, 4])
+    heat *= parameters['liquid_heat']
+    D[:, :, 3] += heat
+    rate *= parameters['reaction_heat']
+    D[:, :, 3] += rate
+
+def CSTR_ensemble(T, fv1, fv2, V=500, tspan=[0, 3600], kinetics=None, method='rk4', number_of_points=3600, save_every=10):
+    '''CSTR_model for M cases at once with the fixed step ensemble integrator. T, fv1, fv2, V and the kinetics
+    values can be arrays of length M. number_of_points = steps over tspan (default 1 s steps). \n
+    returns t (seconds) and y with shape (len(t), M, 4)
+    '''
+    from ptplab.integrators import ensemble_master_function
+    params = cstr_ensemble_params(T, fv1, fv2, V=V, kinetics=kinetics)
+    M = len(params['k0'])
+    y0 = np.column_stack([np.full(M, cw_pure), np.zeros(M), np.zeros(M), params['Inlet temperature']])
+    return ensemble_master_function(cstr_ensemble_der_func, tspan, y0, method=method, number_of_points=number_of_points,
+                                    args=(params,), save_every=save_every)
+
+def PBR_ensemble(T, fv1, fv2, V=131, tspan=[0, 3600], n=6, kinetics=None, method='rk4', number_of_points=3600, save_every=10):
+    '''PBR_model for M cases at once with the fixed step ensemble integrator, see CSTR_ensemble.
+    With many tanks the explicit methods need smaller steps (rk4 is stable up to about 2.8 over the
+    dilution rate of one tank, flow/(V/n)). \n
+    returns t (seconds) and y with shape (len(t), M, 5*n)
+    '''
+    from ptplab.integrators import ensemble_master_function
+    params = pbr_ensemble_params(T, fv1, fv2, V=V, n=n, kinetics=kinetics)
+    T_in = params['inlet'][:, 3]
+    y0 = np.tile(np.column_stack([np.full(len(T_in), cw_pure), np.zeros(len(T_in)), np.zeros(len(T_in)), T_in, T_in]), n)
+    return ensemble_master_function(pbr_ensemble_der_func, tspan, y0, method=method, number_of_points=number_of_points,
+                                    args=(params, n), save_every=save_every)
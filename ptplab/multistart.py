@@ -0,0 +1,133 @@
+'''Multi-start version of estimation.fit_kinetics. k0 and Ea are strongly correlated and span many
+orders of magnitude, so a single local fit often ends up in a bad basin. Here the starting points are
+spread over (ln k0, Ea, ln U, n) with a latin hypercube, the local fits run on a process pool and the
+minima they end up in are merged into a ranked table.
+'''
+import csv
+import os
+import numpy as np
+
+from ptplab.estimation import PARAMETERS, fit_kinetics, prepare_runs, to_x
+
+# Search box for the starting points. n is the number of tanks used for the PBR runs.
+SEARCH_SPACE = {
+    'k0': (1e5, 1e17),   # ml/mol/s, sampled on a log scale
+    'Ea': (4e4, 1.2e5),  # J/mol
+    'U': (1e-5, 1e-2),   # W/cm2/K, sampled on a log scale
+    'n': (3, 20),        # tanks in series, integer
+}
+
+def latin_hypercube_starts(n_starts, space=SEARCH_SPACE, seed=None):
+    '''Latin hypercube starting points in (ln k0, Ea, ln U, n). \n
+    n_starts = number of starting points \n
+    space = dictionary with (low, high) for k0, Ea, U and n \n
+    seed = random seed so a search can be repeated \n
+    returns list of dictionaries {'k0', 'Ea', 'U', 'n'}
+    '''
+    from scipy.stats import qmc
+    low = [np.log(space['k0'][0]), space['Ea'][0], np.log(space['U'][0]), space['n'][0] - 0.5]
+    high = [np.log(space['k0'][1]), space['Ea'][1], np.log(space['U'][1]), space['n'][1] + 0.5]
+    sample = qmc.scale(qmc.LatinHypercube(d=4, seed=seed).random(n_starts), low, high)
+    starts = []
+    for ln_k0, Ea, ln_U, n in sample:
+        n = int(np.clip(np.rint(n), space['n'][0], space['n'][1])) # every n gets an equal share of the starts
+        starts.append({'k0': float(np.exp(ln_k0)), 'Ea': float(Ea), 'U': float(np.exp(ln_U)), 'n': n})
+    return starts
+
+_worker_runs = None
+
+def _init_worker(runs):
+    global _worker_runs
+    _worker_runs = runs
+
+def _local_fit(start, fit, options):
+    '''One local fit from one starting point, on a worker process'''
+    return local_fit(_worker_runs, start, fit, **options)
+
+def local_fit(runs, start, fit=PARAMETERS, **options):
+    '''Fits the kinetics from one starting point with the PBR runs modelled as start['n'] tanks. \n
+    returns a summary dictionary (the full least_squares result is left out to keep it small)
+    '''
+    runs = [dict(run, n=start['n']) if run['reactor'] == 'PBR' else run for run in runs]
+    kinetics = {name: start[name] for name in PARAMETERS}
+    try:
+        fitted = fit_kinetics(runs, start=kinetics, fit=fit, processes=1, **options)
+    except (ValueError, np.linalg.LinAlgError) as error: # a start so far off that the fit itself falls over
+        return {'start': start, 'success': False, 'message': str(error)}
+    return {
+        'start': start,
+        'success': bool(fitted['result'].success),
+        'message': fitted['result'].message,
+        'n': start['n'],
+        'kinetics': fitted['kinetics'],
+        'x': fitted['x'],
+        'stderr': fitted['stderr'],
+        'cost': float(fitted['cost']),
+        'nfev': int(fitted['result'].nfev),
+    }
+
+def merge_minima(fits, fit=PARAMETERS, tol=1e-2, space=SEARCH_SPACE):
+    '''Merges local fits that converged to the same minimum and ranks the minima by cost. \n
+    Two fits are the same minimum when they used the same n and every fitted variable (ln k0, Ea, ln U)
+    differs by less than tol times the width of the search box. \n
+    returns list of dictionaries sorted from best to worst, with 'count' = how many starts ended there
+    '''
+    width = to_x({name: space[name][1] for name in fit}, fit) - to_x({name: space[name][0] for name in fit}, fit)
+    minima = []
+    for result in sorted((f for f in fits if f['success']), key=lambda f: f['cost']):
+        for minimum in minima:
+            if minimum['n'] == result['n'] and np.all(np.abs(minimum['x'] - result['x']) < tol*np.abs(width)):
+                minimum['count'] += 1
+                minimum['starts'].append(result['start'])
+                break
+        else:
+            minima.append(dict(result, count=1, starts=[result['start']]))
+    for rank, minimum in enumerate(minima, start=1):
+        minimum['rank'] = rank
+    return minima
+
+def multistart_fit(runs=None, n_starts=32, fit=PARAMETERS, space=SEARCH_SPACE, seed=None, processes=None, tol=1e-2, t_max=None, **options):
+    '''Runs local kinetic fits from latin hypercube starting points concurrently and ranks the minima. \n
+    runs = catalog entries or prepared runs (default: every run without a step change) \n
+    n_starts = number of starting points \n
+    fit = which of 'k0', 'Ea', 'U' to fit (n is always taken from the starting point) \n
+    space = search box, see SEARCH_SPACE \n
+    seed = random seed for the latin hypercube \n
+    processes = worker processes (default all cores) \n
+    tol = relative distance below which two minima are merged \n
+    other keyword arguments are passed on to least_squares \n
+    returns (ranked table of minima, list with every local fit)
+    '''
+    runs = prepare_runs(runs, t_max=t_max)
+    starts = latin_hypercube_starts(n_starts, space=space, seed=seed)
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    if processes > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(runs,)) as pool:
+            futures = [pool.submit(_local_fit, start, fit, options) for start in starts]
+            fits = [future.result() for future in futures]
+    else:
+        fits = [local_fit(runs, start, fit, **options) for start in starts]
+    return merge_minima(fits, fit=fit, tol=tol, space=space), fits
+
+def write_table(minima, path):
+    '''Writes the ranked minima to a csv file'''
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['rank', 'cost', 'count', 'n', 'k0', 'Ea', 'U', 'stderr_k0', 'stderr_Ea', 'stderr_U'])
+        for minimum in minima:
+            kinetics = minimum['kinetics']
+            stderr = minimum['stderr']
+            writer.writerow([minimum['rank'], minimum['cost'], minimum['count'], minimum['n'],
+                             kinetics['k0'], kinetics['Ea'], kinetics['U'],
+                             stderr.get('k0', ''), stderr.get('Ea', ''), stderr.get('U', '')])
+
+
+if __name__ == '__main__':
+    minima, fits = multistart_fit(n_starts=16, seed=0)
+    print(f'{len(fits)} starts ended in {len(minima)} different minima')
+    for minimum in minima[:10]:
+        kinetics = minimum['kinetics']
+        print(f"{minimum['rank']:3d}  cost {minimum['cost']:10.2f}  n={minimum['n']:2d}  k0={kinetics['k0']:.3e}  Ea={kinetics['Ea']:.4e}  U={kinetics['U']:.3e}  ({minimum['count']} starts)")
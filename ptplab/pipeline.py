@@ -0,0 +1,295 @@
+'''Incremental analysis: raw csv -> extraction -> calibration -> fit -> model solve -> figure as a make-like graph. \n
+Every node is keyed by a hash of its parameters, the source of its code and the keys of the nodes it depends on
+(for raw files, and the probe calibration table, the hash of the file content). Results are pickled in the cache
+directory under that key, so a build only recomputes the nodes whose key changed and everything downstream of
+them. Changing a calibration point only redoes that calibration and the concentrations that use it. A new run
+adds its own extraction, conversion and figure, but it also changes the global fit, so every fitted model and
+figure is redone. An extraction depends on the entry of its own run in the probe health history, so taking a
+new run into the history does not redo the runs that were already there. \n
+    lab = lab_pipeline()
+    results = lab.build(['fit', 'figure:PBR 40c'])
+    lab.log # [(node, 'cached' or 'built'), ...]
+'''
+import importlib
+import inspect
+import json
+import os
+import pickle
+
+import numpy as np
+
+from ptplab import DATA_DIR
+
+DEFAULT_CACHE = '.ptplab_cache'
+CONDUCTIVITY_TAGS = {'CSTR': 'Q210_PV', 'PBR': 'QT210_PV'}
+
+def _hash(*parts):
+    import hashlib
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(part if isinstance(part, bytes) else str(part).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+def _plain(value):
+    return np.asarray(value).tolist() if isinstance(value, (np.ndarray, np.generic)) else repr(value)
+
+def params_hash(params):
+    return _hash(json.dumps(params, sort_keys=True, default=_plain))
+
+def code_version(function, code=()):
+    '''Hash of the source of function and of the code it relies on: functions, or modules by name (like
+    'ptplab.models') when it relies on more of them than a few functions'''
+    sources = [inspect.getsource(function)]
+    for item in code:
+        if isinstance(item, str):
+            with open(importlib.import_module(item).__file__, 'rb') as file:
+                sources.append(file.read())
+        else:
+            sources.append(inspect.getsource(item))
+    return _hash(*sources)
+
+class Pipeline:
+    '''Graph of named nodes. A node is function(*values of its inputs, *paths of its files, **params, **options). \n
+    cache_dir = directory for the pickled results and the file hash cache
+    '''
+    def __init__(self, cache_dir=DEFAULT_CACHE):
+        self.cache_dir = cache_dir
+        self.nodes = {}
+        self.log = []
+        self._file_hashes = None
+
+    def add(self, name, function, inputs=(), params=None, files=(), code=(), options=None, depends=None, produces=False):
+        '''Adds a node. \n
+        name = node name, other nodes refer to it in their inputs \n
+        function = module level function computing the node \n
+        inputs = names of the nodes whose values are passed to function, in order \n
+        params = keyword arguments of function that are part of the key (must be JSON like) \n
+        files = paths passed after the inputs, their content is part of the key \n
+        code = functions, or module names, whose source is part of the key besides the source of function \n
+        options = keyword arguments that do not change the result (like processes), left out of the key \n
+        depends = JSON like value that decides the result without being an argument of function (part of the key) \n
+        produces = the value is the path of a file the node writes, a cached value whose file is gone is rebuilt
+        '''
+        if name in self.nodes:
+            raise ValueError(f'node {name!r} already exists')
+        for dependency in inputs:
+            if dependency not in self.nodes:
+                raise KeyError(f'node {name!r} depends on unknown node {dependency!r}')
+        self.nodes[name] = {'function': function, 'inputs': tuple(inputs), 'params': dict(params or {}),
+                            'files': tuple(files), 'code': tuple(code), 'options': dict(options or {}),
+                            'depends': depends, 'produces': produces}
+
+    def file_hash(self, path):
+        '''Content hash of a file, remembered per (size, modification time) so unchanged files are not read again'''
+        index_path = os.path.join(self.cache_dir, 'files.json')
+        if self._file_hashes is None:
+            self._file_hashes = {}
+            if os.path.exists(index_path):
+                with open(index_path) as file:
+                    self._file_hashes = json.load(file)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        known = self._file_hashes.get(os.path.abspath(path))
+        if known is not None and known[0] == stamp:
+            return known[1]
+        import hashlib
+        sha = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+        self._file_hashes[os.path.abspath(path)] = [stamp, sha.hexdigest()]
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(index_path, 'w') as file:
+            json.dump(self._file_hashes, file)
+        return sha.hexdigest()
+
+    def keys(self):
+        '''Key of every node, upstream keys are folded into the downstream ones'''
+        keys = {}
+        def key(name):
+            if name not in keys:
+                node = self.nodes[name]
+                keys[name] = _hash(name, code_version(node['function'], node['code']), params_hash(node['params']),
+                                   params_hash(node['depends']),
+                                   *[key(dependency) for dependency in node['inputs']],
+                                   *[self.file_hash(path) for path in node['files']])
+            return keys[name]
+        for name in self.nodes:
+            key(name)
+        return keys
+
+    def downstream(self, name):
+        '''Every node that depends on name, directly or through other nodes'''
+        found = set()
+        changed = True
+        while changed:
+            changed = False
+            for other, node in self.nodes.items():
+                if other not in found and (name in node['inputs'] or found.intersection(node['inputs'])):
+                    found.add(other)
+                    changed = True
+        return found
+
+    def _path(self, name, key):
+        from ptplab.cli import safe_name
+        return os.path.join(self.cache_dir, safe_name(name), f'{key}.pkl')
+
+    def _cached(self, name, key):
+        '''Cached value of a node (None, False when there is none)'''
+        path = self._path(name, key)
+        if not os.path.exists(path):
+            return None, False
+        with open(path, 'rb') as file:
+            value = pickle.load(file)
+        if self.nodes[name]['produces'] and not (isinstance(value, str) and os.path.exists(value)):
+            return None, False # the file the node wrote was removed
+        return value, True
+
+    def outdated(self, targets=None):
+        '''Nodes that a build of targets (default every node) would compute, dependencies first'''
+        keys = self.keys()
+        order = []
+        def visit(name):
+            if name in order or self._cached(name, keys[name])[1]:
+                return # a cached node does not need its inputs
+            for dependency in self.nodes[name]['inputs']:
+                visit(dependency)
+            order.append(name)
+        for name in (self.nodes if targets is None else targets):
+            visit(name)
+        return order
+
+    def build(self, targets=None):
+        '''Computes the targets (default every node), reusing cached results of unchanged nodes. \n
+        returns dictionary {node: value} of the targets, self.log tells which nodes were cached or built
+        '''
+        keys = self.keys()
+        self.log = []
+        values = {}
+
+        def value(name):
+            if name in values:
+                return values[name]
+            node = self.nodes[name]
+            path = self._path(name, keys[name])
+            cached, found = self._cached(name, keys[name])
+            if found: # a cached node does not need its inputs
+                values[name] = cached
+                self.log.append((name, 'cached'))
+                return cached
+            arguments = [value(dependency) for dependency in node['inputs']] + list(node['files'])
+            result = node['function'](*arguments, **node['params'], **node['options'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as file:
+                pickle.dump(result, file)
+            os.replace(path + '.tmp', path) # a build that is killed halfway leaves no broken cache entry
+            values[name] = result
+            self.log.append((name, 'built'))
+            return result
+
+        return {name: value(name) for name in (self.nodes if targets is None else targets)}
+
+    def clean(self):
+        '''Removes cached results that no longer match the current key of their node'''
+        keys = self.keys()
+        removed = []
+        for name in self.nodes:
+            folder = os.path.dirname(self._path(name, keys[name]))
+            if not os.path.isdir(folder):
+                continue
+            for file_name in os.listdir(folder):
+                if file_name != f'{keys[name]}.pkl':
+                    os.remove(os.path.join(folder, file_name))
+                    removed.append(os.path.join(folder, file_name))
+        return removed
+
+# Node functions of the lab pipeline
+
+def extract_node(path, *probe_files, entry):
+    '''Probe temperatures and flows of a run (catalog.load_catalog_run), path is the file of the run and
+    probe_files the probe calibration table when there is one'''
+    from ptplab.catalog import load_catalog_run
+    from ptplab.probes import TABLE_PATH
+    return load_catalog_run(dict(entry, file=os.path.relpath(path, DATA_DIR)), probe_table='latest' if TABLE_PATH in probe_files else None)
+
+def calibration_node(cal_cond, cal_conc):
+    '''Calibration of one reactor, a calibration.ConductivityCalibration'''
+    from ptplab.calibration import ConductivityCalibration
+    return ConductivityCalibration(cal_cond, cal_conc)
+
+def concentration_node(calibration, path, tag):
+    '''Acetic acid concentration (mol/L) from the conductivity of a run, converted like every other tool does
+    (calibration.runs_concentration without compensation)'''
+    from ptplab.historian import load_run
+    series = load_run(path, tags=[tag])['tags'][tag]
+    return {'elapsed_time': series['elapsed_time'], 'conductivity': series['values'],
+            'c_aa': calibration.concentration(series['values'])}
+
+def fit_node(*runs, start=None, fit=None, processes=None):
+    '''Global fit of the kinetics against the extracted runs, the picklable part of estimation.fit_kinetics'''
+    from ptplab.estimation import PARAMETERS, fit_kinetics
+    fitted = fit_kinetics(list(runs), start=start, fit=fit or PARAMETERS, processes=processes)
+    return {name: fitted[name] for name in ('kinetics', 'fit', 'stderr', 'cov', 'cost', 'run_rms')}
+
+def solve_node(run, fitted):
+    '''Model of a run at the fitted kinetics, (time in minutes, {probe: temperature in C})'''
+    from ptplab.estimation import simulate_run
+    t, temps, _ = simulate_run(run, fitted['kinetics'])
+    if temps is None:
+        return None, None
+    return t, {probe: temp - 273.15 for probe, temp in temps.items()}
+
+def figure_node(run, model, output='.'):
+    '''Probes against the fitted model (report.probes_figure), returns the png path'''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from ptplab.cli import safe_name
+    from ptplab.report import probes_figure
+    os.makedirs(output, exist_ok=True)
+    fig = probes_figure(plt, run, {run['V']: model})
+    path = os.path.join(output, f"pipeline_{safe_name(run['name'])}.png")
+    fig.savefig(path, dpi=100)
+    plt.close(fig)
+    return path
+
+def lab_pipeline(runs=None, start=None, fit_parameters=None, calibration=None, cache_dir=DEFAULT_CACHE, output='.', processes=None):
+    '''The analysis of the lab as a Pipeline. \n
+    runs = catalog entries (default every run without a step change) \n
+    start = starting kinetics of the fit (default PBR_KINETICS) \n
+    fit_parameters = which of 'k0', 'Ea', 'U' to fit (default all three) \n
+    calibration = {reactor: (conductivities, concentrations)} (default the points in calibration.py) \n
+    output = directory of the figures \n
+    Nodes: raw csv files are inputs of 'extract:<run>' and 'conc:<run>', 'calibration:<reactor>', 'fit',
+    'solve:<run>' and 'figure:<run>'.
+    '''
+    from ptplab.calibration import CSTR_CAL_COND, CSTR_CAL_CONC, PBR_CAL_COND, PBR_CAL_CONC, ConductivityCalibration, fit_calibration
+    from ptplab.catalog import run_path, select_runs
+    from ptplab.health import run_key
+    from ptplab.probes import TABLE_PATH
+    if runs is None:
+        runs = select_runs()
+    if calibration is None:
+        calibration = {'CSTR': (CSTR_CAL_COND, CSTR_CAL_CONC), 'PBR': (PBR_CAL_COND, PBR_CAL_CONC)}
+
+    probe_files = [TABLE_PATH] if os.path.exists(TABLE_PATH) else []
+
+    lab = Pipeline(cache_dir)
+    for reactor, (cal_cond, cal_conc) in calibration.items():
+        lab.add(f'calibration:{reactor}', calibration_node, params={'cal_cond': list(cal_cond), 'cal_conc': list(cal_conc)},
+                code=(ConductivityCalibration, fit_calibration))
+    for entry in runs:
+        health = run_key(entry['name'], lab.file_hash(run_path(entry))) if entry['reactor'] == 'PBR' else None
+        lab.add(f"extract:{entry['name']}", extract_node, params={'entry': entry}, files=[run_path(entry)] + probe_files,
+                code=('ptplab.catalog', 'ptplab.historian', 'ptplab.probes', 'ptplab.health'), depends=health)
+        lab.add(f"conc:{entry['name']}", concentration_node, inputs=[f"calibration:{entry['reactor']}"], files=[run_path(entry)],
+                params={'tag': CONDUCTIVITY_TAGS[entry['reactor']]}, code=(ConductivityCalibration, 'ptplab.historian'))
+    lab.add('fit', fit_node, inputs=[f"extract:{entry['name']}" for entry in runs],
+            params={'start': start, 'fit': list(fit_parameters) if fit_parameters else None},
+            code=('ptplab.estimation', 'ptplab.models'), options={'processes': processes})
+    for entry in runs:
+        lab.add(f"solve:{entry['name']}", solve_node, inputs=[f"extract:{entry['name']}", 'fit'], code=('ptplab.estimation', 'ptplab.models'))
+        lab.add(f"figure:{entry['name']}", figure_node, inputs=[f"extract:{entry['name']}", f"solve:{entry['name']}"],
+                params={'output': output}, code=('ptplab.report',), produces=True)
+    return lab
@@ -0,0 +1,214 @@
+'''Calibration of the PBR temperature probes T201_PV..T208_PV against the water bath T400_PV. \n
+PBR_model.py fits np.polyfit(probe, bath, 1) per probe in a loop on the first sample of every file, every time
+it runs. Here the isothermal windows without reaction (before the start, water only periods, after the run)
+are detected in all runs at once on flat arrays, and every probe is fitted on all of their samples in one
+batched weighted least squares solve (normal equations of shape (probes, degree + 1, degree + 1)). The result is
+stored as a versioned table in probe_calibration.json next to the data, and catalog.load_catalog_run applies the
+latest version when it reads a run, so the fit is done once and used by every tool. \n
+    table = build_table()
+    save_table(table) # appended as a new version, unless the same fit is already the latest one
+'''
+import datetime
+import json
+import os
+
+import numpy as np
+
+from ptplab import DATA_DIR
+from ptplab.historian import START_TAG, START_THRESHOLD
+from ptplab.models import PBR_PROBES
+
+REFERENCE_TAG = 'T400_PV' # water bath
+TABLE_PATH = os.path.join(DATA_DIR, 'probe_calibration.json')
+DEGREE = 1
+# Isothermal window detection
+WINDOW = 4 # samples (about a minute)
+BATH_TOLERANCE = 1 # C, the bath is logged in whole degrees and flickers by one
+PROBE_TOLERANCE = 0.3 # C, largest change of a probe within a window
+MIN_SAMPLES = 2 # a window at the very start of a file may be shorter, but not a single sample
+SETTLE = 15 # minutes after the AAH pump was last on, about three residence times of the bed
+QUANTIZATION = 1/np.sqrt(12) # C, std of rounding the bath to whole degrees
+SEGMENT_SAMPLES = 20 # most samples a single isothermal segment counts as
+
+_tables = {} # path -> (modification time, contents), the table is read once per process
+
+def stack_runs(runs, probes=PBR_PROBES):
+    '''Puts the runs end to end on the time stamps of the bath so the detection works on flat arrays, the
+    loop is over runs and tags only. \n
+    runs = list of historian.load_run outputs \n
+    returns dictionary with 'run' (index of the run of every sample), 'time' (minutes), 'flow' (AAH pump),
+    'reference' (bath), 'readings' (probes, N) and 'present' (probes, N) False where a run has no such probe
+    '''
+    parts = {'run': [], 'time': [], 'flow': [], 'reference': [], 'readings': [], 'present': []}
+    for i, run in enumerate(runs):
+        if REFERENCE_TAG not in run['tags']:
+            continue
+        reference = run['tags'][REFERENCE_TAG]
+        times = reference['elapsed_time']
+        def on_grid(tag):
+            series = run['tags'][tag]
+            return np.interp(times, series['elapsed_time'], series['values'])
+        parts['run'].append(np.full(len(times), i))
+        parts['time'].append(times)
+        parts['flow'].append(on_grid(START_TAG) if START_TAG in run['tags'] else np.zeros(len(times)))
+        parts['reference'].append(reference['values'])
+        parts['readings'].append(np.array([on_grid(probe) if probe in run['tags'] else np.zeros(len(times)) for probe in probes]))
+        parts['present'].append(np.array([np.full(len(times), probe in run['tags']) for probe in probes]))
+    return {key: np.concatenate(value, axis=-1) for key, value in parts.items()}
+
+def _windows(run, window):
+    '''Indices (N, window) of the window ending at every sample, clipped at the first sample of its run so a
+    window never reaches into the run before. Also returns how many distinct samples every window holds.'''
+    index = np.arange(len(run))
+    first = np.maximum.accumulate(np.where(np.concatenate([[True], run[1:] != run[:-1]]), index, 0))
+    windows = np.maximum(index[:, None] - np.arange(window)[None, :], first[:, None])
+    return windows, np.minimum(index - first + 1, window), first
+
+def detect_isothermal(stacked, window=WINDOW, bath_tolerance=BATH_TOLERANCE, probe_tolerance=PROBE_TOLERANCE, settle=SETTLE):
+    '''Marks the samples that sit in an isothermal window without reaction: the AAH pump is off and has been
+    off for settle minutes (before the start, water only periods, after a run once the bed is flushed) and the
+    bath and every probe stay within their tolerance over the window. Works on all runs at once. \n
+    returns mask (N,) of isothermal samples and the segment number of every sample (-1 outside)
+    '''
+    run = stacked['run']
+    index = np.arange(len(run))
+    windows, filled, first = _windows(run, window)
+    pump_on = stacked['flow'] >= START_THRESHOLD
+    last_on = np.maximum.accumulate(np.where(pump_on, index, -1))
+    settled = (last_on < first) | (stacked['time'] - stacked['time'][np.maximum(last_on, 0)] >= settle)
+    readings = np.where(stacked['present'], stacked['readings'], 0)
+    good = ((filled >= MIN_SAMPLES) & np.all(settled[windows], axis=1)
+            & (np.ptp(stacked['reference'][windows], axis=1) <= bath_tolerance)
+            & np.all(np.ptp(readings[:, windows], axis=2) <= probe_tolerance, axis=0))
+
+    # every sample of a good window is isothermal
+    mask = np.zeros(len(run), dtype=bool)
+    mask[windows[good].ravel()] = True
+    starts = mask & ~np.concatenate([[False], mask[:-1] & (run[1:] == run[:-1])])
+    segment = np.where(mask, np.cumsum(starts) - 1, -1)
+    return mask, segment
+
+def isothermal_weights(stacked, mask, segment, window=WINDOW):
+    '''Weights of the isothermal samples for the fit (probes, N). Every sample counts with the inverse of its
+    local variance (probe noise plus the 1 C steps of the bath). A segment counts at most as SEGMENT_SAMPLES
+    samples, so a long water only period does not drown the short ones at other temperatures.'''
+    windows, _, _ = _windows(stacked['run'], window)
+    local_var = np.var(stacked['readings'][:, windows], axis=2) + np.var(stacked['reference'][windows], axis=1) + QUANTIZATION**2
+    counts = np.bincount(segment[mask], minlength=segment.max() + 1) if np.any(mask) else np.zeros(0)
+    scale = np.zeros(len(mask))
+    scale[mask] = np.minimum(1, SEGMENT_SAMPLES/counts[segment[mask]])
+    return np.where(stacked['present'], scale/local_var, 0)
+
+def fit_probes(readings, reference, weights=None, degree=DEGREE):
+    '''Weighted polynomial fits reference = polyval(coefficients, reading - center) for every probe in one solve. \n
+    readings = (probes, N) probe readings, reference = (N,) or (probes, N) true temperatures \n
+    weights = (probes, N) sample weights (default 1) \n
+    returns coefficients (probes, degree + 1) highest power first like np.polyfit, the center (mean reading) of
+    every probe, residual std and r^2 per probe
+    '''
+    readings = np.asarray(readings, dtype=float)
+    reference = np.broadcast_to(np.asarray(reference, dtype=float), readings.shape)
+    weights = np.ones_like(readings) if weights is None else np.asarray(weights, dtype=float)
+    weights = weights/np.max(weights, axis=1, keepdims=True) # only the relative weights matter, keeps the sums tame
+    # center the readings so the normal equations stay well conditioned at 20-40 C
+    center = np.sum(weights*readings, axis=1)/np.sum(weights, axis=1)
+    X = np.power((readings - center[:, None])[:, :, None], np.arange(degree, -1, -1)) # (probes, N, degree + 1)
+    A = np.einsum('pni,pn,pnj->pij', X, weights, X)
+    b = np.einsum('pni,pn,pn->pi', X, weights, reference)
+    coefficients = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+
+    predicted = np.einsum('pni,pi->pn', X, coefficients)
+    total = np.sum(weights, axis=1)
+    residual_std = np.sqrt(np.sum(weights*(reference - predicted)**2, axis=1)/total) # weighted rms
+    mean = np.sum(weights*reference, axis=1)/total
+    r2 = 1 - np.sum(weights*(reference - predicted)**2, axis=1)/np.sum(weights*(reference - mean[:, None])**2, axis=1)
+    return coefficients, center, residual_std, r2
+
+def file_hash(path):
+    import hashlib
+    sha = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def build_table(entries=None, paths=None, degree=DEGREE, probes=PBR_PROBES, window=WINDOW):
+    '''Fits every probe on the isothermal samples of all runs. \n
+    entries = catalog entries (default every PBR run, step change runs included) \n
+    paths = historian files to use instead of catalog entries \n
+    returns the table (dictionary) without a version, see save_table
+    '''
+    from ptplab.catalog import run_path, select_runs
+    from ptplab.historian import load_run
+    if paths is None:
+        if entries is None:
+            entries = select_runs('PBR', step_change=None)
+        names = [entry['name'] for entry in entries]
+        paths = [run_path(entry) for entry in entries]
+    else:
+        names = [os.path.basename(path) for path in paths]
+    stacked = stack_runs([load_run(path, tags=list(probes) + [REFERENCE_TAG, START_TAG]) for path in paths], probes)
+    mask, segment = detect_isothermal(stacked, window=window)
+    weights = isothermal_weights(stacked, mask, segment, window=window)
+    coefficients, center, residual_std, r2 = fit_probes(stacked['readings'], stacked['reference'], weights, degree=degree)
+    return {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'degree': degree,
+        'reference': REFERENCE_TAG,
+        'sources': {name: file_hash(path) for name, path in zip(names, paths)},
+        'segments': int(segment.max() + 1),
+        'probes': {probe: {'coefficients': coefficients[p].tolist(), 'center': float(center[p]),
+                           'residual_std': float(residual_std[p]), 'r2': float(r2[p]), 'samples': int(np.count_nonzero(weights[p]))}
+                   for p, probe in enumerate(probes)},
+    }
+
+def save_table(table, path=TABLE_PATH):
+    '''Appends the table to the file as the next version, unless the latest version has the same degree,
+    sources and coefficients. returns the stored table (with its 'version')'''
+    versions = []
+    if os.path.exists(path):
+        with open(path) as file:
+            versions = json.load(file)['versions']
+    if versions:
+        latest = versions[-1]
+        if all(latest[key] == table[key] for key in ('degree', 'reference', 'sources')) and \
+                all(np.allclose(latest['probes'][probe]['coefficients'], values['coefficients'])
+                    for probe, values in table['probes'].items() if probe in latest['probes']):
+            return latest
+    table = dict(table, version=len(versions) + 1)
+    versions.append(table)
+    with open(path, 'w') as file:
+        json.dump({'versions': versions}, file, indent=1)
+    _tables.pop(path, None)
+    return table
+
+def load_table(path=TABLE_PATH, version=None):
+    '''Calibration table from the file, the latest version by default. None when there is no file.'''
+    if not os.path.exists(path):
+        return None
+    stamp = os.stat(path).st_mtime_ns
+    if path not in _tables or _tables[path][0] != stamp:
+        with open(path) as file:
+            _tables[path] = (stamp, json.load(file)['versions'])
+    versions = _tables[path][1]
+    if version is None:
+        return versions[-1]
+    for table in versions:
+        if table['version'] == version:
+            return table
+    raise KeyError(f'no probe calibration version {version} in {path}')
+
+def apply_table(tags, table):
+    '''Corrects the probe values of historian.load_run tags in place, returns tags'''
+    for probe, values in table['probes'].items():
+        if probe in tags:
+            tags[probe]['values'] = np.polyval(values['coefficients'], tags[probe]['values'] - values['center'])
+    return tags
+
+
+if __name__ == '__main__':
+    table = save_table(build_table())
+    print(f"probe calibration version {table['version']} ({len(table['sources'])} runs, {table['segments']} isothermal segments)")
+    for probe, values in table['probes'].items():
+        print(f"{probe}: coefficients {np.round(values['coefficients'], 4)} around {values['center']:.2f} C, residual std {values['residual_std']:.3f} C, "
+              f"r^2 {values['r2']:.4f}, {values['samples']} samples")
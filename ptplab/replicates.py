@@ -0,0 +1,183 @@
+'''Replicate statistics for runs made at the same condition. \n
+CSTR_Plotting_error_bars.py averages two 27 C runs: hand picked index slices of both files, np.union1d of their
+time stamps and np.interp of each onto it. Here the catalog runs are grouped by condition (reactor, volume,
+inlet temperature and flows within a tolerance, measured like load_catalog_run takes them), every run is
+aligned on its detected start (historian elapsed time) and cut at its first step change, and all replicates and
+tags are interpolated onto one common grid in a single batched searchsorted. Mean, standard deviation, Student t
+confidence interval, median and quantile bands are then reductions over the replicate axis of one array
+(replicates, tags, grid). Grid points a replicate does not reach are NaN, the statistics use the replicates
+that are there. \n
+    for group in replicate_groups():
+        stats = aggregate(group)
+'''
+import warnings
+
+import numpy as np
+
+from ptplab.historian import START_TAG
+from ptplab.models import CSTR_PROBE, PBR_PROBES
+
+TEMPERATURE_TOLERANCE = 1.5 # C, inlet temperatures of replicates
+FLOW_TOLERANCE = 0.1 # relative, the flow meters of the water pump are noisy
+STEP = 0.25 # minutes between grid points (the historian logs about every 15 s)
+CONFIDENCE = 0.95
+QUANTILES = (0.1, 0.5, 0.9)
+TAGS = {'CSTR': [CSTR_PROBE, 'Q210_PV'], 'PBR': PBR_PROBES + ['QT210_PV']}
+
+def run_condition(entry, run):
+    '''Condition of a run like load_catalog_run measures it: minimum of T200_PV and median flows after the start'''
+    tags = run['tags']
+    after_start = lambda tag: tags[tag]['values'][tags[tag]['elapsed_time'] >= 0]
+    return {'reactor': entry['reactor'], 'V': entry['V'], 'n': entry.get('n'), 'T_in': float(np.min(tags['T200_PV']['values'])),
+            'fv_water': float(np.median(after_start('P100_Flow'))), 'fv_aah': float(np.median(after_start(START_TAG)))}
+
+def same_condition(a, b, temperature_tolerance=TEMPERATURE_TOLERANCE, flow_tolerance=FLOW_TOLERANCE):
+    return (all(a[key] == b[key] for key in ('reactor', 'V', 'n'))
+            and abs(a['T_in'] - b['T_in']) <= temperature_tolerance
+            and all(abs(a[key] - b[key]) <= flow_tolerance*max(abs(a[key]), abs(b[key])) for key in ('fv_water', 'fv_aah')))
+
+def first_change(entry):
+    '''Minutes from the start to the first step change of a run, None for a run without one'''
+    times = [value for key, value in entry.get('steps', {}).items() if key.startswith('t_change')]
+    return min(times)/60 if entry['step_change'] and times else None
+
+def replicate_groups(entries=None, temperature_tolerance=TEMPERATURE_TOLERANCE, flow_tolerance=FLOW_TOLERANCE, min_replicates=2,
+                     probe_table='latest'):
+    '''Groups catalog runs made at the same condition. A step change run counts up to its first change. \n
+    entries = catalog entries (default every run, step change runs included) \n
+    min_replicates = smallest group returned \n
+    probe_table = probe calibration applied to the temperatures, as in load_catalog_run \n
+    returns list of groups: dictionary with 'name', 'condition' (of the first run), 'members' (catalog entries),
+    'runs' (historian.load_run outputs) and 'ends' (minutes after the start each run can be used up to, None = all)
+    '''
+    from ptplab.catalog import RUNS, run_path
+    from ptplab.historian import load_run
+    if probe_table == 'latest' or isinstance(probe_table, int):
+        from ptplab.probes import load_table
+        probe_table = load_table(version=None if probe_table == 'latest' else probe_table)
+    groups = []
+    for entry in RUNS if entries is None else entries:
+        run = load_run(run_path(entry), calibration=probe_table)
+        if not run['start_detected']: # nothing to align on
+            continue
+        condition = run_condition(entry, run)
+        for group in groups:
+            if same_condition(group['condition'], condition, temperature_tolerance, flow_tolerance):
+                break
+        else:
+            group = {'condition': condition, 'members': [], 'runs': [], 'ends': []}
+            groups.append(group)
+        group['members'].append(entry)
+        group['runs'].append(run)
+        group['ends'].append(first_change(entry))
+    for group in groups:
+        condition = group['condition']
+        group['name'] = f"{condition['reactor']} {condition['T_in']:.0f}c {condition['fv_water']:.0f}/{condition['fv_aah']:.1f} ml/min"
+    return [group for group in groups if len(group['members']) >= min_replicates]
+
+def batched_interp(grid, series):
+    '''np.interp of many series onto one grid in a single searchsorted, NaN outside the range of each series. \n
+    series = list of (times, values), the times of every series ascending \n
+    returns array (len(series), len(grid))
+    '''
+    grid = np.asarray(grid, dtype=float)
+    out = np.full((len(series), len(grid)), np.nan)
+    used = [j for j, (times, _) in enumerate(series) if len(times) >= 2] # shorter series stay NaN
+    if not used:
+        return out
+    lengths = np.array([len(series[j][0]) for j in used])
+    times = np.concatenate([np.asarray(series[j][0], dtype=float) for j in used])
+    values = np.concatenate([np.asarray(series[j][1], dtype=float) for j in used])
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    # every series gets its own stretch of one sorted axis, so one searchsorted finds all the intervals
+    base = min(times.min(), grid.min())
+    span = max(times.max(), grid.max()) - base + 1
+    row = np.repeat(np.arange(len(used)), lengths)
+    keys = row*span + (times - base)
+    queries = np.arange(len(used))[:, None]*span + (grid - base)[None, :]
+    lo = np.clip(np.searchsorted(keys, queries, side='right') - 1, starts[:, None], (ends - 2)[:, None])
+    hi = lo + 1
+    width = keys[hi] - keys[lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = np.where(width > 0, (queries - keys[lo])/width, 0)
+    inside = (queries >= keys[starts][:, None]) & (queries <= keys[ends - 1][:, None])
+    out[used] = np.where(inside, values[lo] + weight*(values[hi] - values[lo]), np.nan)
+    return out
+
+def aggregate(group, tags=None, step=STEP, t_max=None, baseline=False, confidence=CONFIDENCE, quantiles=QUANTILES):
+    '''Statistics of the replicates of one group on a common grid. \n
+    group = one of replicate_groups \n
+    tags = historian tags (default TAGS of the reactor), a replicate without a tag is NaN there \n
+    step = grid spacing in minutes, t_max = end of the grid (default the last minute any replicate reaches) \n
+    baseline = subtract the mean of every replicate and tag before the start (rises instead of values) \n
+    returns dictionary with 'time' (grid, min), 'tags', 'members' (names), 'values' (replicates, tags, grid) and per
+    tag and grid point 'n', 'mean', 'std', 'ci' (low and high of the confidence interval of the mean), 'median'
+    and 'bands' (one row per quantile), shapes (tags, grid) and (2 or quantiles, tags, grid)
+    '''
+    tags = list(TAGS[group['condition']['reactor']] if tags is None else tags)
+    series = []
+    for run, end in zip(group['runs'], group['ends']):
+        for tag in tags:
+            if tag not in run['tags']:
+                series.append((np.zeros(0), np.zeros(0)))
+                continue
+            times, values = run['tags'][tag]['elapsed_time'], run['tags'][tag]['values']
+            if baseline:
+                before = times <= 0
+                values = values - (np.mean(values[before]) if np.any(before) else values[0])
+            keep = times >= 0 if end is None else (times >= 0) & (times <= end)
+            series.append((times[keep], values[keep]))
+    if t_max is None:
+        t_max = max((times[-1] for times, _ in series if len(times)), default=0)
+    grid = np.arange(0, t_max + step/2, step)
+    values = batched_interp(grid, series).reshape(len(group['runs']), len(tags), len(grid))
+
+    present = np.isfinite(values)
+    n = np.sum(present, axis=0)
+    total = np.sum(np.where(present, values, 0), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n > 0, total/n, np.nan)
+        std = np.sqrt(np.sum(np.where(present, (values - mean)**2, 0), axis=0)/(n - 1))
+    std[n < 2] = np.nan
+    from scipy.stats import t as student
+    half_width = student.ppf((1 + confidence)/2, np.maximum(n - 1, 1))*std/np.sqrt(np.maximum(n, 1))
+    with warnings.catch_warnings(): # grid points no replicate reaches
+        warnings.simplefilter('ignore', RuntimeWarning)
+        bands = np.nanquantile(values, quantiles, axis=0)
+        median = np.nanmedian(values, axis=0)
+    return {'name': group['name'], 'members': [entry['name'] for entry in group['members']], 'tags': tags, 'time': grid,
+            'values': values, 'n': n, 'mean': mean, 'std': std, 'ci': np.stack([mean - half_width, mean + half_width]),
+            'median': median, 'quantiles': np.asarray(quantiles), 'bands': bands, 'confidence': confidence}
+
+def replicates_figure(plt, stats, tag, every=4):
+    '''Mean with standard deviation error bars (every few grid points), the confidence band and the replicates,
+    like CSTR_Plotting_error_bars.py'''
+    j = stats['tags'].index(tag)
+    t = stats['time']
+    fig, axis = plt.subplots(figsize=(10, 6))
+    axis.fill_between(t, stats['ci'][0, j], stats['ci'][1, j], color='#1f77b4', alpha=0.2,
+                      label=f"{stats['confidence']:.0%} confidence interval")
+    axis.errorbar(t[::every], stats['mean'][j, ::every], yerr=stats['std'][j, ::every], fmt='-o', color='#1f77b4', capsize=4,
+                  elinewidth=1.5, markerfacecolor='white', markeredgewidth=2, label='Average')
+    for values, name, style in zip(stats['values'][:, j], stats['members'], ['--', ':', '-.'] * len(stats['members'])):
+        axis.plot(t, values, linestyle=style, alpha=0.8, linewidth=2, label=name)
+    axis.set_xlabel('Time (minutes)', fontsize=14)
+    axis.set_ylabel(tag, fontsize=14)
+    axis.set_title(f"{stats['name']}: {len(stats['members'])} replicates", fontsize=16, weight='bold')
+    axis.grid(True, which='both', linestyle='--', alpha=0.6)
+    axis.legend(fontsize=12)
+    fig.tight_layout()
+    return fig
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    for group in replicate_groups():
+        stats = aggregate(group)
+        both = stats['n'] >= 2
+        spread = ', '.join(f"{tag} {np.nanmax(np.where(both[j], stats['std'][j], np.nan)):.2f}" for j, tag in enumerate(stats['tags'])
+                           if np.any(both[j]))
+        print(f"{stats['name']}: {', '.join(stats['members'])}; largest std {spread}")
+        replicates_figure(plt, stats, stats['tags'][0])
+    plt.show()
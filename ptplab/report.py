@@ -0,0 +1,212 @@
+'''Report figures for every run, rendered headless on a process pool. \n
+The report scripts (PBR_model.py, PBR_model_step_change.py, CSTR_plotting_diff_volumes.py) solve the model
+again for every figure and draw the figures one after the other. Here every distinct model solve is done
+once, in parallel, and then all figures are drawn in parallel from those results with the Agg backend, so
+the whole report takes about as long as the slowest solve plus the slowest figure.
+'''
+import os
+import numpy as np
+
+from ptplab.catalog import select_runs
+from ptplab.models import (CSTR_model, PBR_model, CSTR_model_step_change, PBR_model_step_change, PBR_PROBES,
+                           CSTR_PROBE, probe_tank)
+
+FIGURES = ('probes', 'tanks', 'volumes', 'step')
+VOLUMES = (500, 600) # ml, CSTR volumes drawn next to the real one like CSTR_plotting_diff_volumes.py
+TANK_PROBES = (2, 5, 8) # 1 based probes of the tanks 2, 6 and 9 figure in PBR_model.py
+N_EVAL = 400
+SOLVER_OPTIONS = {'method': 'LSODA', 'rtol': 1e-6, 'atol': 1e-9}
+
+def solve_jobs(runs, figures=FIGURES):
+    '''Distinct model solves the figures need: (run, V). Runs are solved at their own volume, the CSTR runs
+    also at VOLUMES when the volumes figure is made.'''
+    jobs = []
+    for entry in runs:
+        jobs.append((entry, entry['V']))
+        if 'volumes' in figures and entry['reactor'] == 'CSTR' and not entry['step_change']:
+            jobs.extend((entry, V) for V in VOLUMES)
+    return jobs
+
+def _solve(job):
+    '''Loads the data of a run and solves its model at volume V. \n
+    returns (run name, V, prepared run, model time in minutes, {probe: temperature in C} or None)
+    '''
+    from ptplab.estimation import prepare_runs
+    entry, V, kinetics = job
+    run = prepare_runs([entry])[0]
+    t_end = 60*max(max(np.max(probe['elapsed_time']) for probe in run['probes'].values()), 1)
+    t_eval = np.linspace(0, t_end, N_EVAL)
+
+    if run['step_change']:
+        steps = run['steps']
+        if run['reactor'] == 'CSTR':
+            t, y = CSTR_model_step_change(steps.get('T1', run['T_in']), steps['T2'], steps['fv1'], steps['fv2'], V=V,
+                                          tspan=[0, t_end], t_change=steps['t_change'], kinetics=kinetics, **SOLVER_OPTIONS)
+        else:
+            t, y = PBR_model_step_change(steps.get('T1', run['T_in']), steps['T2'], steps['fv1'], steps['fv2_1'], steps['fv2_2'], V=V,
+                                         tspan=[0, t_end], t_change1=steps['t_change1'], t_change2=steps['t_change2'], n=run['n'],
+                                         kinetics=kinetics, **SOLVER_OPTIONS)
+    else:
+        if run['reactor'] == 'CSTR':
+            sol = CSTR_model(run['T_in'], run['fv_water'], run['fv_aah'], V=V, tspan=[0, t_end], t_eval=t_eval, kinetics=kinetics, **SOLVER_OPTIONS)
+        else:
+            sol = PBR_model(run['T_in'], run['fv_water'], run['fv_aah'], V=V, tspan=[0, t_end], n=run['n'], t_eval=t_eval, kinetics=kinetics, **SOLVER_OPTIONS)
+        if not sol.success:
+            return run['name'], V, run, None, None
+        t, y = sol.t, sol.y
+
+    if run['reactor'] == 'CSTR':
+        temps = {CSTR_PROBE: y[3] - 273.15}
+    else:
+        temps = {probe: y[3 + 5*probe_tank(i, run['n'])] - 273.15 for i, probe in enumerate(PBR_PROBES)}
+    return run['name'], V, run, t/60, temps
+
+def _init_renderer():
+    import matplotlib
+    matplotlib.use('Agg')
+
+def _style(axis, title):
+    axis.set_title(title, fontsize=14, fontweight='bold')
+    axis.set_xlabel('Elapsed Time (min)', fontsize=12)
+    axis.set_ylabel('Temperature (°C)', fontsize=12)
+    axis.minorticks_on()
+    axis.grid(which='major', linewidth=2)
+    axis.grid(which='minor', linewidth=0.3)
+    axis.legend(fontsize=10)
+
+def _measured(run, probe):
+    data = run['probes'][probe]
+    return data['elapsed_time'], data['rise'] + run['T_in']
+
+def probes_figure(plt, run, models):
+    '''Every probe of a run against the model, the 2x4 grid of PBR_model.py'''
+    t, temps = models[run['V']]
+    probes = list(run['probes'])
+    if len(probes) > 1:
+        fig, ax = plt.subplots(2, 4, figsize=(20, 8), sharex=True, sharey=True)
+    else:
+        fig, ax = plt.subplots(figsize=(10, 6))
+    for i, (axis, probe) in enumerate(zip(np.atleast_1d(ax).ravel(), probes)):
+        axis.plot(*_measured(run, probe), color='#ff7f0e', label='Real Data', linewidth=2)
+        if temps is not None:
+            axis.plot(t, temps[probe], color='#1f77b4', label='Model Prediction', linewidth=2)
+        if run['reactor'] == 'PBR':
+            number = PBR_PROBES.index(probe) # flagged probes are left out, keep the numbers of the others
+            title = f"Temperature Probe {number + 1}, Reactor {probe_tank(number, run['n']) + 1}"
+        else:
+            title = probe
+        _style(axis, title)
+    fig.suptitle(f"{run['name']}: Reactor Temperature Data Comparison", fontsize=16, fontweight='bold')
+    fig.tight_layout(rect=[0, 0, 1, 0.95])
+    return fig
+
+def tanks_figure(plt, run, models):
+    '''Three probes along the bed in one plot, like the tanks 2, 6 and 9 figure of PBR_model.py'''
+    t, temps = models[run['V']]
+    fig, axis = plt.subplots(figsize=(10, 8))
+    for color, number in zip(['firebrick', 'steelblue', 'forestgreen'], TANK_PROBES):
+        probe = PBR_PROBES[number - 1]
+        if probe not in run['probes']:
+            continue
+        tank = probe_tank(number - 1, run['n'])
+        axis.plot(*_measured(run, probe), color=color, label=f'Real Data, Probe {number}', linestyle='dashed', linewidth=2)
+        if temps is not None:
+            axis.plot(t, temps[probe], color=color, label=f'Model Prediction, Tank {tank + 1}', linewidth=2)
+    _style(axis, f"{run['name']}: Temperature along the bed")
+    fig.tight_layout()
+    return fig
+
+def volumes_figure(plt, run, models):
+    '''Model at several volumes against the data with the residuals, like CSTR_plotting_diff_volumes.py'''
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 6))
+    time_data, temp_data = _measured(run, CSTR_PROBE)
+    for V, style, color in zip((run['V'],) + VOLUMES, ['-', '--', '-.'], ['tab:blue', 'tab:orange', 'tab:green']):
+        t, temps = models[V]
+        if temps is None:
+            continue
+        label = f'True Volume {V} ml' if V == run['V'] else f'Volume {V} ml'
+        ax1.plot(t, temps[CSTR_PROBE], label=label, color=color, linestyle=style, linewidth=2)
+        ax2.plot(time_data, temp_data - np.interp(time_data, t, temps[CSTR_PROBE]), label=f'Residuals {label}',
+                 color=color, linestyle=style, linewidth=2)
+    ax1.plot(time_data, temp_data, label='Real Data', color='tab:red')
+    _style(ax1, 'Temperature vs. Time')
+    _style(ax2, 'Residuals (Model vs. Real Data)')
+    ax2.set_ylabel('Residuals (°C)', fontsize=12)
+    ax2.axhline(0, color='black', linestyle='--', linewidth=1)
+    fig.suptitle(run['name'], fontsize=16, fontweight='bold')
+    fig.tight_layout()
+    return fig
+
+def step_figure(plt, run, models):
+    '''Step change run against the step change model, PBR_model_step_change.py and CSTR_Model_temp_step_change.py'''
+    fig = probes_figure(plt, run, models)
+    steps = run['steps']
+    for axis in fig.axes:
+        for key in ('t_change', 't_change1', 't_change2'):
+            if key in steps:
+                axis.axvline(steps[key]/60, color='grey', linestyle=':', linewidth=1.5)
+    return fig
+
+FIGURE_FUNCTIONS = {'probes': probes_figure, 'tanks': tanks_figure, 'volumes': volumes_figure, 'step': step_figure}
+
+def figure_jobs(runs, figures=FIGURES):
+    '''(figure, run name) for every figure that applies to a run'''
+    jobs = []
+    for run in runs:
+        if run['step_change']:
+            kinds = ['step']
+        else:
+            kinds = ['probes'] + (['tanks'] if run['reactor'] == 'PBR' else ['volumes'])
+        jobs.extend((kind, run['name']) for kind in kinds if kind in figures)
+    return jobs
+
+def _render(job):
+    import matplotlib.pyplot as plt
+    kind, run, models, path, dpi = job
+    fig = FIGURE_FUNCTIONS[kind](plt, run, models)
+    fig.savefig(path, dpi=dpi)
+    plt.close(fig)
+    return path
+
+def build_report(output, runs=None, kinetics=None, figures=FIGURES, processes=None, dpi=100):
+    '''Solves every model the report needs once and renders all figures, both on a process pool. \n
+    output = directory for the png files \n
+    runs = catalog entries (default every run, step change runs included) \n
+    kinetics = dictionary overriding k0, Ea and U \n
+    figures = which of FIGURES to make \n
+    processes = worker processes (default all cores, 1 does everything here) \n
+    returns dictionary {file name: path}
+    '''
+    from ptplab.cli import run_pool, safe_name
+    if runs is None:
+        runs = select_runs(step_change=None)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    os.makedirs(output, exist_ok=True)
+
+    solved = run_pool(_solve, [(entry, V, kinetics) for entry, V in solve_jobs(runs, figures)], processes)
+    prepared = {}
+    models = {}
+    for name, V, run, t, temps in solved:
+        prepared[name] = run
+        models.setdefault(name, {})[V] = (t, temps)
+
+    jobs = []
+    for kind, name in figure_jobs(prepared.values(), figures):
+        path = os.path.join(output, f'{kind}_{safe_name(name)}.png')
+        jobs.append((kind, prepared[name], models[name], path, dpi))
+    if processes > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(processes, len(jobs)), initializer=_init_renderer) as pool:
+            paths = list(pool.map(_render, jobs))
+    else:
+        _init_renderer()
+        paths = [_render(job) for job in jobs]
+    return {os.path.basename(path): path for path in paths}
+
+
+if __name__ == '__main__':
+    import time
+    start = time.perf_counter()
+    paths = build_report('report')
+    print(f'{len(paths)} figures in {time.perf_counter() - start:.1f} s')
@@ -0,0 +1,231 @@
+'''Precomputed lookup table of CSTR/PBR predictions. \n
+The models are solved once for every point of a grid over inlet temperature, flow ratio (AAH/water),
+total flow and number of tanks, in parallel. The results are stored as a memory mapped .npy file so a
+table can be opened without reading it, and looked up with multilinear (or cubic spline) interpolation.
+Next to every table an error estimate is stored so a lookup also says how far off the interpolation might be.
+'''
+import json
+from bisect import bisect_right
+import os
+from itertools import product
+import numpy as np
+
+from ptplab.models import CSTR_model, PBR_model, inlet_concentrations
+
+AXES = ('T', 'ratio', 'flow', 'n') # inlet temperature (C), fv_aah/fv_water, total flow (ml/min), tanks in series
+OUTPUTS = ('T_out', 'T_max', 'C_AA_out', 'conversion') # outlet temperature (C), hottest tank (C), acetic acid (mol/L), AAH conversion
+
+DEFAULT_GRID = {
+    'CSTR': {'T': np.linspace(15, 45, 13), 'ratio': np.linspace(0.03, 0.15, 7), 'flow': np.linspace(120, 260, 8), 'n': np.array([1])},
+    'PBR': {'T': np.linspace(15, 45, 13), 'ratio': np.linspace(0.1, 0.3, 5), 'flow': np.linspace(18, 36, 4), 'n': np.arange(3, 21)},
+}
+DEFAULT_VOLUME = {'CSTR': 567, 'PBR': 131}
+STEADY_TIME = 1e6 # seconds, the glass beads take hours to warm up so steady state is far away
+
+def solve_point(reactor, T, ratio, flow, n, V, t_end, kinetics=None):
+    '''Solves one grid point and returns the OUTPUTS at t_end (seconds)'''
+    fv1 = flow/(1 + ratio) # water
+    fv2 = flow*ratio/(1 + ratio) # anhydride
+    options = {'method': 'LSODA', 'rtol': 1e-6, 'atol': 1e-10, 't_eval': [t_end]}
+    if reactor == 'CSTR':
+        sol = CSTR_model(T, fv1, fv2, V=V, tspan=[0, t_end], kinetics=kinetics, **options)
+    else:
+        sol = PBR_model(T, fv1, fv2, V=V, tspan=[0, t_end], n=int(n), kinetics=kinetics, **options)
+    if not sol.success: # a failed solve never reaches t_end, sol.y is empty
+        return np.full(len(OUTPUTS), np.nan)
+    state = sol.y[:, -1].reshape(-1, 4 if reactor == 'CSTR' else 5)
+    c_aah_in = inlet_concentrations(fv1, fv2)[1]
+    return np.array([
+        state[-1, 3] - 273.15,
+        np.max(state[:, 3]) - 273.15,
+        state[-1, 2]*1e3, # mol/ml -> mol/L
+        1 - state[-1, 1]/c_aah_in,
+    ])
+
+def _solve_chunk(args):
+    reactor, points, V, t_end, kinetics = args
+    return np.array([solve_point(reactor, *point, V=V, t_end=t_end, kinetics=kinetics) for point in points])
+
+def error_estimate(values, axes):
+    '''Estimate of the multilinear interpolation error at every node: along an axis the error of linear
+    interpolation is about |f''| h^2 / 8, and the second difference of the table is f'' h^2.'''
+    from scipy.ndimage import maximum_filter
+    error = np.zeros_like(values)
+    for dim in range(len(axes)):
+        if values.shape[dim] < 3:
+            continue
+        second = np.diff(values, n=2, axis=dim)/8
+        # the edge nodes have no second difference of their own, they get the ones next to them extrapolated
+        # outwards (with their sign, the conversion bends over with temperature and a second difference across
+        # the bend is about 0)
+        first, last = np.take(second, [0], axis=dim), np.take(second, [-1], axis=dim)
+        if second.shape[dim] > 1:
+            first = np.fmax(np.abs(first), np.abs(2*first - np.take(second, [1], axis=dim)))
+            last = np.fmax(np.abs(last), np.abs(2*last - np.take(second, [-2], axis=dim)))
+        error += np.concatenate([np.abs(first), np.abs(second), np.abs(last)], axis=dim)
+    # a lookup mixes the estimates of the corners of its cell and the curvature changes across a cell, so every
+    # node takes the largest estimate of the nodes around it
+    return maximum_filter(error, size=(3,)*len(axes) + (1,)*(values.ndim - len(axes)), mode='nearest')
+
+def build_table(path, reactor='PBR', grid=None, mode='steady', t_end=None, V=None, kinetics=None, processes=None, chunksize=16):
+    '''Solves the model on every grid point and stores the table. \n
+    path = file name without extension, writes path.npy (values), path_error.npy (error estimate) and path.json (axes) \n
+    reactor = 'CSTR' or 'PBR' \n
+    grid = dictionary with the values for 'T', 'ratio', 'flow' and 'n' (default DEFAULT_GRID) \n
+    mode = 'steady' (long time limit) or 'transient' (state at t_end seconds) \n
+    V = reactor volume in ml (default 567 for CSTR, 131 for PBR) \n
+    kinetics = dictionary overriding k0, Ea and U \n
+    processes = worker processes (default all cores) \n
+    returns the opened table, see load_table
+    '''
+    grid = dict(DEFAULT_GRID[reactor], **(grid or {}))
+    axes = [np.asarray(grid[name], dtype=float) for name in AXES]
+    if V is None:
+        V = DEFAULT_VOLUME[reactor]
+    if mode == 'steady':
+        t_end = STEADY_TIME
+    elif t_end is None:
+        raise ValueError("mode='transient' needs t_end")
+
+    shape = tuple(len(axis) for axis in axes)
+    points = list(product(*axes))
+    chunks = [(reactor, points[i:i + chunksize], V, t_end, kinetics) for i in range(0, len(points), chunksize)]
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(_solve_chunk, chunks))
+    else:
+        results = [_solve_chunk(chunk) for chunk in chunks]
+
+    values = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=float, shape=shape + (len(OUTPUTS),))
+    values[...] = np.concatenate(results).reshape(values.shape)
+    values.flush()
+    error = np.lib.format.open_memmap(path + '_error.npy', mode='w+', dtype=float, shape=values.shape)
+    error[...] = error_estimate(np.asarray(values), axes)
+    error.flush()
+
+    meta = {'reactor': reactor, 'mode': mode, 't_end': t_end, 'V': V, 'kinetics': kinetics,
+            'axes': {name: axis.tolist() for name, axis in zip(AXES, axes)}, 'outputs': list(OUTPUTS)}
+    with open(path + '.json', 'w') as file:
+        json.dump(meta, file, indent=1)
+    del values, error
+    return load_table(path)
+
+def load_table(path):
+    '''Opens a table written by build_table. The values are memory mapped, nothing is read until it is looked up.'''
+    with open(path + '.json') as file:
+        table = json.load(file)
+    table['axes'] = [np.array(table['axes'][name]) for name in AXES]
+    table['values'] = np.load(path + '.npy', mmap_mode='r')
+    table['error'] = np.load(path + '_error.npy', mmap_mode='r')
+    # corners of a grid cell, along axes with a single value both corners are the same node (and get weight 0 and 1)
+    sizes = np.array([len(axis) for axis in table['axes']])
+    corners = np.array(list(product((0, 1), repeat=len(AXES))))
+    table['corners'] = corners
+    table['offsets'] = np.minimum(corners, sizes - 1)
+    table['strides'] = np.array([int(np.prod(sizes[d + 1:])) for d in range(len(AXES))])
+    table['flat_values'] = table['values'].reshape(-1, len(table['outputs']))
+    table['flat_error'] = table['error'].reshape(-1, len(table['outputs']))
+    table['spline'] = None
+    # plain python lists for lookup_point, numpy scalars are slow one at a time
+    table['axis_lists'] = [axis.tolist() for axis in table['axes']]
+    table['corner_lists'] = list(zip(table['corners'].tolist(), table['offsets'].tolist()))
+    table['stride_list'] = table['strides'].tolist()
+    return table
+
+def lookup_point(table, T, ratio, flow, n):
+    '''Multilinear lookup of a single point without building any arrays until the final gather,
+    this is the one to call in a loop (optimizers, dashboards). Same output as lookup.'''
+    index = []
+    weight = []
+    for axis, x in zip(table['axis_lists'], (T, ratio, flow, n)):
+        if len(axis) == 1:
+            index.append(0)
+            weight.append(0.0)
+            continue
+        i = min(max(bisect_right(axis, x) - 1, 0), len(axis) - 2)
+        index.append(i)
+        weight.append(min(max((x - axis[i])/(axis[i + 1] - axis[i]), 0.0), 1.0))
+
+    flat = []
+    corner_weight = []
+    strides = table['stride_list']
+    for corner, offset in table['corner_lists']:
+        w = 1.0
+        position = 0
+        for d in range(len(AXES)):
+            w *= weight[d] if corner[d] else 1.0 - weight[d]
+            position += (index[d] + offset[d])*strides[d]
+        flat.append(position)
+        corner_weight.append(w)
+    corner_weight = np.array(corner_weight)
+    return corner_weight @ table['flat_values'][flat], corner_weight @ table['flat_error'][flat]
+
+def lookup(table, T, ratio, flow, n, method='linear'):
+    '''Interpolates the table. \n
+    T, ratio, flow, n = numbers or arrays of the same length (points outside the grid are clipped to its edge) \n
+    method = 'linear' (multilinear, fastest) or 'cubic' (scipy RegularGridInterpolator) \n
+    returns (values, error bound), both shaped (..., len(OUTPUTS)) in the order of table['outputs']
+    '''
+    if method == 'linear' and all(np.ndim(x) == 0 for x in (T, ratio, flow, n)):
+        return lookup_point(table, float(T), float(ratio), float(flow), float(n))
+    points = np.stack(np.broadcast_arrays(*(np.asarray(x, dtype=float) for x in (T, ratio, flow, n))), axis=-1)
+    scalar = points.ndim == 1
+    points = np.atleast_2d(points)
+
+    index = np.empty(points.shape, dtype=int)
+    weight = np.empty(points.shape)
+    for d, axis in enumerate(table['axes']):
+        if len(axis) == 1:
+            index[:, d] = 0
+            weight[:, d] = 0
+            continue
+        i = np.clip(np.searchsorted(axis, points[:, d], side='right') - 1, 0, len(axis) - 2)
+        index[:, d] = i
+        weight[:, d] = np.clip((points[:, d] - axis[i])/(axis[i + 1] - axis[i]), 0, 1)
+
+    flat = (index[:, None, :] + table['offsets'][None, :, :]) @ table['strides'] # (points, corners)
+    corner_weight = np.prod(np.where(table['corners'][None, :, :] == 1, weight[:, None, :], 1 - weight[:, None, :]), axis=2)
+    error = np.einsum('pc,pco->po', corner_weight, table['flat_error'][flat])
+
+    if method == 'linear':
+        values = np.einsum('pc,pco->po', corner_weight, table['flat_values'][flat])
+    elif method == 'cubic':
+        if table['spline'] is None:
+            from scipy.interpolate import RegularGridInterpolator
+            keep = [d for d, axis in enumerate(table['axes']) if len(axis) > 1] # spline over the axes that vary
+            if any(len(table['axes'][d]) < 4 for d in keep):
+                raise ValueError('cubic lookup needs at least 4 grid values along every axis that varies')
+            values_all = np.asarray(table['values']).reshape([len(table['axes'][d]) for d in keep] + [len(table['outputs'])])
+            grid_axes = [table['axes'][d] for d in keep]
+            try: # newer scipy fits the spline with an iterative solver that misses the nodes by about 1e-3, solve it exactly
+                from scipy.sparse.linalg import spsolve
+                spline = RegularGridInterpolator(grid_axes, values_all, method='cubic', solver=spsolve)
+            except TypeError: # older scipy has no solver argument and interpolates the nodes exactly anyway
+                spline = RegularGridInterpolator(grid_axes, values_all, method='cubic')
+            table['spline'] = (keep, spline)
+        keep, spline = table['spline']
+        clipped = np.clip(points[:, keep], [table['axes'][d][0] for d in keep], [table['axes'][d][-1] for d in keep])
+        values = spline(clipped)
+    else:
+        raise ValueError(f'Unknown method {method!r}, use linear or cubic')
+
+    if scalar:
+        return values[0], error[0]
+    return values, error
+
+
+if __name__ == '__main__':
+    import time
+    table = build_table('pbr_surrogate', reactor='PBR', grid={'n': np.array([6, 9, 12])})
+    start = time.perf_counter()
+    for _ in range(1000):
+        values, error = lookup(table, 30, 0.23, 28.8, 9)
+    print(f'one lookup takes {(time.perf_counter() - start)*1e3:.1f} us')
+    start = time.perf_counter()
+    values, error = lookup(table, np.linspace(20, 40, 100000), 0.23, 28.8, 9)
+    print(f'100000 lookups take {(time.perf_counter() - start)*1e3:.1f} ms')
+    for name, value, bound in zip(table['outputs'], values[0], error[0]):
+        print(f'{name} = {value:.4f} +/- {bound:.4f}')
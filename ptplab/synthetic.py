@@ -0,0 +1,165 @@
+'''Synthetic historian exports for scale and load testing. \n
+The real exports are small (about 1500 rows for the PBR, 1000 for the CSTR). This writes files in the same
+format (TagName;DateTime;Value;vValue;... in ISO-8859-1) from a model simulation, with noise, (null) rows,
+extra tags, any sampling interval and any duration, so ingestion and fitting can be tried at the size of a
+production archive. The files read back with historian.load_run and catalog.load_catalog_run.
+'''
+import numpy as np
+
+from ptplab.calibration import TEMPERATURE_TAGS, conductivity_calibration
+from ptplab.historian import ENCODING
+from ptplab.models import CSTR_model, PBR_model, PBR_PROBES, CSTR_PROBE, probe_tank
+
+HEADER = 'TagName;DateTime;Value;vValue;MinRaw;MaxRaw;MinEU;MaxEU;Unit;Quality;QualityDetail;QualityString;wwResolution;StartDateTime'
+# (MinRaw/MinEU, MaxRaw/MaxEU, unit) like the real exports
+TAG_INFO = {
+    'P100_Flow': (0, 1000, 'ml/min'),
+    'P100_PV': (0, 100, 'rpm'),
+    'P120_Flow': (0, 1000, 'ml/min'),
+    'P120_PV': (0, 100, 'rpm'),
+    'T200_PV': (0, 150, '°C'),
+    'T400_PV': (0, 100, '°C'),
+    'Q210_PV': (0, 2000, 'µS/cm'),
+    'QT210_PV': (0, 1000, 'µS/cm'),
+    'SysSpaceBuffer': (0, 100000, 'MB'),
+}
+TAG_INFO.update({probe: (0, 150, '°C') for probe in PBR_PROBES})
+EXTRA_TAG_INFO = (0, 100, '-') # filler tags added to reach n_tags
+DEFAULT_NOISE = {'°C': 0.05, 'ml/min': 0.05, 'µS/cm': 2.0, 'rpm': 0.0, 'MB': 0.0, '-': 0.1}
+RESOLUTION = 15757 # wwResolution column of the real exports (ms)
+
+def conductivity(c_aa, reactor, T=None):
+    '''Conductivity (uS/cm) that the calibration surface of the reactor maps to c_aa (mol/L) at T (C, default the
+    calibration temperature)'''
+    # the PBR curve has an offset d > 0, below it the curve has no inverse so those points sit at its lower end
+    return conductivity_calibration(reactor).conductivity(c_aa, T)
+
+def simulate_tags(reactor='PBR', T=30, fv_water=26.8, fv_aah=4.1, duration=60, lead_time=5, sample_interval=RESOLUTION/1e3,
+                  V=None, n=9, kinetics=None, n_tags=None, compensate=False):
+    '''Tag values of one run: lead_time minutes with only water, then the AAH pump is switched on and the model
+    runs for duration minutes. \n
+    sample_interval = seconds between time stamps \n
+    V = reactor volume in ml (default 567 for the CSTR, 131 for the PBR) \n
+    n = number of tanks for the PBR \n
+    n_tags = total number of tags, filler tags (AUX001_PV, ...) are added to reach it (a run always has at least its own tags) \n
+    compensate = the conductivity follows the temperature of its paired probe through the calibration surface
+    (off by default like the tools that read it back, see calibration.py) \n
+    returns seconds since the first time stamp and dictionary {tag: values} without noise
+    '''
+    t = np.arange(0, 60*(lead_time + duration), sample_interval)
+    running = t >= 60*lead_time
+    t_model = t[running] - 60*lead_time
+    options = {'method': 'LSODA', 'rtol': 1e-6, 'atol': 1e-10}
+
+    values = {}
+    if reactor == 'CSTR':
+        sol = CSTR_model(T, fv_water, fv_aah, V=V or 567, tspan=[0, max(t_model[-1], 1)], t_eval=t_model, kinetics=kinetics, **options)
+        temps = {CSTR_PROBE: sol.y[3]}
+        c_aa = sol.y[2]
+        cond_tag = 'Q210_PV'
+    else:
+        sol = PBR_model(T, fv_water, fv_aah, V=V or 131, tspan=[0, max(t_model[-1], 1)], n=n, t_eval=t_model, kinetics=kinetics, **options)
+        temps = {probe: sol.y[3 + 5*probe_tank(i, n)] for i, probe in enumerate(PBR_PROBES)}
+        temps[CSTR_PROBE] = np.full(len(t_model), T + 273.15) # inlet
+        c_aa = sol.y[-3]
+        cond_tag = 'QT210_PV'
+    if not sol.success:
+        raise RuntimeError(f'Model did not solve: {sol.message}')
+
+    for tag, temp in temps.items():
+        values[tag] = np.full(len(t), T, dtype=float)
+        values[tag][running] = temp - 273.15
+    values['T400_PV'] = np.full(len(t), float(T))
+    values['P100_Flow'] = np.full(len(t), float(fv_water))
+    values['P100_PV'] = np.full(len(t), 99.0)
+    values['P120_Flow'] = np.where(running, float(fv_aah), 0.0)
+    values['P120_PV'] = np.where(running, 50.0, 0.0)
+    values[cond_tag] = conductivity(np.where(running, np.interp(t - 60*lead_time, t_model, c_aa)*1e3, 0.0), reactor,
+                                    T=values[TEMPERATURE_TAGS[cond_tag]] if compensate else None)
+    values['SysSpaceBuffer'] = np.full(len(t), 107159.0)
+
+    if n_tags is not None:
+        for j in range(n_tags - len(values)):
+            values[f'AUX{j + 1:03d}_PV'] = np.full(len(t), 50.0)
+    return t, values
+
+def add_noise(values, noise=None, seed=None):
+    '''Gaussian noise per tag. noise = standard deviation, a number for every tag or a dictionary {tag or unit: std}
+    (default DEFAULT_NOISE per unit). Flows that are off stay exactly 0 so the start detection works like on real data.'''
+    rng = np.random.default_rng(seed)
+    noisy = {}
+    for tag, value in values.items():
+        unit = TAG_INFO.get(tag, EXTRA_TAG_INFO)[2]
+        if noise is None:
+            std = DEFAULT_NOISE[unit]
+        elif isinstance(noise, dict):
+            std = noise.get(tag, noise.get(unit, 0.0))
+        else:
+            std = noise
+        noisy[tag] = value + rng.normal(0, std, len(value)) if std > 0 else value.copy()
+        if unit == 'ml/min':
+            noisy[tag] = np.where(value == 0, 0.0, np.abs(noisy[tag]))
+    return noisy
+
+def write_historian(path, t, values, start='2024-09-18T11:47:56', null_fraction=0.0, seed=None, chunk_size=10000):
+    '''Writes tag values as a historian export, every time stamp has one row per tag like the real files. \n
+    path = csv file to write \n
+    t = seconds since start, values = dictionary {tag: values} \n
+    start = time stamp of the first row \n
+    null_fraction = fraction of the rows written as (null) with the quality of a failed read \n
+    chunk_size = time stamps formatted at once, so big files are written without holding them in memory \n
+    returns the number of data rows
+    '''
+    rng = np.random.default_rng(seed)
+    tags = list(values)
+    start = np.datetime64(start, 'ms')
+    first = str(start.astype('datetime64[s]')).replace('T', ' ')
+    start_column = f'{first[8:10]}/{first[5:7]}/{first[:4]} {first[11:]}' # StartDateTime is day first
+    fixed = {}
+    for tag in tags:
+        low, high, unit = TAG_INFO.get(tag, EXTRA_TAG_INFO)
+        fixed[tag] = (f'{low};{high};{low};{high};{unit};0;192;Good;{RESOLUTION};{start_column}',
+                      f'{low};{high};{low};{high};{unit};1;24;IOServer communication failed;{RESOLUTION};{start_column}')
+
+    rows = 0
+    with open(path, 'w', encoding=ENCODING) as file:
+        file.write(HEADER + '\n')
+        for begin in range(0, len(t), chunk_size):
+            stamps = start + np.round(np.asarray(t[begin:begin + chunk_size])*1e3).astype('timedelta64[ms]')
+            stamps = [str(stamp).replace('T', ' ') + '0000' for stamp in stamps] # .xxx -> .xxx0000 like the historian
+            nulls = rng.random((len(stamps), len(tags))) < null_fraction
+            lines = []
+            for i, stamp in enumerate(stamps):
+                for j, tag in enumerate(tags):
+                    if nulls[i, j]:
+                        lines.append(f'{tag};{stamp};(null);(null);{fixed[tag][1]}\n')
+                    else:
+                        value = values[tag][begin + i]
+                        lines.append(f'{tag};{stamp};{value:.15g};{value:.17g};{fixed[tag][0]}\n')
+            file.writelines(lines)
+            rows += len(lines)
+    return rows
+
+def generate_export(path, reactor='PBR', T=30, fv_water=26.8, fv_aah=4.1, duration=60, lead_time=5, sample_interval=RESOLUTION/1e3,
+                    n_tags=None, noise=None, null_fraction=0.0, seed=None, **model):
+    '''Simulates a run and writes it as a historian export, see simulate_tags, add_noise and write_historian. \n
+    other keyword arguments (V, n, kinetics) go to the model \n
+    returns the number of data rows
+    '''
+    t, values = simulate_tags(reactor, T, fv_water, fv_aah, duration=duration, lead_time=lead_time,
+                              sample_interval=sample_interval, n_tags=n_tags, **model)
+    values = add_noise(values, noise=noise, seed=seed)
+    return write_historian(path, t, values, null_fraction=null_fraction, seed=seed)
+
+
+if __name__ == '__main__':
+    import time
+    from ptplab.historian import load_run
+
+    for duration in (60, 6000):
+        start = time.perf_counter()
+        rows = generate_export('synthetic_pbr.csv', 'PBR', T=30, duration=duration, null_fraction=0.01, seed=0)
+        written = time.perf_counter() - start
+        start = time.perf_counter()
+        run = load_run('synthetic_pbr.csv')
+        print(f'{rows} rows: written in {written:.2f} s, read in {time.perf_counter() - start:.2f} s, start detected: {run["start_detected"]}')
@@ -0,0 +1,203 @@
+'''Monte Carlo propagation of fit uncertainty into model predictions. \n
+Parameters are drawn from the covariance of a fit (the kinetic fit from estimation.py or a curve_fit pcov),
+every chunk of the ensemble is solved at once with the batched models (models.cstr_ensemble_der_func and
+pbr_ensemble_der_func on integrators.ensemble_master_function) and the chunks are folded into streaming
+quantile estimators (P-square algorithm), so memory does not grow with the number of samples.
+'''
+import numpy as np
+
+from ptplab.estimation import from_x, prepare_runs
+
+QUANTILES = (0.025, 0.5, 0.975)
+STEP = 2 # s, rk4 step of the ensemble solve (stable up to about 80 s with 9 tanks, the accuracy sets the step)
+
+class StreamingQuantiles:
+    '''P-square quantile estimators (Jain and Chlamtac, 1985) for many positions at once. \n
+    quantiles = probabilities to track \n
+    shape = shape of one observation (for example the number of time points) \n
+    Every call to add() takes one observation of that shape. Five markers are kept per quantile
+    and position so the memory use does not depend on the number of observations.
+    Mean and standard deviation are tracked alongside with Welford's update.
+    '''
+    def __init__(self, quantiles=QUANTILES, shape=()):
+        self.p = np.asarray(quantiles, dtype=float).reshape((-1,) + (1,)*len(shape))
+        self.shape = tuple(shape)
+        self.count = 0
+        self.first = [] # the first five observations are needed to place the markers
+        full = (len(quantiles),) + self.shape + (5,)
+        self.q = np.zeros(full) # marker heights
+        self.n = np.zeros(full) # marker positions (1 based)
+        self.desired = np.zeros(full)
+        self.increment = np.stack([np.zeros_like(self.p), self.p/2, self.p, (1 + self.p)/2, np.ones_like(self.p)], axis=-1)
+        self.increment = np.broadcast_to(self.increment, full).copy()
+        self._mean = np.zeros(self.shape)
+        self._m2 = np.zeros(self.shape)
+
+    def add(self, x):
+        x = np.asarray(x, dtype=float)
+        self.count += 1
+        delta = x - self._mean
+        self._mean += delta/self.count
+        self._m2 += delta*(x - self._mean)
+
+        if self.count <= 5:
+            self.first.append(x)
+            if self.count == 5:
+                start = np.sort(np.stack(self.first, axis=-1), axis=-1)
+                self.q[...] = start
+                self.n[...] = np.arange(1, 6)
+                p = self.p[..., None]
+                self.desired[...] = np.concatenate([np.ones_like(p), 1 + 2*p, 1 + 4*p, 3 + 2*p, 5*np.ones_like(p)], axis=-1)
+                self.first = None
+            return
+
+        x = np.broadcast_to(x, self.q.shape[:-1])
+        q, n = self.q, self.n
+        # cell the observation falls in, extending the outer markers when needed
+        q[..., 0] = np.minimum(q[..., 0], x)
+        q[..., 4] = np.maximum(q[..., 4], x)
+        k = np.clip(np.sum(q[..., 1:4] <= x[..., None], axis=-1), 0, 3) # markers 0..3, cell k is between marker k and k+1
+        n += np.arange(5) > k[..., None]
+        self.desired += self.increment
+
+        for i in (1, 2, 3):
+            d = self.desired[..., i] - n[..., i]
+            up = (d >= 1) & (n[..., i + 1] - n[..., i] > 1)
+            down = (d <= -1) & (n[..., i - 1] - n[..., i] < -1)
+            move = up | down
+            if not np.any(move):
+                continue
+            s = np.where(up, 1.0, -1.0)
+            qi, qm, qp = q[..., i], q[..., i - 1], q[..., i + 1]
+            ni, nm, np_ = n[..., i], n[..., i - 1], n[..., i + 1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                parabolic = qi + s/(np_ - nm)*((ni - nm + s)*(qp - qi)/(np_ - ni) + (np_ - ni - s)*(qi - qm)/(ni - nm))
+                q_next = np.where(up, qp, qm)
+                n_next = np.where(up, np_, nm)
+                linear = qi + s*(q_next - qi)/(n_next - ni)
+            new = np.where((qm < parabolic) & (parabolic < qp), parabolic, linear)
+            q[..., i] = np.where(move, new, qi)
+            n[..., i] = np.where(move, ni + s, ni)
+
+    def quantiles(self):
+        '''Current estimates, shape (number of quantiles,) + shape, NaN before the first observation'''
+        if self.count == 0:
+            return np.full((self.p.size,) + self.shape, np.nan)
+        if self.count < 5:
+            return np.quantile(np.stack(self.first), self.p.ravel(), axis=0)
+        return self.q[..., 2].copy()
+
+    def mean(self):
+        return self._mean.copy() if self.count else np.full(self.shape, np.nan)
+
+    def std(self):
+        return np.sqrt(self._m2/max(self.count - 1, 1)) if self.count else np.full(self.shape, np.nan)
+
+def sample_kinetics(fitted, n_samples, seed=None):
+    '''Draws kinetic parameter sets from a fit_kinetics result. The sampling is done in the fitted
+    variables (ln k0, Ea, ln U) so k0 and U stay positive. \n
+    returns list of kinetics dictionaries
+    '''
+    rng = np.random.default_rng(seed)
+    x = rng.multivariate_normal(fitted['x'], fitted['cov_x'], size=n_samples)
+    return [from_x(row, fitted['fit'], fitted['kinetics']) for row in x]
+
+def _simulate_ensemble(run, kinetics_list, n_eval, step=STEP):
+    '''Probe temperatures (C) and outlet acetic acid (mol/L) for a chunk of parameter sets in one batched solve,
+    on the same time points as estimation.simulate_run. Rows of members that blew up are NaN. \n
+    returns array (len(kinetics_list), probes + 1, n_eval)
+    '''
+    from ptplab.models import CSTR_PROBE, CSTR_ensemble, PBR_PROBES, PBR_ensemble, probe_tank
+    t_end = 60*max(max(np.max(probe['elapsed_time']) for probe in run['probes'].values()), 1)
+    save_every = max(int(np.ceil(t_end/(n_eval - 1)/step)), 1)
+    kinetics = {key: np.array([values[key] for values in kinetics_list]) for key in kinetics_list[0]}
+    options = {'tspan': [0, t_end], 'kinetics': kinetics, 'number_of_points': (n_eval - 1)*save_every, 'save_every': save_every}
+    if run['reactor'] == 'CSTR':
+        _, y = CSTR_ensemble(run['T_in'], run['fv_water'], run['fv_aah'], V=run['V'], **options)
+        columns = {CSTR_PROBE: 3}
+        c_aa = y[:, :, 2]
+    else:
+        n = run['n']
+        _, y = PBR_ensemble(run['T_in'], run['fv_water'], run['fv_aah'], V=run['V'], n=n, **options)
+        columns = {probe: 3 + 5*probe_tank(i, n) for i, probe in enumerate(PBR_PROBES)}
+        c_aa = y[:, :, -3] # c_AA of the last tank is third from the end
+    out = np.empty((len(kinetics_list), len(run['probes']) + 1, n_eval))
+    for j, probe in enumerate(run['probes']):
+        out[:, j] = y[:, :, columns[probe]].T - 273.15
+    out[:, -1] = c_aa.T*1e3 # mol/ml -> mol/L
+    out[~np.all(np.isfinite(out), axis=(1, 2))] = np.nan
+    return out
+
+def propagate_kinetics(run, fitted, n_samples=1000, quantiles=QUANTILES, seed=None, chunk_size=250, n_eval=200, step=STEP):
+    '''Prediction bands of the model for one run from the covariance of a kinetic fit. \n
+    run = catalog entry or prepared run \n
+    fitted = result of estimation.fit_kinetics \n
+    n_samples = ensemble size \n
+    quantiles = probabilities of the bands \n
+    seed = random seed \n
+    chunk_size = parameter sets solved together, only this many trajectories are in memory \n
+    step = integrator step in seconds \n
+    returns dictionary with 'time' (min), 'quantiles', 'n_samples' (members that did not blow up), and for every
+    probe and 'C_AA_out' a dictionary with 'bands' (one row per quantile), 'mean' and 'std', all NaN when no
+    member made it
+    '''
+    run = prepare_runs([run])[0]
+    samples = sample_kinetics(fitted, n_samples, seed=seed)
+    names = list(run['probes']) + ['C_AA_out']
+    stats = StreamingQuantiles(quantiles, shape=(len(names), n_eval))
+    for i in range(0, n_samples, chunk_size):
+        for row in _simulate_ensemble(run, samples[i:i + chunk_size], n_eval, step=step):
+            if not np.any(np.isnan(row)):
+                stats.add(row)
+
+    t_end = max(np.max(probe['elapsed_time']) for probe in run['probes'].values())
+    bands, mean, std = stats.quantiles(), stats.mean(), stats.std()
+    result = {'time': np.linspace(0, max(t_end, 1), n_eval), 'quantiles': tuple(quantiles), 'n_samples': stats.count}
+    for j, name in enumerate(names):
+        result[name] = {'bands': bands[:, j], 'mean': mean[j], 'std': std[j]}
+    return result
+
+def propagate(func, mean, cov, x, n_samples=10000, quantiles=QUANTILES, seed=None, chunk_size=1000):
+    '''Monte Carlo bands for a cheap vectorized function, for example a calibration curve or the Arrhenius line. \n
+    func = function(x, *params) that broadcasts over a column of parameter sets \n
+    mean, cov = popt and pcov of the fit \n
+    x = where to evaluate the function \n
+    returns dictionary with 'bands' (one row per quantile), 'mean' and 'std'
+    '''
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=float)
+    stats = StreamingQuantiles(quantiles, shape=x.shape)
+    for start in range(0, n_samples, chunk_size):
+        params = rng.multivariate_normal(mean, cov, size=min(chunk_size, n_samples - start))
+        values = func(x[None, :], *(params[:, [i]] for i in range(params.shape[1]))) # (chunk, len(x)) in one go
+        for row in values:
+            stats.add(row)
+    return {'bands': stats.quantiles(), 'mean': stats.mean(), 'std': stats.std()}
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    from ptplab.calibration import fit_calibration, model_func, CSTR_CAL_COND
+    from ptplab.catalog import get_run
+    from ptplab.estimation import fit_kinetics
+
+    popt, pcov = fit_calibration()
+    cond = np.linspace(min(CSTR_CAL_COND), max(CSTR_CAL_COND), 100)
+    calibration_band = propagate(model_func, popt, pcov, cond, seed=0)
+    plt.fill_between(cond, calibration_band['bands'][0], calibration_band['bands'][-1], alpha=0.3, label='95% band')
+    plt.plot(cond, calibration_band['bands'][1], label='median')
+    plt.xlabel('Conductivity [us/cm]')
+    plt.ylabel('Concentration [mol/L]')
+    plt.legend()
+    plt.show()
+
+    run = get_run('PBR 40c')
+    fitted = fit_kinetics([run])
+    bands = propagate_kinetics(run, fitted, n_samples=200, seed=0)
+    for probe in ['T201_PV', 'T204_PV', 'T208_PV']:
+        plt.fill_between(bands['time'], bands[probe]['bands'][0], bands[probe]['bands'][-1], alpha=0.3)
+        plt.plot(bands['time'], bands[probe]['bands'][1], label=probe)
+    plt.xlabel('Elapsed Time (min)')
+    plt.ylabel('Temperature (°C)')
+    plt.legend()
+    plt.show()
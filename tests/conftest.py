@@ -0,0 +1,6 @@
+'''Run from the repository root: python -m pytest tests'''
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT) # for ptplab
@@ -0,0 +1,48 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from ptplab import bootstrap
+from ptplab.bootstrap import bootstrap_arrhenius, bootstrap_calibration, interval
+from ptplab.calibration import R_GAS
+
+K0, EA = 4.4e14, 9.825e4
+
+@pytest.mark.parametrize('kind', ['residual', 'case'])
+def test_arrhenius_interval_covers_the_true_line(kind):
+    rng = np.random.default_rng(2)
+    T = np.repeat(np.linspace(295, 320, 6), 4)
+    k = K0*np.exp(-EA/(R_GAS*T))*np.exp(rng.normal(0, 0.05, T.size))
+    result = bootstrap_arrhenius(T, k, n_boot=4000, kind=kind, seed=0)
+    assert result['samples'].shape == (4000, 2)
+    for name, true in (('k0', K0), ('Ea', EA)):
+        low, high = result['interval'][name]
+        assert low < true < high
+        assert low < result['estimate'][name] < high
+    # about two standard errors of the slope either side
+    x = 1/T
+    slope_std = 0.05/np.sqrt(np.sum((x - x.mean())**2))
+    low, high = result['interval']['Ea']
+    assert (high - low)/2 == pytest.approx(1.96*slope_std*R_GAS, rel=0.3)
+
+def test_calibration_pooled_matches_serial():
+    serial = bootstrap_calibration(n_boot=60, seed=3, processes=1, chunk_size=16)
+    pooled = bootstrap_calibration(n_boot=60, seed=3, processes=2, chunk_size=16)
+    assert np.array_equal(serial['samples'], pooled['samples'], equal_nan=True)
+    assert serial['interval'] == pooled['interval']
+
+def test_interval_without_usable_samples():
+    samples = np.full((10, 3), np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        low, high = interval(samples)
+    assert low.shape == high.shape == (3,)
+    assert np.all(np.isnan(low)) and np.all(np.isnan(high))
+    samples[::2] = np.arange(5)[:, None] # the failed rows are left out
+    assert np.allclose(interval(samples, 1.0), [[0, 0, 0], [4, 4, 4]])
+
+def test_calibration_with_every_refit_failed(monkeypatch):
+    monkeypatch.setattr(bootstrap, '_fit_chunk', lambda X, Y, p0: np.full((len(X), 3), np.nan))
+    result = bootstrap_calibration(n_boot=20, seed=0, processes=1)
+    assert all(np.isnan(low) and np.isnan(high) for low, high in result['interval'].values())
@@ -0,0 +1,62 @@
+import numpy as np
+
+from ptplab.calibration import (CSTR_CAL_COND, CSTR_CAL_CONC, PBR_CAL_COND, ConductivityCalibration, conductivity_calibration,
+                                fit_calibration, model_func)
+
+def test_calibration_is_fitted_once_per_set():
+    assert conductivity_calibration('CSTR') is conductivity_calibration('Q210_PV')
+    assert conductivity_calibration('PBR', '2024-10-01') is conductivity_calibration('QT210_PV')
+    popt, _ = fit_calibration(CSTR_CAL_COND, CSTR_CAL_CONC)
+    assert np.allclose(conductivity_calibration('CSTR').popt, popt)
+
+def test_forward_inverse_roundtrip():
+    for instrument, points in (('Q210_PV', CSTR_CAL_COND), ('QT210_PV', PBR_CAL_COND)):
+        calibration = conductivity_calibration(instrument)
+        conductivity = np.linspace(min(points), max(points), 50).reshape(5, 10)
+        c = calibration.concentration(conductivity)
+        assert c.shape == conductivity.shape
+        assert np.allclose(c, model_func(conductivity, *calibration.popt))
+        assert np.allclose(calibration.conductivity(c), conductivity)
+        for T in (15.0, 22.0, 40.0):
+            assert np.allclose(calibration.concentration(calibration.conductivity(c, T), T), c)
+
+def test_propagated_std_matches_finite_differences():
+    calibration = conductivity_calibration('CSTR')
+    x, T = np.array([700.0, 1200.0, 1600.0]), np.array([25.0, 30.0, 35.0])
+    _, std = calibration.concentration(x, T, return_std=True)
+    # first order propagation by hand: numerical gradient to (a, b, d, alpha)
+    theta = np.array(calibration.popt + (calibration.alpha,))
+    def value(theta):
+        other = ConductivityCalibration(CSTR_CAL_COND, CSTR_CAL_CONC)
+        other.popt, other.alpha = tuple(theta[:3]), theta[3]
+        return other.concentration(x, T)
+    gradient = np.array([(value(theta + step) - value(theta - step))/(2*step[i])
+                         for i, step in enumerate(np.diag(np.abs(theta)*1e-6))]).T
+    expected = np.sqrt(np.einsum('ni,ij,nj->n', gradient, calibration.cov, gradient))
+    assert np.allclose(std, expected, rtol=1e-4)
+
+def test_every_tool_converts_a_run_the_same_way(tmp_path):
+    from ptplab.calibration import run_concentration
+    from ptplab.historian import load_run
+    from ptplab.kalman import PBRKalmanFilter
+    from ptplab.kinetics import KineticsExtractor
+    from ptplab.pipeline import calibration_node, concentration_node
+    from ptplab.synthetic import generate_export
+    path = str(tmp_path/'synthetic.csv')
+    generate_export(path, 'CSTR', T=35, fv_water=180, fv_aah=15, duration=20, noise=0)
+    run = load_run(path)
+    series = run['tags']['Q210_PV']
+    reference = run_concentration(run, 'Q210_PV')
+    pipeline = concentration_node(calibration_node(CSTR_CAL_COND, CSTR_CAL_CONC), path, 'Q210_PV')['c_aa']
+    assert np.allclose(pipeline, reference)
+    extractor = KineticsExtractor(180, 15)
+    assert not extractor.compensate
+    assert np.allclose(extractor.calibration.concentration(series['values']), reference)
+    # the filter sees the PBR cell the same way
+    pbr = conductivity_calibration('QT210_PV')
+    ekf = PBRKalmanFilter(30, 24, 5.4)
+    outlet = ekf.x[ekf.outlet_index]
+    conductivity = pbr.conductivity(0.5)
+    innovations = ekf.update(conductivity=conductivity)
+    assert ekf.calibration is pbr
+    assert np.isclose(innovations['QT210_PV'], pbr.concentration(conductivity)*1e-3 - outlet)
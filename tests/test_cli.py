@@ -0,0 +1,63 @@
+import json
+import os
+
+import numpy as np
+
+from ptplab import cli
+from ptplab.cli import main
+
+def run_command(tmp_path, command, *args, config=None):
+    argv = [command, '--output', str(tmp_path), '--processes', '1', *args]
+    if config is not None:
+        path = tmp_path/'config.json'
+        path.write_text(json.dumps(config))
+        argv += ['--config', str(path)]
+    assert main(argv) == 0
+    with open(tmp_path/f'{command}.json') as file:
+        return json.load(file)
+
+def test_simulate(tmp_path):
+    case = {'name': 'pbr 35c', 'reactor': 'PBR', 'T': 35, 'fv_water': 26.8, 'fv_aah': 4.1, 'n': 6, 't_end': 600}
+    summary = run_command(tmp_path, 'simulate', config={'simulate': {'cases': [case], 'n_eval': 21}})
+    assert summary['pbr 35c']['success']
+    columns = np.genfromtxt(summary['pbr 35c']['file'], delimiter=',', names=True)
+    assert len(columns) == 21 and columns['time_min'][-1] == 10
+    assert np.all(columns['T208_PV'] >= 35 - 1e-6)
+
+def test_fit(tmp_path):
+    summary = run_command(tmp_path, 'fit', '--runs', 'CSTR 27c', config={'fit': {'fit': ['k0'], 't_max': 10}})
+    assert summary['fit'] == ['k0'] and summary['success']
+    assert set(summary['run_rms']) == {'CSTR 27c'}
+    assert summary['stderr']['k0'] > 0
+
+def test_scan_prepares_every_run_once(tmp_path, monkeypatch):
+    from ptplab import estimation
+    prepared = []
+    prepare_runs = estimation.prepare_runs
+    def counting(runs=None, t_max=None):
+        prepared.extend(entry['name'] for entry in runs)
+        return prepare_runs(runs, t_max)
+    monkeypatch.setattr(estimation, 'prepare_runs', counting)
+    summary = run_command(tmp_path, 'scan', '--runs', 'PBR 40c', 'CSTR 27c', config={'scan': {'n': [8, 10]}})
+    assert prepared == ['PBR 40c'] # the CSTR run is left out, the PBR run is read once for the three n
+    assert set(summary['best']) == {'PBR 40c'} and summary['best']['PBR 40c']['n'] in (8, 9, 10)
+    with open(summary['file']) as file:
+        assert len(file.readlines()) == 1 + 3
+
+def test_report(tmp_path):
+    summary = run_command(tmp_path, 'report', '--runs', 'CSTR 27c', config={'report': {'figures': ['probes']}})
+    assert summary and all(os.path.exists(path) for path in summary.values())
+    assert all(path.endswith('.png') for path in summary.values())
+
+def test_run_pool_initializer_runs_here_too():
+    seen = []
+    assert cli.run_pool(lambda job: (seen[0], job), [1, 2], 1, initializer=seen.append, initargs=('runs',)) == [('runs', 1), ('runs', 2)]
+
+def test_scan_on_a_pool_matches_serial(tmp_path):
+    results = {}
+    for processes in ('1', '2'):
+        output = tmp_path/processes
+        assert main(['scan', '--output', str(output), '--processes', processes, '--runs', 'PBR 40c']) == 0
+        with open(output/'scan.json') as file:
+            results[processes] = json.load(file)['best']
+    assert results['1'] == results['2']
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from ptplab import estimation
+from ptplab.catalog import load_catalog_run
+from ptplab.estimation import fit_kinetics, run_residuals, simulate_run, to_x
+from ptplab.models import PBR_KINETICS
+from ptplab.synthetic import generate_export
+
+TRUE = dict(PBR_KINETICS, U=2e-3) # U large enough that the PBR probes see it
+NOISE = 0.05 # K on the probes
+
+@pytest.fixture(scope='module')
+def synthetic_runs(tmp_path_factory):
+    '''Two CSTR runs (different temperatures for Ea) and one PBR run (for U) with known kinetics. The sample
+    interval puts a time stamp on the pump start so the detected start is exact, and the inlet stays noise
+    free so the minimum of T200_PV is the inlet temperature.'''
+    runs = []
+    for seed, (reactor, T) in enumerate((('CSTR', 25), ('CSTR', 40), ('PBR', 30))):
+        path = str(tmp_path_factory.mktemp('runs')/f'{reactor} {T}.csv')
+        flows = {'fv_water': 180, 'fv_aah': 15} if reactor == 'CSTR' else {}
+        generate_export(path, reactor, T=T, duration=30, sample_interval=10, noise={'T200_PV': 0.0, '°C': NOISE},
+                        seed=seed, kinetics=TRUE, **flows)
+        entry = {'name': f'{reactor} {T}', 'reactor': reactor, 'file': path, 'V': 567 if reactor == 'CSTR' else 131,
+                 'n': 9, 'step_change': False}
+        runs.append(load_catalog_run(entry, probe_table=None, probe_health=None))
+    return runs
+
+def test_fit_recovers_known_kinetics(synthetic_runs):
+    start = dict(TRUE, k0=3*TRUE['k0'], Ea=1.01*TRUE['Ea'], U=2*TRUE['U'])
+    fitted = fit_kinetics(synthetic_runs, start=start, processes=1)
+    assert fitted['result'].success
+    stderr_x = np.sqrt(np.diag(fitted['cov_x']))
+    assert np.all(np.isfinite(stderr_x)) and np.all(stderr_x > 0)
+    assert np.all(np.abs(fitted['x'] - to_x(TRUE)) < 4*stderr_x)
+    assert abs(fitted['kinetics']['Ea'] - TRUE['Ea']) < 0.01*TRUE['Ea']
+    # the residuals of the noisy run are the noise, so the covariance is scaled right
+    assert fitted['run_rms']['PBR 30'] == pytest.approx(NOISE, rel=0.1)
+    assert fitted['stderr']['Ea'] == pytest.approx(stderr_x[1]*1e3)
+    assert fitted['stderr']['k0'] == pytest.approx(stderr_x[0]*fitted['kinetics']['k0'])
+
+def test_failed_solve_gives_penalty(monkeypatch, synthetic_runs):
+    failed = lambda *args, **options: SimpleNamespace(success=False, message='failed')
+    monkeypatch.setattr(estimation, 'CSTR_model', failed)
+    monkeypatch.setattr(estimation, 'PBR_model', failed)
+    for run in synthetic_runs:
+        assert simulate_run(run, TRUE)[1] is None
+        residuals = run_residuals(run, TRUE)
+        assert len(residuals) == sum(len(probe['rise']) for probe in run['probes'].values())
+        assert np.all(residuals == 1e3)
@@ -0,0 +1,38 @@
+import numpy as np
+
+from ptplab.forecast import RunawayForecaster, watch
+from ptplab.kalman import aligned_readings
+from ptplab.models import PBR_PROBES, pbr_initial_state
+
+def test_aligned_readings_hold_the_last_sample():
+    run = {'tags': {'A': {'elapsed_time': np.array([0.0, 1.0, 3.0]), 'values': np.array([10.0, 11.0, 13.0])}}}
+    readings = aligned_readings(run, ['A', 'B'], np.array([-1.0, 0.0, 0.5, 1.0, 2.0, 3.0, 4.0]))
+    assert np.array_equal(readings[0], [np.nan, 10, 10, 11, 11, 13, 13], equal_nan=True)
+    assert np.all(np.isnan(readings[1]))
+
+def test_forecast_of_a_cold_run_raises_no_alert():
+    forecaster = RunawayForecaster(20, 24, 5.4, members=16, horizon=5, seed=0)
+    result = forecaster.forecast(pbr_initial_state(20, 9))
+    assert not result['alert'] and result['time_to_limit'] is None
+    assert result['median'] < 30
+
+def test_watch_follows_probes_with_gaps(monkeypatch):
+    '''Probes logged on change and with (null) gaps: every filter step gets the reading of the probe at its time'''
+    from ptplab import historian
+    from ptplab.catalog import get_run
+    load_run = historian.load_run
+    seen = []
+    def gappy(path, **options):
+        run = load_run(path, **options)
+        rng = np.random.default_rng(0)
+        for probe in PBR_PROBES:
+            series = run['tags'][probe]
+            keep = rng.random(len(series['values'])) > 0.3
+            keep[0] = True
+            run['tags'][probe] = {key: value[keep] for key, value in series.items()}
+        seen.append(run)
+        return run
+    monkeypatch.setattr(historian, 'load_run', gappy)
+    history = watch(get_run('PBR 40c'), every=50, members=8, horizon=2, seed=0)
+    assert seen # watch read the gappy export
+    assert history and all(np.isfinite(result['median']) for result in history)
@@ -0,0 +1,43 @@
+import shutil
+
+import numpy as np
+
+from ptplab.catalog import get_run, load_catalog_run, run_path
+from ptplab.health import HISTORY_PATH, ingest, load_history, run_flags
+from ptplab.historian import load_run
+from ptplab.models import PBR_PROBES
+from ptplab.probes import load_table
+
+def test_raw_run_is_not_checked_against_a_calibrated_history():
+    entry = dict(get_run('PBR 40c'), name='PBR 40c under a new name')
+    raw = load_run(run_path(entry))
+    assert run_flags(entry, raw, None) == ({}, False)
+    prepared = load_catalog_run(entry, probe_table=None)
+    assert sorted(prepared['probes']) == PBR_PROBES
+
+def test_checked_run_is_flagged_not_dropped(tmp_path, monkeypatch):
+    entry = dict(get_run('PBR 40c'), name='PBR 40c with a stuck probe', file=str(tmp_path/'stuck.csv'))
+    shutil.copy(run_path(get_run('PBR 40c')), entry['file'])
+    table = load_table()
+    from ptplab import catalog, historian
+    load = historian.load_run
+    def stuck(path, **options):
+        run = load(path, **options)
+        series = run['tags']['T204_PV']
+        series['values'] = np.full(len(series['values']), series['values'][0])
+        return run
+    monkeypatch.setattr(catalog, 'load_run', stuck)
+    monkeypatch.setattr(catalog, 'run_path', lambda entry: entry['file'])
+    flags, stored = run_flags(entry, stuck(entry['file'], calibration=table), table)
+    assert 'stuck' in flags['T204_PV'] and not stored
+    prepared = load_catalog_run(entry)
+    assert 'T204_PV' in prepared['probe_flags'] and 'T204_PV' in prepared['probes']
+
+    # once the run is in the history with the same table its flags are its own and the probe is dropped
+    path = str(tmp_path/'history.json')
+    shutil.copy(HISTORY_PATH, path)
+    ingest(stuck(entry['file'], calibration=table), entry['name'], path=path)
+    flags, stored = run_flags(entry, stuck(entry['file'], calibration=table), table, path=path)
+    assert 'stuck' in flags['T204_PV'] and stored
+    assert run_flags(entry, stuck(entry['file']), None, path=path)[1] is False # another table, only flagged
+    assert load_history(path).table_version == table['version']
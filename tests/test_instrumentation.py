@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from scipy.integrate import solve_ivp
+
+from ptplab import instrumentation
+from ptplab.models import PBR_model, pbr_der_func, pbr_initial_state, pbr_params
+
+@pytest.mark.parametrize('method', ['RK45', 'RK23', 'DOP853', 'LSODA', 'BDF', 'Radau'])
+def test_recorded_solve_matches_solve_ivp(method):
+    n = 6
+    args = (pbr_params(40, 26.8, 4.1, n=n), n)
+    y0 = pbr_initial_state(40, n)
+    plain = solve_ivp(pbr_der_func, [0, 1800], y0, method=method, args=args)
+    with instrumentation.record() as recorder:
+        sol = instrumentation.instrumented_solve(pbr_der_func, [0, 1800], y0, args=args, method=method)
+    entry, = recorder.records
+    assert entry['nfev'] == plain.nfev and entry['njev'] == plain.njev and entry['nlu'] == plain.nlu
+    assert np.array_equal(sol.t, plain.t) and np.array_equal(sol.y, plain.y)
+    assert entry['accepted_steps'] == len(sol.t) - 1 # without t_eval solve_ivp keeps every step
+    if method in ('RK45', 'RK23', 'DOP853'):
+        assert entry['rejected_steps'] >= 0
+    else:
+        assert entry['rejected_steps'] is None
+
+def test_models_report_to_nested_recorders():
+    with instrumentation.record() as outer:
+        PBR_model(40, 26.8, 4.1, n=6, tspan=[0, 600])
+        with instrumentation.record() as inner:
+            PBR_model(40, 26.8, 4.1, n=6, tspan=[0, 600], method='LSODA')
+    assert len(outer.records) == 2 and len(inner.records) == 1
+    assert inner.records[0]['method'] == 'LSODA'
+    assert not instrumentation.active()
+    assert outer.summary()['pbr_der_func']['solves'] == 2
@@ -0,0 +1,100 @@
+import numpy as np
+import pytest
+from scipy.integrate import solve_ivp
+
+from ptplab.integrators import embedded_rk, ensemble_master_function, fd_jacobian, implicit_fixed_step, master_function
+from ptplab.models import (PBR_BAND, cstr_der_func, cstr_ensemble_der_func, cstr_ensemble_params, cstr_params, cw_pure,
+                           pbr_der_func, pbr_initial_state, pbr_jacobian, pbr_params)
+
+def cstr_case(T=30):
+    params = cstr_params(T, 180, 15, V=567)
+    return (lambda t, y: cstr_der_func(t, y, params)), np.array([cw_pure, 0, 0, T + 273.15])
+
+def pbr_case(T=40, n=9):
+    params = pbr_params(T, 26.8, 4.1, n=n)
+    return (lambda t, y: pbr_der_func(t, y, params, n)), (lambda t, y: pbr_jacobian(t, y, params, n)), pbr_initial_state(T, n)
+
+def dense(ab, band=PBR_BAND):
+    '''solve_banded storage -> full matrix'''
+    lower, upper = band
+    d = ab.shape[1]
+    J = np.zeros((d, d))
+    for k in range(-upper, lower + 1):
+        J += np.diag(ab[upper + k, max(-k, 0):d - max(k, 0)], -k)
+    return J
+
+@pytest.mark.parametrize('method, scipy_method', [('dopri5', 'RK45'), ('bs23', 'RK23')])
+def test_embedded_pairs_take_the_steps_of_solve_ivp(method, scipy_method):
+    fun, y0 = cstr_case()
+    t, y, stats = embedded_rk(fun, [0, 3600], y0, method=method, rtol=1e-6, atol=1e-10)
+    reference = solve_ivp(fun, [0, 3600], y0, method=scipy_method, rtol=1e-6, atol=1e-10)
+    assert len(t) == len(reference.t) and np.allclose(t, reference.t, rtol=1e-4) # same steps up to rounding
+    assert stats['nfev'] == reference.nfev
+    assert np.allclose(y, reference.y.T, rtol=1e-6, atol=1e-10)
+
+@pytest.mark.parametrize('method', ['dopri5', 'bs23'])
+def test_dense_output_at_t_eval(method):
+    fun, y0 = cstr_case(40)
+    t_eval = np.linspace(0, 3600, 37)
+    t, y = master_function(fun, [0, 3600], y0, method=method, t_eval=t_eval, rtol=1e-8, atol=1e-12)
+    reference = solve_ivp(fun, [0, 3600], y0, method='LSODA', t_eval=t_eval, rtol=1e-10, atol=1e-14)
+    assert np.array_equal(t, t_eval)
+    assert np.max(np.abs(y[:, 3] - reference.y[3])) < 1e-4 # K
+    assert np.allclose(y[:, 2], reference.y[2], rtol=1e-5, atol=1e-12)
+
+def test_ensemble_matches_master_function():
+    T = np.array([25, 30, 40])
+    params = cstr_ensemble_params(T, 180, 15, V=567)
+    y0 = np.column_stack([np.full(3, cw_pure), np.zeros(3), np.zeros(3), T + 273.15])
+    _, ensemble = ensemble_master_function(cstr_ensemble_der_func, [0, 1800], y0, number_of_points=180, args=(params,))
+    for m in range(3):
+        fun, start = cstr_case(T[m])
+        _, single = master_function(fun, [0, 1800], start, number_of_points=180)
+        assert np.allclose(ensemble[:, m], single, rtol=1e-12, atol=1e-15)
+
+@pytest.mark.parametrize('method, scipy_method', [('dopri5', 'RK45'), ('bs23', 'RK23')])
+@pytest.mark.parametrize('t_end', [0.9, 1.1, 5.7])
+def test_last_step_ends_on_t_end(method, scipy_method, t_end):
+    # steps of max_step add up to 1 ulp short of t_end, the step after that has to end on t_end
+    t, y, stats = embedded_rk(lambda t, y: -y, [0, t_end], [1.0], method=method, max_step=0.1)
+    reference = solve_ivp(lambda t, y: -y, [0, t_end], [1.0], method=scipy_method, max_step=0.1)
+    assert t[-1] == t_end
+    assert np.array_equal(t, reference.t) and stats['nfev'] == reference.nfev
+    assert np.isclose(y[-1, 0], np.exp(-t_end), rtol=1e-3)
+    t, y = master_function(lambda t, y: -y, [0, t_end], [1.0], method=method, number_of_points=10, max_step=0.1)
+    assert t[-1] == t_end and np.isclose(y[-1, 0], np.exp(-t_end), rtol=1e-3)
+
+@pytest.mark.parametrize('method, order', [('backward_euler', 1), ('bdf2', 2), ('sdirk', 2)])
+def test_implicit_convergence_order(method, order):
+    fun, jac, y0 = pbr_case()
+    reference = solve_ivp(fun, [0, 600], y0, method='Radau', rtol=1e-12, atol=1e-14).y[:, -1]
+    scale = np.abs(reference) + 1e-6
+    errors = []
+    for steps in (50, 100, 200):
+        t, y, _ = implicit_fixed_step(fun, [0, 600], y0, method=method, number_of_points=steps, jac=jac, band=PBR_BAND,
+                                      rtol=1e-10, atol=1e-14)
+        errors.append(np.max(np.abs(y[-1] - reference)/scale))
+    observed = np.log2(np.array(errors[:-1])/errors[1:])
+    assert np.all(np.abs(observed - order) < 0.3)
+
+def test_banded_fd_jacobian_is_the_analytic_one():
+    fun, jac, y0 = pbr_case()
+    y = solve_ivp(fun, [0, 300], y0, method='LSODA', rtol=1e-8, atol=1e-12).y[:, -1] # reacting, not the flat start
+    ab, nfev = fd_jacobian(fun, 300, y, fun(300, y), band=PBR_BAND)
+    assert nfev == sum(PBR_BAND) + 1
+    analytic = jac(300, y)
+    assert np.allclose(ab, analytic, rtol=1e-5, atol=1e-7*np.max(np.abs(analytic)))
+    full, nfev = fd_jacobian(fun, 300, y, fun(300, y))
+    assert nfev == len(y)
+    assert np.allclose(full, dense(analytic), rtol=1e-5, atol=1e-7*np.max(np.abs(analytic)))
+
+def test_dense_banded_and_sparse_newton_agree():
+    from scipy.sparse import csr_matrix
+    fun, jac, y0 = pbr_case()
+    options = {'method': 'sdirk', 'number_of_points': 60, 'rtol': 1e-10, 'atol': 1e-14}
+    _, banded, _ = implicit_fixed_step(fun, [0, 600], y0, jac=jac, band=PBR_BAND, **options)
+    _, full, _ = implicit_fixed_step(fun, [0, 600], y0, jac=lambda t, y: dense(jac(t, y)), **options)
+    _, sparse, _ = implicit_fixed_step(fun, [0, 600], y0, jac=lambda t, y: csr_matrix(dense(jac(t, y))), **options)
+    _, finite, _ = implicit_fixed_step(fun, [0, 600], y0, band=PBR_BAND, **options)
+    for other in (full, sparse, finite):
+        assert np.allclose(other, banded, rtol=1e-9, atol=1e-12)
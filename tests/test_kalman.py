@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+import pytest
+
+from ptplab.kalman import CONCENTRATION_NOISE, TEMPERATURE_NOISE, PBRKalmanFilter, gaspari_cohn
+from ptplab.models import PBR_BAND, PBR_PROBES, pbr_der_func, pbr_jacobian
+
+def dense_jacobian(ekf):
+    lower, upper = PBR_BAND
+    ab = pbr_jacobian(ekf.t, ekf.x, ekf.params, ekf.n)
+    d = len(ekf.x)
+    J = np.zeros((d, d))
+    for k in range(-upper, lower + 1): # row - column
+        column = np.arange(max(0, -k), min(d, d - k))
+        J[column + k, column] = ab[upper + k, column]
+    return J
+
+class DenseFilter:
+    '''The same filter with a full covariance: P = A^-1 P A^-T + Q dt, tapered after every predict'''
+    def __init__(self, ekf, taper):
+        self.ekf = ekf # state, parameters and the measurement model are shared, only x and P are kept here
+        self.x = ekf.x.copy()
+        self.P = ekf.covariance()
+        tank = np.arange(len(self.x))//5
+        self.taper = 1 if taper is None else gaspari_cohn((tank[:, None] - tank[None, :])/taper)
+
+    def predict(self, t):
+        ekf = self.ekf
+        dt = t - ekf.t
+        ekf.x = self.x
+        A = np.eye(len(self.x)) - dt*dense_jacobian(ekf)
+        inverse = np.linalg.inv(A)
+        self.x = self.x + dt*inverse @ pbr_der_func(ekf.t, self.x, ekf.params, ekf.n)
+        self.P = (inverse @ self.P @ inverse.T + np.diag(ekf.q.ravel()*dt))*self.taper
+        ekf.t = t
+
+    def update(self, index, z, variance):
+        K = self.P[:, index]/(self.P[index, index] + variance)
+        self.x = self.x + K*(z - self.x[index])
+        self.P = self.P - np.outer(K, self.P[index])
+
+def samples(count):
+    '''Probe readings of a warming bed and a rising outlet conductivity every 15 s'''
+    for i in range(1, count + 1):
+        temperatures = {probe: 30 + 0.05*i*(1 + j/4) for j, probe in enumerate(PBR_PROBES)}
+        yield 15.0*i, temperatures, 500 + 40*i
+
+def run_both(n, taper, count=20):
+    ekf = PBRKalmanFilter(30, 24, 5.4, n=n, taper=taper)
+    reference = DenseFilter(PBRKalmanFilter(30, 24, 5.4, n=n, taper=taper), taper)
+    for t, temperatures, conductivity in samples(count):
+        ekf.step(t, temperatures, conductivity)
+        reference.predict(t)
+        for probe, value in temperatures.items():
+            reference.update(ekf.probe_index[probe], value + 273.15, TEMPERATURE_NOISE**2)
+        z = float(ekf.calibration.concentration(conductivity))*1e-3
+        reference.update(ekf.outlet_index, z, (CONCENTRATION_NOISE*1e-3)**2)
+    return ekf, reference
+
+@pytest.mark.parametrize('taper', [None, 2])
+def test_band_covers_a_short_reactor_exactly(taper):
+    '''Four tanks are all within the taper, so the band is the full matrix and nothing is left out'''
+    ekf, reference = run_both(4, taper)
+    assert ekf.half_width == 3
+    assert np.allclose(ekf.x, reference.x, rtol=1e-10, atol=0)
+    P = ekf.covariance()
+    assert np.allclose(P, P.T, rtol=0, atol=1e-12*np.abs(P).max())
+    scale = np.sqrt(np.outer(np.diag(reference.P), np.diag(reference.P)))
+    assert np.all(np.abs(P - reference.P) <= 1e-8*scale)
+
+def test_band_follows_the_dense_filter():
+    '''Nine tanks with the default taper: only what the taper would damp anyway is left out'''
+    ekf, reference = run_both(9, 2)
+    T = slice(3, None, 5)
+    assert np.allclose(ekf.x[T], reference.x[T], rtol=0, atol=1e-3) # K
+    assert ekf.x[ekf.outlet_index] == pytest.approx(reference.x[ekf.outlet_index], rel=1e-3)
+    std, expected = np.sqrt(np.diag(ekf.covariance())), np.sqrt(np.diag(reference.P))
+    assert np.allclose(std, expected, rtol=2e-3)
+    # beyond the taper the covariance is zero
+    tank = np.arange(5*9)//5
+    assert np.all(ekf.covariance()[np.abs(tank[:, None] - tank[None, :]) >= 4] == 0)
+
+def step_time(n, count=20):
+    ekf = PBRKalmanFilter(30, 24, 5.4, n=n)
+    readings = list(samples(count))
+    ekf.step(*readings[0])
+    start = time.perf_counter()
+    for sample in readings[1:]:
+        ekf.step(*sample)
+    return (time.perf_counter() - start)/(count - 1)
+
+def test_step_time_grows_linearly_with_the_tanks():
+    small = min(step_time(50) for _ in range(3))
+    large = min(step_time(200) for _ in range(3))
+    assert large/small < 8 # 4 times the tanks, a dense covariance would be 16 times slower or more
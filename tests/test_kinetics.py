@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from ptplab.catalog import RUNS
+from ptplab.kinetics import RecursiveArrhenius, extract, stream
+
+CSTR_RUNS = {entry['name']: entry for entry in RUNS if entry['reactor'] == 'CSTR'}
+
+@pytest.mark.parametrize('name', ['CSTR 27c', 'CSTR 27c-30c'])
+def test_stream_matches_extract(name):
+    entry = CSTR_RUNS[name]
+    batch = extract(entry)
+    estimates, extractor = stream(entry)
+    assert len(estimates) == len(batch['k'])
+    accepted = np.array([estimate['accepted'] for estimate in estimates])
+    assert np.any(accepted)
+    assert np.array_equal(accepted, batch['accepted'])
+    for key in ('t', 'T', 'c_aa', 'dcdt'):
+        assert np.allclose([estimate[key] for estimate in estimates], batch[key], rtol=1e-9, equal_nan=True)
+    # before the start the live extractor does not know the last concentration before the pump yet
+    started = batch['t'] >= 0
+    k = np.array([estimate['k'] for estimate in estimates])
+    assert np.allclose(k[started], batch['k'][started], rtol=1e-9, equal_nan=True)
+    streamed, archived = extractor.arrhenius.result(), batch['arrhenius'].result()
+    assert streamed['count'] == archived['count']
+    assert np.isclose(streamed['Ea'], archived['Ea'], rtol=1e-9)
+
+def test_recursive_arrhenius_matches_polyfit():
+    rng = np.random.default_rng(0)
+    T = rng.uniform(295, 320, 50)
+    k = 2e16*np.exp(-1e5/(8.314*T))*np.exp(rng.normal(0, 0.05, T.size))
+    fit = RecursiveArrhenius()
+    for T_sample, k_sample in zip(T, k):
+        fit.add(T_sample, k_sample)
+    x = fit.T_ref/T - 1
+    (slope, intercept), cov = np.polyfit(x, np.log(k), 1, cov='unscaled')
+    residuals = np.log(k) - (slope*x + intercept)
+    slope_std = np.sqrt(cov[0, 0]*np.sum(residuals**2)/(T.size - 2))
+    assert np.allclose(fit.theta, [slope, intercept], rtol=1e-6)
+    result = fit.result()
+    assert np.isclose(result['Ea_std'], slope_std*8.314*fit.T_ref, rtol=1e-3)
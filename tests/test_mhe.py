@@ -0,0 +1,58 @@
+import numpy as np
+
+from ptplab.mhe import MAX_HALVINGS, MovingHorizonEstimator
+from ptplab.models import PBR_PROBES
+
+def fake_model(estimator, theta_true, calls):
+    '''Probes that depend linearly on theta, with the sensitivities that go with it'''
+    d = 5*estimator.n
+    def simulate(theta, x0, t_eval):
+        calls.append(np.array(theta))
+        S = np.zeros((len(t_eval), d, 2))
+        S[:, estimator.probe_index, 0] = np.linspace(0.5, 2, len(PBR_PROBES))
+        S[:, estimator.probe_index, 1] = np.linspace(2, 0.5, len(PBR_PROBES))
+        x = np.full((len(t_eval), d), 303.15) + S @ (np.asarray(theta) - theta_true)
+        return x, S
+    return simulate
+
+def feed(estimator, minutes):
+    for t in np.arange(0.25, minutes, 0.25):
+        estimator.add(t, np.full(len(PBR_PROBES), 30.0))
+
+def test_gauss_newton_keeps_theta_and_trajectory_together():
+    estimator = MovingHorizonEstimator(30, 24, 5.4)
+    theta_true = estimator.theta + [0.3, -0.2]
+    calls = []
+    estimator.simulate = fake_model(estimator, theta_true, calls)
+    feed(estimator, 2.1)
+    result = estimator.history[-1]
+    assert np.allclose(estimator.theta, theta_true, atol=1e-3) # the prior pulls only a little
+    # what is stored belongs to the accepted theta
+    x, _ = estimator.simulate(estimator.theta, estimator.x0, estimator.last_fit['t'])
+    assert np.allclose(estimator.last_fit['x'], x)
+    assert result['rms'] < 1e-3
+
+def test_step_that_raises_the_cost_is_rejected():
+    estimator = MovingHorizonEstimator(30, 24, 5.4)
+    start = estimator.theta.copy()
+    calls = []
+    linear = fake_model(estimator, start, calls)
+    def flat(theta, x0, t_eval): # the probes do not follow theta, every step only adds arrival cost
+        x, S = linear(start, x0, t_eval)
+        calls[-1] = np.array(theta)
+        return x + 0.5, S
+    estimator.simulate = flat
+    feed(estimator, 2.1)
+    assert len(estimator.history) == 1
+    assert np.array_equal(estimator.theta, start)
+    assert estimator.history[0]['iterations'] == 1
+    assert len(calls) == 1 + MAX_HALVINGS
+    assert np.allclose(estimator.history[0]['rms'], 0.5)
+
+def test_window_buffer_is_trimmed():
+    estimator = MovingHorizonEstimator(30, 24, 5.4, window=4, step=1)
+    estimator.simulate = fake_model(estimator, estimator.theta, [])
+    feed(estimator, 30)
+    assert len(estimator.history) > 20
+    assert len(estimator.times) <= 4/0.25 + 4 # window plus the samples since the last fit
+    assert len(estimator.values) == len(estimator.times)
@@ -0,0 +1,63 @@
+import csv
+
+import numpy as np
+import pytest
+
+from ptplab.catalog import load_catalog_run
+from ptplab.estimation import to_x
+from ptplab.models import PBR_KINETICS
+from ptplab.multistart import SEARCH_SPACE, latin_hypercube_starts, merge_minima, multistart_fit, write_table
+from ptplab.synthetic import generate_export
+
+def test_latin_hypercube_starts():
+    starts = latin_hypercube_starts(20, seed=0)
+    assert starts == latin_hypercube_starts(20, seed=0)
+    ln_k0 = np.log([start['k0'] for start in starts])
+    low, high = np.log(SEARCH_SPACE['k0'])
+    assert np.all((ln_k0 >= low) & (ln_k0 <= high))
+    # one start in every stratum
+    assert np.array_equal(np.sort(np.floor((ln_k0 - low)/(high - low)*20)), np.arange(20))
+    for start in starts:
+        assert SEARCH_SPACE['Ea'][0] <= start['Ea'] <= SEARCH_SPACE['Ea'][1]
+        assert SEARCH_SPACE['U'][0] <= start['U'] <= SEARCH_SPACE['U'][1]
+        assert isinstance(start['n'], int) and SEARCH_SPACE['n'][0] <= start['n'] <= SEARCH_SPACE['n'][1]
+
+def local(x, cost, n=9, success=True):
+    kinetics = {'k0': float(np.exp(x[0])), 'Ea': x[1]*1e3, 'U': float(np.exp(x[2]))}
+    return {'start': {'n': n, 'cost': cost}, 'success': success, 'n': n, 'x': np.array(x, dtype=float), 'cost': cost,
+            'kinetics': kinetics, 'stderr': {'k0': 1.0, 'Ea': 2.0, 'U': 3.0}}
+
+def test_merge_minima():
+    a, b = [35.0, 98.0, -9.0], [20.0, 60.0, -9.0]
+    fits = [local(a, 2.0), local(b, 5.0), local(np.add(a, 1e-3), 2.1), local(a, 2.05, n=12),
+            local(np.add(b, [0, 0.01, 0]), 5.2), local(a, 1.0, success=False)]
+    minima = merge_minima(fits)
+    assert [(minimum['rank'], minimum['n'], minimum['count']) for minimum in minima] == [(1, 9, 2), (2, 12, 1), (3, 9, 2)]
+    assert [minimum['cost'] for minimum in minima] == [2.0, 2.05, 5.0] # the best fit of every minimum is kept
+    assert np.allclose(minima[2]['x'], b)
+
+def test_write_table(tmp_path):
+    minima = merge_minima([local([35.0, 98.0, -9.0], 2.0), local([20.0, 60.0, -9.0], 5.0)])
+    path = tmp_path/'minima.csv'
+    write_table(minima, path)
+    with open(path, newline='') as file:
+        rows = list(csv.DictReader(file))
+    assert [int(row['rank']) for row in rows] == [1, 2]
+    assert float(rows[1]['Ea']) == pytest.approx(60e3)
+    assert float(rows[0]['stderr_U']) == 3.0
+
+def test_multistart_finds_the_synthetic_minimum(tmp_path):
+    true = dict(PBR_KINETICS)
+    runs = []
+    for T in (25, 40):
+        path = str(tmp_path/f'{T}.csv')
+        generate_export(path, 'CSTR', T=T, fv_water=180, fv_aah=15, duration=20, sample_interval=10, noise=0, kinetics=true)
+        runs.append(load_catalog_run({'name': f'CSTR {T}', 'reactor': 'CSTR', 'file': path, 'V': 567, 'step_change': False},
+                                     probe_table=None, probe_health=None))
+    space = dict(SEARCH_SPACE, k0=(1e13, 1e16), Ea=(9e4, 1.05e5), n=(9, 9))
+    minima, fits = multistart_fit(runs, n_starts=3, fit=('k0', 'Ea'), space=space, seed=1, processes=1)
+    assert len(fits) == 3 and all(fit['success'] for fit in fits)
+    assert sum(minimum['count'] for minimum in minima) == 3
+    best = minima[0]
+    assert np.allclose(best['x'], to_x(true, ('k0', 'Ea')), rtol=1e-3)
+    assert best['kinetics']['U'] == best['start']['U'] # not fitted, kept at the start
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+
+from ptplab.health import ProbeHistory, STATISTICS, run_key, save_history
+from ptplab.models import PBR_PROBES
+from ptplab.pipeline import Pipeline
+
+def read_number(path):
+    with open(path) as file:
+        return float(file.read())
+
+def double(x, factor=2):
+    return x*factor
+
+def add(a, b):
+    return a + b
+
+def write_file(value, output):
+    path = os.path.join(output, 'value.txt')
+    with open(path, 'w') as file:
+        file.write(str(value))
+    return path
+
+def toy_pipeline(tmp_path, factor=2):
+    lab = Pipeline(str(tmp_path/'cache'))
+    lab.add('a', read_number, files=[str(tmp_path/'a.txt')])
+    lab.add('b', read_number, files=[str(tmp_path/'b.txt')])
+    lab.add('double', double, inputs=['a'], params={'factor': factor})
+    lab.add('sum', add, inputs=['double', 'b'])
+    lab.add('file', write_file, inputs=['sum'], params={'output': str(tmp_path)}, produces=True)
+    return lab
+
+def test_cache_hit_and_invalidation(tmp_path):
+    (tmp_path/'a.txt').write_text('1')
+    (tmp_path/'b.txt').write_text('10')
+    lab = toy_pipeline(tmp_path)
+    assert lab.build(['sum']) == {'sum': 12}
+    assert all(state == 'built' for _, state in lab.log)
+
+    lab = toy_pipeline(tmp_path)
+    assert lab.outdated(['sum']) == []
+    assert lab.build(['sum']) == {'sum': 12}
+    assert lab.log == [('sum', 'cached')] # a cached node does not need its inputs
+
+    (tmp_path/'b.txt').write_text('20')
+    lab = toy_pipeline(tmp_path)
+    assert lab.outdated(['sum']) == ['b', 'sum']
+    assert lab.build(['sum']) == {'sum': 22}
+    assert dict(lab.log) == {'sum': 'built', 'double': 'cached', 'b': 'built'}
+
+    lab = toy_pipeline(tmp_path, factor=3)
+    assert lab.build(['sum']) == {'sum': 23}
+    assert dict(lab.log) == {'sum': 'built', 'double': 'built', 'a': 'cached', 'b': 'cached'}
+    assert len(lab.clean()) == 4 # the old b, double and both old sums
+
+def test_missing_product_is_rebuilt(tmp_path):
+    (tmp_path/'a.txt').write_text('1')
+    (tmp_path/'b.txt').write_text('10')
+    path = toy_pipeline(tmp_path).build(['file'])['file']
+    lab = toy_pipeline(tmp_path)
+    lab.build(['file'])
+    assert lab.log == [('file', 'cached')]
+    os.remove(path)
+    lab = toy_pipeline(tmp_path)
+    assert lab.outdated(['file']) == ['file']
+    lab.build(['file'])
+    assert lab.log[0] == ('sum', 'cached') and lab.log[-1] == ('file', 'built')
+    assert os.path.exists(path)
+
+def test_health_key_of_a_run_ignores_other_runs(tmp_path):
+    path = str(tmp_path/'history.json')
+    statistics = {name: np.zeros(len(PBR_PROBES)) for name in STATISTICS + ('movement',)}
+    statistics.update(present=np.ones(len(PBR_PROBES), dtype=bool), isothermal=10)
+    history = ProbeHistory()
+    history.add(statistics, name='run 1', digest='one')
+    save_history(history, path)
+    first, new = run_key('run 1', 'one', path), run_key('run 3', 'three', path)
+    history.add(statistics, name='run 2', digest='two')
+    save_history(history, path)
+    assert run_key('run 1', 'one', path) == first # stored entry
+    assert run_key('run 1', 'changed file', path) != first
+    assert run_key('run 3', 'three', path) != new # checked against a baseline that moved
+    assert run_key('run 1', 'one', str(tmp_path/'none.json')) is None
@@ -0,0 +1,32 @@
+import numpy as np
+
+from ptplab.replicates import aggregate, batched_interp, replicate_groups
+
+def test_batched_interp_matches_np_interp():
+    rng = np.random.default_rng(1)
+    series = []
+    for length in (5, 0, 40, 1, 12, 0): # empty and single sample series, last one empty
+        times = np.sort(rng.uniform(-2, 30, length))
+        series.append((times, rng.normal(size=length)))
+    grid = np.linspace(-5, 35, 200)
+    out = batched_interp(grid, series)
+    assert out.shape == (len(series), len(grid))
+    for row, (times, values) in zip(out, series):
+        if len(times) < 2:
+            assert np.all(np.isnan(row))
+            continue
+        inside = (grid >= times[0]) & (grid <= times[-1])
+        assert np.allclose(row[inside], np.interp(grid[inside], times, values))
+        assert np.all(np.isnan(row[~inside]))
+
+def test_batched_interp_without_usable_series():
+    out = batched_interp(np.arange(3.0), [(np.zeros(0), np.zeros(0)), (np.ones(1), np.ones(1))])
+    assert out.shape == (2, 3) and np.all(np.isnan(out))
+
+def test_missing_tag_is_nan():
+    from ptplab.catalog import RUNS
+    group = replicate_groups([entry for entry in RUNS if entry['name'] in ('CSTR 27c', 'CSTR 27c-30c')])[0]
+    stats = aggregate(group, tags=['T200_PV', 'NOPE_PV'])
+    assert np.all(np.isnan(stats['values'][:, 1]))
+    assert np.all(stats['n'][1] == 0)
+    assert np.any(stats['n'][0] == 2)
@@ -0,0 +1,55 @@
+from itertools import product
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from ptplab import surrogate
+from ptplab.surrogate import OUTPUTS, STEADY_TIME, build_table, load_table, lookup, lookup_point, solve_point
+
+GRID = {'T': np.linspace(20, 40, 5), 'ratio': np.linspace(0.05, 0.11, 4), 'flow': np.linspace(150, 240, 4)}
+
+@pytest.fixture(scope='module')
+def table(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('surrogate')/'cstr')
+    build_table(path, 'CSTR', grid=GRID, processes=1)
+    return load_table(path)
+
+def test_solve_point_cstr():
+    values = solve_point('CSTR', 25, 0.08, 200, 1, V=567, t_end=3600)
+    assert values.shape == (len(OUTPUTS),)
+    assert np.all(np.isfinite(values))
+    assert 0 < values[3] < 1 # conversion
+
+def test_failed_solve_is_nan(monkeypatch):
+    failed = lambda *args, **options: SimpleNamespace(success=False, y=np.zeros((4, 0)))
+    monkeypatch.setattr(surrogate, 'CSTR_model', failed)
+    monkeypatch.setattr(surrogate, 'PBR_model', failed)
+    assert np.all(np.isnan(solve_point('CSTR', 25, 0.08, 200, 1, V=567, t_end=3600)))
+    assert np.all(np.isnan(solve_point('PBR', 25, 0.2, 24, 9, V=131, t_end=3600)))
+
+def test_table_is_memory_mapped(table):
+    assert isinstance(table['values'], np.memmap) and isinstance(table['error'], np.memmap)
+    assert table['values'].shape == (5, 4, 4, 1, len(OUTPUTS))
+    assert np.all(np.isfinite(table['values'])) and np.all(table['error'] >= 0)
+
+def test_lookup_at_the_nodes_is_exact(table):
+    nodes = np.array(list(product(GRID['T'], GRID['ratio'], GRID['flow'], [1])))
+    stored = np.asarray(table['values']).reshape(-1, len(OUTPUTS))
+    for method in ('linear', 'cubic'):
+        values, _ = lookup(table, *nodes.T, method=method)
+        assert np.allclose(values, stored, rtol=1e-12, atol=1e-12)
+    for node, expected in zip(nodes[::7], stored[::7]):
+        assert np.array_equal(lookup_point(table, *node)[0], expected)
+
+def test_lookup_between_nodes_is_within_the_error_estimate(table):
+    rng = np.random.default_rng(0)
+    points = np.column_stack([rng.uniform(20, 40, 8), rng.uniform(0.05, 0.11, 8), rng.uniform(150, 240, 8), np.ones(8)])
+    direct = np.array([solve_point('CSTR', *point, V=567, t_end=STEADY_TIME) for point in points])
+    linear, error = lookup(table, *points.T)
+    cubic, _ = lookup(table, *points.T, method='cubic')
+    assert np.all(np.abs(linear - direct) <= error)
+    assert np.all(np.abs(cubic - direct) <= error)
+    for point, values, bound in zip(points, linear, error):
+        single = lookup_point(table, *point)
+        assert np.allclose(single[0], values) and np.allclose(single[1], bound)
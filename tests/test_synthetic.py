@@ -0,0 +1,29 @@
+import numpy as np
+
+from ptplab.historian import load_run
+from ptplab.models import PBR_PROBES
+from ptplab.synthetic import generate_export, simulate_tags
+
+def test_export_roundtrips_through_load_run(tmp_path):
+    path = str(tmp_path/'synthetic.csv')
+    t, values = simulate_tags('PBR', T=30, duration=20, lead_time=5)
+    rows = generate_export(path, 'PBR', T=30, duration=20, lead_time=5, noise=0)
+    assert rows == len(t)*len(values)
+    run = load_run(path)
+    assert run['start_detected']
+    assert set(values) <= set(run['tags'])
+    seconds = np.floor(t) # the historian drops the fractional seconds
+    start = seconds[np.argmax(values['P120_Flow'] > 0)] # first sample with the AAH pump on
+    for tag in PBR_PROBES + ['P120_Flow', 'QT210_PV']:
+        series = run['tags'][tag]
+        assert np.allclose(series['elapsed_time'], (seconds - start)/60)
+        assert np.allclose(series['values'], values[tag], rtol=1e-12, atol=1e-9)
+
+def test_null_rows_are_dropped(tmp_path):
+    path = str(tmp_path/'synthetic.csv')
+    generate_export(path, 'CSTR', T=25, fv_water=180, fv_aah=15, duration=10, null_fraction=0.2, seed=1)
+    run = load_run(path)
+    t, _ = simulate_tags('CSTR', T=25, fv_water=180, fv_aah=15, duration=10)
+    lengths = [len(series['values']) for series in run['tags'].values()]
+    assert all(0 < length < len(t) for length in lengths)
+    assert all(np.all(np.isfinite(series['values'])) for series in run['tags'].values())
@@ -0,0 +1,48 @@
+import numpy as np
+
+from ptplab import uncertainty
+from ptplab.estimation import simulate_run, to_x
+from ptplab.models import PBR_KINETICS, PBR_PROBES
+from ptplab.uncertainty import StreamingQuantiles, propagate_kinetics
+
+def pbr_run():
+    '''Prepared run as catalog.load_catalog_run gives it, only what the model needs'''
+    probes = {probe: {'elapsed_time': np.linspace(0, 30, 50), 'rise': np.zeros(50)} for probe in PBR_PROBES}
+    return {'reactor': 'PBR', 'T_in': 30, 'fv_water': 24, 'fv_aah': 5.4, 'V': 131, 'n': 9, 'probes': probes}
+
+def fitted(scale):
+    x = to_x(PBR_KINETICS)
+    return {'x': x, 'cov_x': np.diag(np.full(len(x), scale)**2), 'fit': ('k0', 'Ea', 'U'), 'kinetics': PBR_KINETICS}
+
+def test_p_square_matches_np_quantile():
+    rng = np.random.default_rng(0)
+    samples = rng.normal(size=(5000, 3))*[1, 2, 5] + [0, 1, -3]
+    stats = StreamingQuantiles((0.05, 0.5, 0.95), shape=(3,))
+    for row in samples:
+        stats.add(row)
+    exact = np.quantile(samples, (0.05, 0.5, 0.95), axis=0)
+    assert np.allclose(stats.quantiles(), exact, atol=0.05*np.std(samples, axis=0))
+    assert np.allclose(stats.mean(), samples.mean(axis=0))
+    assert np.allclose(stats.std(), samples.std(axis=0, ddof=1))
+
+def test_p_square_before_five_observations():
+    stats = StreamingQuantiles((0.5,), shape=(2,))
+    assert np.all(np.isnan(stats.quantiles())) and np.all(np.isnan(stats.mean()))
+    stats.add([1, 2])
+    stats.add([3, 4])
+    assert np.allclose(stats.quantiles(), [[2, 3]])
+
+def test_ensemble_matches_solve_ivp():
+    '''With a tiny covariance the median band is the LSODA solution at the fitted kinetics'''
+    run = pbr_run()
+    bands = propagate_kinetics(run, fitted(1e-9), n_samples=8, seed=0)
+    t, temps, sol = simulate_run(run, PBR_KINETICS)
+    assert np.allclose(bands['time'], t)
+    for probe in PBR_PROBES:
+        assert np.max(np.abs(bands[probe]['bands'][1] - (temps[probe] - 273.15))) < 0.05
+
+def test_no_member_left_gives_nan(monkeypatch):
+    monkeypatch.setattr(uncertainty, '_simulate_ensemble', lambda run, chunk, n_eval, step: np.full((len(chunk), 9, n_eval), np.nan))
+    bands = propagate_kinetics(pbr_run(), fitted(0.1), n_samples=10, seed=0)
+    assert bands['n_samples'] == 0
+    assert np.all(np.isnan(bands['T201_PV']['bands'])) and np.all(np.isnan(bands['C_AA_out']['mean']))